@@ -0,0 +1,119 @@
+"""
+local stand-in for minecraft's rcon server. it answers the way vanilla does:
+a wrong password gets request id -1, output longer than a packet comes back
+in several packets, and a packet type it doesn't know gets one reply, which
+mcm sends after each command to mark the end of its output. the hang command
+never answers, for timeouts
+"""
+import struct
+import asyncio
+import threading
+
+
+LOGIN = 3
+COMMAND = 2
+RESPONSE = 0
+# vanilla splits command output into packets of at most this many bytes
+FRAGMENT = 4096
+PASSWORD = 'secret'
+
+
+def packet(request_id, kind, payload):
+    """
+    encode an rcon packet
+    """
+    body = struct.pack('<ii', request_id, kind) + payload.encode('utf-8') + b'\x00\x00'
+    return struct.pack('<i', len(body)) + body
+
+
+def reply(command):
+    """
+    return the output of a command: long <n> answers n bytes, list answers
+    like an empty server and anything else is echoed back
+    """
+    name, _, argument = command.partition(' ')
+    if name == 'long':
+        return ''.join(chr(ord('a') + i % 26) for i in range(int(argument)))
+    if name == 'list':
+        return 'There are 0 of a max of 20 players online: '
+    return command
+
+
+class FakeRcon:
+    """
+    rcon servers on free local ports, served from a background event loop
+    """
+    def __init__(self, password=PASSWORD):
+        self.password = password
+        self.loop = asyncio.new_event_loop()
+        self.servers = []
+        self.commands = 0
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    async def send(self, writer, request_id, payload):
+        """
+        send a response, each packet written in two halves so the client has
+        to reassemble it
+        """
+        data = packet(request_id, RESPONSE, payload)
+        writer.write(data[:len(data) // 2])
+        await writer.drain()
+        writer.write(data[len(data) // 2:])
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        """
+        answer one client until it disconnects
+        """
+        authenticated = False
+        try:
+            while True:
+                length = struct.unpack('<i', await reader.readexactly(4))[0]
+                body = await reader.readexactly(length)
+                request_id, kind = struct.unpack('<ii', body[:8])
+                payload = body[8:-2].decode('utf-8')
+                if kind == LOGIN:
+                    authenticated = payload == self.password
+                    writer.write(packet(request_id if authenticated else -1, COMMAND, ''))
+                elif not authenticated:
+                    break
+                elif kind == COMMAND and payload == 'hang':
+                    # hold the connection without answering until the client gives up
+                    await reader.read()
+                    break
+                elif kind == COMMAND:
+                    self.commands += 1
+                    output = reply(payload).encode('utf-8')
+                    for start in range(0, max(len(output), 1), FRAGMENT):
+                        await self.send(writer, request_id,
+                            output[start:start + FRAGMENT].decode('utf-8'))
+                else:
+                    await self.send(writer, request_id, f'Unknown request {kind:x}')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self, count=1):
+        """
+        start count servers, returning their ports
+        """
+        async def listen():
+            return await asyncio.start_server(self.handle, '127.0.0.1', 0)
+
+        for _ in range(count):
+            self.servers.append(asyncio.run_coroutine_threadsafe(listen(), self.loop).result())
+        return [server.sockets[0].getsockname()[1] for server in self.servers[-count:]]
+
+    def stop(self):
+        """
+        close every server and stop the loop
+        """
+        async def close():
+            for server in self.servers:
+                server.close()
+                await server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.servers = []
+        self.loop.call_soon_threadsafe(self.loop.stop)
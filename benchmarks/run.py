@@ -0,0 +1,521 @@
+"""
+offline benchmarks of mcm against a local stand-in for upstream. each case
+runs a few times in a scratch home and reports its median wall time and how
+many upstream requests it made. results can be saved as a baseline, and
+later runs compared against one fail when a case got slower or chattier.
+a baseline file keeps one baseline per python version, as timings differ
+between interpreters
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+from fnmatch import fnmatch
+from importlib.util import find_spec
+from pathlib import Path
+
+from fake_rcon import FakeRcon, PASSWORD, FRAGMENT
+from upstream import Upstream, LARGE_JAR, LARGE_SIZE, PLUGINS, MODS
+
+
+ROOT = Path(__file__).resolve().parent.parent
+MCM = 'import sys, mcm; sys.argv[0] = "mcm"; mcm.main()'
+# mcm list is run by monitoring scripts and must not load the http, html or thread pool stacks
+HEAVY_MODULES = {'urllib.request', 'html.parser', 'concurrent.futures'}
+# runs mcm like MCM, listing every module it loaded on stderr as it exits. -X importtime
+# would do, but python 3.6 doesn't have it
+STARTUP = 'import sys, atexit, mcm; sys.argv[0] = "mcm"; ' + \
+    'atexit.register(lambda: sys.stderr.write("\\n".join(sys.modules))); mcm.main()'
+# versions the update cases start from, a few builds behind the newest
+OLD_VERSIONS = {'vanilla': '1.16.4', 'paper': '1.16.5-700', 'forge': '1.16.5-36.4.0'}
+LIST_SAVES = 10000
+STARTUP_SAVES = 10
+EXEC_SERVERS = 50
+PLUGIN_SERVERS = 30
+# the minecraft version of a generated forge page and the version to resolve from it
+GENERATED_PAGES = {'latest': (None, None), 'old-build': ('1.12.2', '1.12.2-32.0.0')}
+# seconds a case may slow down by regardless of tolerance, as timer noise
+SLACK = 0.05
+HEADER = ('case', 'median', 'min', 'requests', '')
+
+
+class Bench:
+    """
+    a stand-in upstream and scratch homes for the cases to run in
+    """
+    def __init__(self, scratch):
+        self.scratch = scratch
+        self.upstream = Upstream().start()
+        self.homes = 0
+
+    def home(self):
+        """
+        return a fresh home directory with its own caches and systemd directory
+        """
+        self.homes += 1
+        home = Path(self.scratch, f'home{self.homes}')
+        Path(home, 'systemd').mkdir(parents=True)
+        return home
+
+    def env(self, home):
+        """
+        return the environment mcm runs with in a home
+        """
+        return dict(os.environ, HOME=str(home), XDG_CACHE_HOME=str(Path(home, '.cache')),
+            MCM_UPSTREAM=self.upstream.url, MCM_SYSTEMD_DIR=str(Path(home, 'systemd')),
+            PYTHONPATH=str(ROOT))
+
+    def mcm(self, home, *args):
+        """
+        run an mcm command in a home, failing loudly if it fails, and return
+        what it printed
+        """
+        result = subprocess.run([sys.executable, '-c', MCM] + list(args), cwd=str(home),
+            env=self.env(home), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+        if result.returncode != 0:
+            raise RuntimeError(f'mcm {" ".join(args)} failed: {result.stdout.decode()}')
+        return result.stdout.decode()
+
+    def measure(self, func):
+        """
+        return the wall time of a call and the upstream requests it made
+        """
+        requests = self.upstream.requests
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start, self.upstream.requests - requests
+
+
+def write_saves(home, saves):
+    """
+    write a saves.json into a home
+    """
+    Path(home, '.config/mcm').mkdir(parents=True, exist_ok=True)
+    with open(Path(home, '.config/mcm/saves.json'), 'wt') as file:
+        file.write(json.dumps(saves, indent=4))
+
+
+def create_case(fork, warm):
+    """
+    time creating a server, with nothing cached or with every document and
+    the jar already cached by an earlier create
+    """
+    def case(bench):
+        home = bench.home()
+        if warm:
+            bench.mcm(home, 'create', fork, '-n', 'first')
+        return bench.measure(lambda: bench.mcm(home, 'create', fork, '-n', 'timed'))
+    return case
+
+
+def update_case(fork):
+    """
+    time updating a server from an older build to the newest
+    """
+    def case(bench):
+        home = bench.home()
+        bench.mcm(home, 'create', fork, '-n', 'timed', '-v', OLD_VERSIONS[fork])
+        return bench.measure(lambda: bench.mcm(home, 'update', 'timed'))
+    return case
+
+
+def update_all_case(bench):
+    """
+    time updating ten servers of every fork at once
+    """
+    home = bench.home()
+    saves = []
+    for fork, version in OLD_VERSIONS.items():
+        for i in range(10):
+            path = Path(home, f'{fork}{i}')
+            path.mkdir()
+            saves.append({'name': f'{fork}{i}', 'fork': fork, 'version': version,
+                'path': str(path)})
+    write_saves(home, saves)
+    return bench.measure(lambda: bench.mcm(home, 'update', '--all'))
+
+
+def list_case(bench):
+    """
+    time listing a large save file
+    """
+    home = bench.home()
+    write_saves(home, [{'name': f'server{i}', 'fork': 'paper', 'version': '1.16.5-794',
+        'path': f'/srv/minecraft/server{i}', 'jar': 'paper-1.16.5-794.jar'}
+        for i in range(LIST_SAVES)])
+    return bench.measure(lambda: bench.mcm(home, 'list'))
+
+
+def startup_case(bench):
+    """
+    time mcm list on a small save file as a whole process, as monitoring
+    scripts run it, failing if it loaded any of HEAVY_MODULES
+    """
+    home = bench.home()
+    write_saves(home, [{'name': f'server{i}', 'fork': 'paper', 'version': '1.16.5-794',
+        'path': f'/srv/minecraft/server{i}', 'jar': 'paper-1.16.5-794.jar'}
+        for i in range(STARTUP_SAVES)])
+    modules = []
+
+    def run():
+        modules.extend(subprocess.run([sys.executable, '-c', STARTUP, 'list'], cwd=str(home),
+            env=bench.env(home), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            check=True).stderr.decode().splitlines())
+
+    result = bench.measure(run)
+    heavy = HEAVY_MODULES & set(modules)
+    if heavy:
+        raise RuntimeError(f'mcm list loaded {", ".join(sorted(heavy))}')
+    return result
+
+
+def forge_page_case(version_arg):
+    """
+    time scraping a forge index page, stopping at the recommended download block
+    or scanning a long page for an old build
+    """
+    def case(bench):
+        from mcm.forge import resolve_from_page # pylint: disable=import-outside-toplevel
+        return bench.measure(lambda: resolve_from_page(version_arg))
+    return case
+
+
+def find_link(page, version_arg):
+    """
+    pick the link out of a page with LinkFinder, fed in blocks and stopping
+    at the link as resolve_from_page does
+    """
+    from mcm.forge import LinkFinder, BLOCK_SIZE # pylint: disable=import-outside-toplevel
+    finder = LinkFinder(version_arg)
+    for start in range(0, len(page), BLOCK_SIZE):
+        finder.feed(page[start:start + BLOCK_SIZE])
+        if finder.link is not None:
+            return finder.link
+    finder.close()
+    return finder.link
+
+
+def soup_link(page, version_arg):
+    """
+    pick the link out of a page the way mcm did before LinkFinder, parsing
+    the whole page with BeautifulSoup first
+    """
+    # pylint: disable=import-outside-toplevel,import-error,not-an-iterable,unsubscriptable-object
+    from bs4 import BeautifulSoup
+    parsed_page = BeautifulSoup(page, 'html.parser')
+    if version_arg is not None and '-' in version_arg:
+        links = [e['href'] for e in parsed_page.find_all('a', href=True) if \
+            'universal' in e['href'] and f'/{version_arg}' in e['href']]
+        return links[0] if links else None
+    blocks = parsed_page.find_all('div', attrs={'class': 'download'})
+    block = blocks[0 if version_arg == 'latest' or len(blocks) == 1 else 1]
+    return block.find_all('a')[-1]['href'].partition('url=')[2]
+
+
+def parse_case(parser, page):
+    """
+    time picking the link out of one of the generated pages, held in memory.
+    cases needing beautifulsoup4 are skipped without it
+    """
+    def case(bench):
+        if parser is soup_link and find_spec('bs4') is None:
+            return None
+        mc_version, version_arg = GENERATED_PAGES[page]
+        text = bench.upstream.fixtures.forge_page(mc_version).decode('utf-8')
+        return bench.measure(lambda: parser(text, version_arg))
+    return case
+
+
+def rcon_protocol_case(bench):
+    """
+    time the rcon client through a refused login, a reply split over
+    several packets, a timeout and a command on the same connection after
+    it, failing if any of them goes wrong
+    """
+    # pylint: disable=import-outside-toplevel,import-error
+    from mcm.rcon import RconClient, RconError
+    from mcm.utils import run_async
+    fake = FakeRcon()
+    port = fake.start()[0]
+
+    async def exchange():
+        try:
+            await RconClient('127.0.0.1', port, 'wrong').command('list')
+            raise RuntimeError('a wrong rcon password was accepted')
+        except RconError:
+            pass
+        client = RconClient('127.0.0.1', port, PASSWORD)
+        output = await client.command(f'long {FRAGMENT * 3 + 100}')
+        if len(output) != FRAGMENT * 3 + 100:
+            raise RuntimeError(f'reassembled {len(output)} bytes of a fragmented reply')
+        try:
+            await asyncio.wait_for(client.command('hang'), 0.2)
+            raise RuntimeError('a command that never answered did not time out')
+        except asyncio.TimeoutError:
+            pass
+        # the timed out connection is dropped, so the next command starts clean
+        if await client.command('list') != 'There are 0 of a max of 20 players online: ':
+            raise RuntimeError('rcon replies got out of step after a timeout')
+        client.close()
+
+    try:
+        return bench.measure(lambda: run_async(exchange()))
+    finally:
+        fake.stop()
+
+
+def exec_case(bench):
+    """
+    time mcm exec fanning a command with a multi-packet reply out to many
+    servers at once
+    """
+    fake = FakeRcon()
+    home = bench.home()
+    write_saves(home, [{'name': f'server{i}', 'fork': 'paper', 'version': '1.16.5-794',
+        'path': str(Path(home, f'server{i}')), 'rcon': {'port': port, 'password': PASSWORD}}
+        for i, port in enumerate(fake.start(EXEC_SERVERS))])
+    try:
+        result = bench.measure(lambda: bench.mcm(home, 'exec', '--all', f'long {FRAGMENT * 2}'))
+    finally:
+        fake.stop()
+    if fake.commands != EXEC_SERVERS:
+        raise RuntimeError(f'mcm exec reached {fake.commands} of {EXEC_SERVERS} servers')
+    return result
+
+
+def plugin_home(bench):
+    """
+    return a home with paper servers listing every stand-in plugin and
+    forge servers listing every mod in their manifests
+    """
+    home = bench.home()
+    saves = []
+    for i in range(PLUGIN_SERVERS):
+        fork = 'forge' if i % 3 == 2 else 'paper'
+        path = Path(home, f'server{i}')
+        path.mkdir()
+        with open(Path(path, 'mcm-plugins.json'), 'wt') as file:
+            file.write(json.dumps({'plugins': {project: '*'
+                for project in (MODS if fork == 'forge' else PLUGINS)}}))
+        saves.append({'name': f'server{i}', 'fork': fork, 'version': OLD_VERSIONS[fork],
+            'path': str(path)})
+    write_saves(home, saves)
+    return home, saves
+
+
+def check_sync(output, expected):
+    """
+    fail unless every server's line of plugins sync output reports expected
+    """
+    lines = output.strip().splitlines()
+    wrong = [line for line in lines if expected not in line]
+    if len(lines) != PLUGIN_SERVERS or wrong:
+        raise RuntimeError(f'plugins sync did not report "{expected}" everywhere: {output}')
+
+
+def plugins_case(change):
+    """
+    time syncing plugins and mods into fresh servers, syncing again with
+    nothing changed, or syncing after a project left every manifest
+    """
+    def case(bench):
+        home, saves = plugin_home(bench)
+        if change == 'cold':
+            return bench.measure(lambda: check_sync(bench.mcm(home, 'plugins', 'sync', '--all'),
+                '0 replaced, 0 removed, 0 unchanged'))
+        bench.mcm(home, 'plugins', 'sync', '--all')
+        if change == 'unchanged':
+            return bench.measure(lambda: check_sync(bench.mcm(home, 'plugins', 'sync', '--all'),
+                '0 added, 0 replaced, 0 removed'))
+        for save in saves:
+            manifest_path = Path(save['path'], 'mcm-plugins.json')
+            manifest = json.loads(manifest_path.read_text())
+            manifest['plugins'].pop(next(iter(manifest['plugins'])))
+            manifest_path.write_text(json.dumps(manifest))
+        return bench.measure(lambda: check_sync(bench.mcm(home, 'plugins', 'sync', '--all'),
+            '0 added, 0 replaced, 1 removed'))
+    return case
+
+
+def bench_case(bench):
+    """
+    time mcm bench comparing every profile on stub_java.py, which starts
+    fastest under zgc, and writing the winner to a save with no heap
+    """
+    home = bench.home()
+    path = Path(home, 'server')
+    path.mkdir()
+    Path(path, 'server.jar').write_bytes(b'stub')
+    write_saves(home, [{'name': 'server', 'fork': 'paper', 'version': OLD_VERSIONS['paper'],
+        'path': str(path), 'jar': 'server.jar'}])
+    output = []
+    result = bench.measure(lambda: output.append(bench.mcm(home, 'bench', 'server',
+        '--java', str(Path(__file__).resolve().parent / 'stub_java.py'), '--runs', '2',
+        '--write')))
+    save = json.loads(Path(home, '.config/mcm/saves.json').read_text())[0]
+    if 'fastest: zgc@' not in output[0] or 'None' in output[0] or \
+        not isinstance(save.get('heap'), int) or \
+        '-XX:+UseZGC' not in Path(path, 'start.sh').read_text():
+        raise RuntimeError(f'mcm bench did not write zgc with a heap: {output[0]}')
+    return result
+
+
+def download_case(workers):
+    """
+    time a large range-request download with a number of workers
+    """
+    def case(bench):
+        from mcm.download import download # pylint: disable=import-outside-toplevel
+        dest = Path(bench.home(), 'large.jar')
+        result = bench.measure(lambda: download(f'{bench.upstream.url}/{LARGE_JAR}', dest,
+            workers=workers, progress=lambda n: None))
+        dest.unlink()
+        return result
+    return case
+
+
+CASES = dict([(f'create-{fork}-{state}', create_case(fork, state == 'warm'))
+    for fork in OLD_VERSIONS for state in ('cold', 'warm')] + \
+    [(f'update-{fork}', update_case(fork)) for fork in OLD_VERSIONS] + [
+    ('update-all', update_all_case),
+    ('list-10k', list_case),
+    ('startup-list', startup_case),
+    ('forge-page-latest', forge_page_case(None)),
+    ('forge-page-old-build', forge_page_case('1.12.2-32.0.0')),
+] + [(f'forge-parse-{name}-{page}', parse_case(parser, page))
+    for page in GENERATED_PAGES
+    for name, parser in (('linkfinder', find_link), ('soup', soup_link))] + \
+    [(f'plugins-sync-{change}', plugins_case(change)) for change in ('cold', 'unchanged', 'remove')] + \
+    [('rcon-protocol', rcon_protocol_case), (f'exec-{EXEC_SERVERS}-servers', exec_case)] + \
+    [('bench-stub', bench_case)] + \
+    [(f'download-{workers}-workers', download_case(workers)) for workers in (1, 4, 8)])
+
+
+def run_cases(bench, names, repeat):
+    """
+    run each case repeat times, returning its median and fastest time and
+    the most requests any run made. cases that can't run here are skipped
+    """
+    results = {}
+    for name in names:
+        runs = [CASES[name](bench) for _ in range(repeat)]
+        if None in runs:
+            print(f'{name}: skipped, beautifulsoup4 is not installed', file=sys.stderr)
+            continue
+        times = [seconds for seconds, _ in runs]
+        results[name] = {'seconds': statistics.median(times), 'min': min(times),
+            'requests': max(requests for _, requests in runs)}
+        print(f'{name}: {results[name]["seconds"] * 1000:.1f} ms', file=sys.stderr)
+    return results
+
+
+def interpreter():
+    """
+    return the major.minor version of the running python, which baselines are
+    kept per
+    """
+    return '.'.join(str(part) for part in sys.version_info[:2])
+
+
+def compare(results, baseline, tolerance):
+    """
+    return a line for every case that got slower than tolerance allows or
+    made more requests than its baseline. timings aren't compared without
+    a tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        if result['requests'] > base['requests']:
+            regressions.append(f'{name}: {result["requests"]} requests, ' + \
+                f'baseline {base["requests"]}')
+        if tolerance is not None and result['seconds'] > base['seconds'] * (1 + tolerance) and \
+                result['seconds'] - base['seconds'] > SLACK:
+            regressions.append(f'{name}: {result["seconds"] * 1000:.1f} ms, ' + \
+                f'baseline {base["seconds"] * 1000:.1f} ms')
+    return regressions
+
+
+def print_results(results):
+    """
+    print results in aligned columns, with throughput for downloads
+    """
+    rows = [(name, f'{result["seconds"] * 1000:.1f} ms', f'{result["min"] * 1000:.1f} ms',
+        result['requests'], f'{LARGE_SIZE / (1024 * 1024) / result["seconds"]:.1f} MB/s'
+            if name.startswith('download') else '') for name, result in results.items()]
+    widths = [max(len(str(row[col])) for row in rows + [HEADER]) for col in range(len(HEADER))]
+    for row in [HEADER] + rows:
+        print('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def main():
+    """
+    run the selected cases, then save or compare against a baseline
+    """
+    parser = argparse.ArgumentParser(description='benchmark mcm against a local upstream')
+    parser.add_argument('--match', '-k', default='*',
+        help='only run cases whose name matches this glob')
+    parser.add_argument('--repeat', '-r', type=int, default=5,
+        help='how many times to run each case')
+    parser.add_argument('--save', metavar='FILE', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+        help='fail if a case is slower or makes more requests than in this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+        help='how much slower than its baseline a case may be, 0.5 for 50%% by default')
+    args = parser.parse_args()
+
+    names = [name for name in CASES if fnmatch(name, args.match)]
+    if not names:
+        print(f'no cases match {args.match}, choose from {", ".join(CASES)}')
+        sys.exit(1)
+    scratch = tempfile.mkdtemp(prefix='mcm-bench-')
+    try:
+        bench = Bench(scratch)
+        # the in-process cases import mcm, which reads these when imported
+        os.environ.update(bench.env(bench.home()))
+        sys.path.insert(0, str(ROOT))
+        results = run_cases(bench, names, args.repeat)
+    finally:
+        shutil.rmtree(scratch)
+    print_results(results)
+
+    if args.save:
+        baselines = {}
+        if Path(args.save).exists():
+            with open(args.save, 'r') as file:
+                baselines = json.loads(file.read())
+        # cases left out with -k keep their old baseline
+        cases = dict(baselines.get(interpreter(), {}).get('cases', {}), **results)
+        baselines[interpreter()] = {'python': sys.version.split()[0],
+            'cases': {name: cases[name] for name in CASES if name in cases}}
+        with open(args.save, 'wt') as file:
+            file.write(json.dumps(dict(sorted(baselines.items(), key=lambda item:
+                tuple(int(part) for part in item[0].split('.')))), indent=4) + '\n')
+        print(f'saved the results to {args.save} as the python {interpreter()} baseline')
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baselines = json.loads(file.read())
+        tolerance = args.tolerance
+        baseline = baselines.get(interpreter())
+        if baseline is None:
+            # request counts are the same on every interpreter, timings are not
+            print(f'{args.compare} has no python {interpreter()} baseline, ' + \
+                'comparing request counts only')
+            baseline, tolerance = next(iter(baselines.values())), None
+        regressions = compare(results, baseline, tolerance)
+        if regressions:
+            print('regressions against ' + args.compare + ':\n' + '\n'.join(regressions))
+            sys.exit(1)
+        print(f'no regressions against {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+stands in for java and a server jar so mcm bench can run without either.
+it answers -version like a java 17 runtime. given a jar, it prints a Done
+line whose startup time depends on the collector the flags pick, then a
+lag warning, writes a gc log if asked, and exits on stop
+"""
+import sys
+
+
+# startup seconds by collector, so the fastest profile is known ahead
+STARTUP = {'-XX:+UseZGC': 1.2, '-XX:+UseShenandoahGC': 1.6, '-XX:+UseG1GC': 2.0}
+
+
+def main():
+    """
+    pretend to be java running a server
+    """
+    args = sys.argv[1:]
+    if '-version' in args:
+        print('openjdk version "17.0.1" 2021-10-19', file=sys.stderr)
+        return
+    if '-jar' not in args or args.index('-jar') + 1 >= len(args):
+        print('Error: -jar requires jar file specification', file=sys.stderr)
+        sys.exit(1)
+    startup = next((seconds for flag, seconds in STARTUP.items() if flag in args), 2.5)
+    for arg in args:
+        if arg.startswith('-Xlog:gc:file='):
+            with open(arg.partition('=')[2], 'wt') as log:
+                log.write('[0.100s][info][gc] GC(0) Pause Young (Normal) 24M->8M(1024M) 3.250ms\n')
+                log.write('[0.900s][info][gc] GC(1) Pause Young (Normal) 40M->12M(1024M) 4.750ms\n')
+    print('[00:00:01] [Server thread/INFO]: Starting minecraft server version 1.16.5', flush=True)
+    print(f'[00:00:02] [Server thread/INFO]: Done ({startup:.3f}s)! For help, type "help"',
+        flush=True)
+    print('[00:00:03] [Server thread/WARN]: Can\'t keep up! Is the server overloaded? ' + \
+        'Running 2500ms or 50 ticks behind', flush=True)
+    for line in sys.stdin:
+        if line.strip() == 'stop':
+            print('[00:00:04] [Server thread/INFO]: Stopping server', flush=True)
+            return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""
+local stand-in for the upstream apis mcm talks to. every host is served under
+/<host>/ so MCM_UPSTREAM can point at it, with documents shaped like
+mojang's, paper's, forge's and modrinth's and jars of random bytes. it
+answers HEAD, range and conditional requests the way the real hosts do, and
+counts requests
+"""
+import json
+import random
+import hashlib
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+MOJANG = 'launchermeta.mojang.com'
+PAPER = 'papermc.io/api/v2/projects/paper'
+FORGE_FILES = 'files.minecraftforge.net'
+FORGE_MAVEN = 'maven.minecraftforge.net/net/minecraftforge/forge'
+MODRINTH = 'api.modrinth.com/v2'
+MODRINTH_CDN = 'cdn.modrinth.com/data'
+JAR_SIZE = 1024 * 1024
+PLUGIN_SIZE = 64 * 1024
+LARGE_SIZE = 64 * 1024 * 1024
+LARGE_JAR = 'bench/large.jar'
+# the releases of each minor version, roughly what mojang has published
+RELEASES = {0: 0, 1: 0, 2: 5, 3: 2, 4: 7, 5: 2, 6: 4, 7: 10, 8: 9, 9: 4, 10: 2, 11: 2,
+    12: 2, 13: 2, 14: 4, 15: 2, 16: 5, 17: 1}
+# the minor versions with paper and forge builds, and how many builds each has
+PAPER_BUILDS = {8: 443, 9: 773, 10: 918, 11: 1698, 12: 1620, 13: 1, 14: 1, 15: 1, 16: 794,
+    17: 102}
+# the projects in the stand-in plugin repository, and how many versions each has
+PLUGINS = {'luckperms': 12, 'worldedit': 8, 'essentialsx': 10, 'dynmap': 6, 'vault': 3}
+MODS = {'jei': 15, 'journeymap': 9, 'ftb-chunks': 4}
+PROJECTS = dict(PLUGINS, **MODS)
+FORGE_BUILDS = {7: 600, 8: 400, 9: 250, 10: 200, 11: 500, 12: 800, 13: 50, 14: 300, 15: 150,
+    16: 500, 17: 90}
+
+
+def release_ids():
+    """
+    return every generated minecraft release, oldest first
+    """
+    return [f'1.{minor}' if patch == 0 else f'1.{minor}.{patch}'
+        for minor, patches in sorted(RELEASES.items()) for patch in range(patches + 1)]
+
+
+def file_link(build, kind):
+    """
+    return the maven url of one of a forge build's files
+    """
+    return f'https://{FORGE_MAVEN}/{build}/forge-{build}-{kind}.jar'
+
+
+def ad_link(build, kind):
+    """
+    return a file link behind the ad redirect the download blocks use
+    """
+    return f'https://adfoc.us/serve/sitelinks/?id=271228&amp;url={file_link(build, kind)}'
+
+
+def random_bytes(key, size):
+    """
+    return size bytes that are the same for the same key
+    """
+    return random.Random(key).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+class Fixtures:
+    """
+    builds the documents and jars of every upstream path on first request
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jars = {}
+        self.documents = {}
+        self.releases = release_ids()
+        self.forge = []
+        for minor, count in sorted(FORGE_BUILDS.items()):
+            mc_version = [release for release in self.releases
+                if release.split('.')[1] == str(minor)][-1]
+            # old builds carry the minecraft version again as a suffix, as in maven
+            suffix = f'-{mc_version}' if minor < 10 else ''
+            self.forge += [f'{mc_version}-{minor + 20}.{number // 100}.{number % 100}{suffix}'
+                for number in range(count)]
+
+    def jar(self, path, size=JAR_SIZE):
+        """
+        return the bytes of a jar
+        """
+        with self.lock:
+            if path not in self.jars:
+                self.jars[path] = random_bytes(path, size)
+            return self.jars[path]
+
+    def mojang_manifest(self):
+        """
+        the version manifest, with a snapshot between every two releases
+        """
+        versions = []
+        for i, release in enumerate(self.releases):
+            month = f'{2010 + i // 12}-{i % 12 + 1:02}'
+            snapshot = f'{10 + i // 12}w{i % 12 + 1:02}a'
+            for version, kind, day in ((release, 'release', '01'), (snapshot, 'snapshot', '15')):
+                stamp = f'{month}-{day}T00:00:00+00:00'
+                versions.append({'id': version, 'type': kind, 'time': stamp, 'releaseTime': stamp,
+                    'url': f'https://{MOJANG}/v1/packages/{version}.json'})
+        versions.reverse()
+        return {'latest': {'release': self.releases[-1], 'snapshot': versions[0]['id']},
+            'versions': versions}
+
+    def mojang_version(self, version):
+        """
+        the document of one version, pointing at its server jar
+        """
+        path = f'launcher.mojang.com/v1/objects/{version}/server.jar'
+        return {'id': version, 'downloads': {'server': {'url': f'https://{path}',
+            'sha1': hashlib.sha1(self.jar(path)).hexdigest(), 'size': JAR_SIZE}}}
+
+    def paper_versions(self):
+        """
+        every minecraft version with paper builds
+        """
+        return [release for release in self.releases
+            if int(release.split('.')[1]) in PAPER_BUILDS]
+
+    def paper_build(self, version, build):
+        """
+        the document of one paper build, naming its jar
+        """
+        name = f'paper-{version}-{build}.jar'
+        jar = self.jar(f'{PAPER}/versions/{version}/builds/{build}/downloads/{name}')
+        return {'version': version, 'build': int(build), 'downloads': {'application':
+            {'name': name, 'sha256': hashlib.sha256(jar).hexdigest()}}}
+
+    def forge_page(self, mc_version=None):
+        """
+        a files index page: the latest and recommended download blocks, then a
+        row linking the files of every build of a minecraft version, the
+        newest one by default
+        """
+        if mc_version is None:
+            mc_version = self.forge[-1].partition('-')[0]
+        builds = [build for build in self.forge if build.partition('-')[0] == mc_version]
+        blocks = ''.join(f'<div class="download"><div class="title">Download {title}</div>'
+            '<div class="links"><ul>' + ''.join(f'<li><a href="{ad_link(build, kind)}">{kind}</a>'
+                '</li>' for kind in ('installer', 'mdk', 'universal')) + '</ul></div></div>'
+            for title, build in (('Latest', builds[-1]), ('Recommended', builds[len(builds) // 2])))
+        rows = ''.join(f'<tr><td class="download-version">{build.partition("-")[2]}</td>'
+            '<td class="download-time">2021-01-01</td><td class="download-files"><ul>' + \
+            ''.join(f'<li><a href="{file_link(build, kind)}" title="{kind}"><i class="fa"></i>'
+                f'{kind}</a></li>' for kind in ('changelog', 'installer', 'mdk', 'universal')) + \
+            '</ul></td></tr>' for build in reversed(builds))
+        return ('<!DOCTYPE html><html><head><title>Downloads for Minecraft Forge</title></head>'
+            f'<body><div class="promos-content">{blocks}</div><table class="download-list">'
+            f'<tbody>{rows}</tbody></table></body></html>').encode('utf-8')
+
+    def maven_metadata(self):
+        """
+        the maven version list of forge
+        """
+        versions = ''.join(f'<version>{build}</version>' for build in self.forge)
+        return ('<?xml version="1.0" encoding="UTF-8"?><metadata><groupId>net.minecraftforge'
+            f'</groupId><artifactId>forge</artifactId><versioning><versions>{versions}'
+            '</versions></versioning></metadata>').encode('utf-8')
+
+    def promotions(self):
+        """
+        forge's latest and recommended build per minecraft version
+        """
+        promos = {}
+        for build in self.forge:
+            mc_version, _, number = build.partition('-')
+            number = number.partition('-')[0]
+            promos[f'{mc_version}-latest'] = number
+            if number.endswith('.0'):
+                promos[f'{mc_version}-recommended'] = number
+        return {'homepage': f'https://{FORGE_FILES}/', 'promos': promos}
+
+    def project_versions(self, project):
+        """
+        a project's versions as modrinth lists them, newest first, each built
+        for the 1.16 and 1.17 releases
+        """
+        loaders = ['forge'] if project in MODS else ['paper', 'spigot', 'bukkit']
+        game_versions = [release for release in self.releases
+            if release.split('.')[1] in ('16', '17')]
+        versions = []
+        for number in range(1, PROJECTS[project] + 1):
+            name = f'{project}-{number}.0.0.jar'
+            path = f'{MODRINTH_CDN}/{project}/versions/{number}.0.0/{name}'
+            versions.append({'version_number': f'{number}.0.0', 'game_versions': game_versions,
+                'loaders': loaders, 'date_published': f'2021-01-01T00:{number:02}:00Z',
+                'files': [{'filename': name, 'url': f'https://{path}', 'primary': True,
+                    'hashes': {'sha1': hashlib.sha1(self.jar(path, PLUGIN_SIZE)).hexdigest()}}]})
+        return list(reversed(versions))
+
+    def document(self, path):
+        """
+        return the body and etag of a path, or None if upstream has nothing
+        there
+        """
+        with self.lock:
+            if path in self.documents:
+                return self.documents[path]
+        body = self.build(path)
+        if isinstance(body, dict):
+            body = json.dumps(body).encode('utf-8')
+        document = None if body is None else (body, f'"{hashlib.sha1(body).hexdigest()}"')
+        with self.lock:
+            self.documents[path] = document
+        return document
+
+    def build(self, path): # pylint: disable=too-many-return-statements,too-many-branches
+        """
+        generate the body of a path
+        """
+        parts = path.split('/')
+        if path == f'{MOJANG}/mc/game/version_manifest.json':
+            return self.mojang_manifest()
+        if path.startswith(f'{MOJANG}/v1/packages/'):
+            return self.mojang_version(parts[-1][:-len('.json')])
+        if path.startswith('launcher.mojang.com/') or path.endswith('.jar') and \
+                path.startswith((PAPER, FORGE_MAVEN)):
+            return self.jar(path)
+        if path.startswith(MODRINTH_CDN):
+            return self.jar(path, PLUGIN_SIZE)
+        if path.startswith(f'{MODRINTH}/project/') and len(parts) == 5 and parts[4] == 'version':
+            # every version is listed, mcm filters by loader and minecraft version itself
+            return json.dumps(self.project_versions(parts[3])).encode('utf-8') \
+                if parts[3] in PROJECTS else None
+        if path == LARGE_JAR:
+            return self.jar(path, LARGE_SIZE)
+        if path == PAPER:
+            return {'project_id': 'paper', 'versions': self.paper_versions()}
+        if path.startswith(f'{PAPER}/versions/') and len(parts) == 7:
+            version = parts[-1]
+            return {'version': version,
+                'builds': list(range(1, PAPER_BUILDS[int(version.split('.')[1])] + 1))}
+        if path.startswith(f'{PAPER}/versions/') and len(parts) == 9:
+            return self.paper_build(parts[6], parts[8])
+        if path == f'{FORGE_MAVEN}/maven-metadata.xml':
+            return self.maven_metadata()
+        if path == f'{FORGE_FILES}/net/minecraftforge/forge/promotions_slim.json':
+            return self.promotions()
+        if path in (FORGE_FILES, f'{FORGE_FILES}/'):
+            return self.forge_page()
+        if path.startswith(f'{FORGE_FILES}/maven/net/minecraftforge/forge/index_'):
+            return self.forge_page(path.rpartition('index_')[2][:-len('.html')])
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    serves the fixtures of the server it belongs to
+    """
+    def do_HEAD(self): # pylint: disable=invalid-name
+        """
+        answer with the headers a GET would get
+        """
+        self.respond(False)
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """
+        answer with a document or jar, or a range of one
+        """
+        self.respond(True)
+
+    def respond(self, send_body):
+        """
+        send a path's body, honouring Range and If-None-Match
+        """
+        self.server.count()
+        try:
+            document = self.server.fixtures.document(self.path.lstrip('/').partition('?')[0])
+        except (KeyError, ValueError, IndexError):
+            document = None
+        if document is None:
+            self.send_error(404)
+            return
+        body, etag = document
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start, end = 0, len(body) - 1
+        if self.headers.get('Range', '').startswith('bytes='):
+            first, _, last = self.headers['Range'][len('bytes='):].partition('-')
+            start, end = int(first), min(int(last or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body[start:end + 1])
+
+    def log_message(self, *_): # pylint: disable=arguments-differ
+        pass
+
+
+class Upstream(ThreadingMixIn, HTTPServer):
+    """
+    threaded stand-in server on a free local port
+    """
+    daemon_threads = True
+    # parallel downloads open more connections at once than the default backlog of 5
+    request_queue_size = 64
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.fixtures = Fixtures()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        """
+        the base url to give MCM_UPSTREAM
+        """
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self):
+        """
+        count a request
+        """
+        with self.lock:
+            self.requests += 1
+
+    def start(self):
+        """
+        serve from a background thread
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
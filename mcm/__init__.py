@@ -1,17 +1,16 @@
 """
-option parsing file for the minecraft manager
+option parsing file for the minecraft manager.
+subcommands import what they need when they run, so that cheap commands
+like list don't pay for the http and html stacks at startup
 """
 import argparse
 
-from .create import create_vanilla, create_paper, create_forge
-from .update import update_server
-from .saves import get_saves
-
 
 def handle_create(args):
     """
     dispatch creation of a server to the proper module
     """
+    from .create import create_vanilla, create_paper, create_forge # pylint: disable=import-outside-toplevel
     if args.module == 'vanilla' or args.module == 'minecraft':
         create_vanilla(args)
     elif args.module == 'paper':
@@ -23,23 +22,166 @@ def handle_update(args):
     """
     dispatch update args
     """
+    from .update import update_server # pylint: disable=import-outside-toplevel
     update_server(args)
 
 
-def handle_list(args): # pylint: disable=unused-argument
+def handle_list(args):
     """
     list available servers from save file
     """
+    from .saves import get_saves # pylint: disable=import-outside-toplevel
     saves = get_saves()
+    if not args.status:
+        for save in saves:
+            print(f'server name {save["name"]}, {save["fork"]} fork, version {save["version"]}')
+        return
+    from .ping import get_statuses, format_status # pylint: disable=import-outside-toplevel
+    statuses = get_statuses(saves, args.timeout, args.cache)
     for save in saves:
-        print(f'server name {save["name"]}, {save["fork"]} fork, version {save["version"]}')
+        print(f'server name {save["name"]}, {save["fork"]} fork, version {save["version"]}, ' + \
+            format_status(statuses[save['name']]))
+
+
+def handle_cache(args):
+    """
+    dispatch jar cache actions
+    """
+    from .cache import handle_cache as cache_action # pylint: disable=import-outside-toplevel
+    cache_action(args)
+
+
+def handle_plan(args):
+    """
+    dispatch host resource planning
+    """
+    if args.plan_action == 'memory':
+        from .memory import plan_memory # pylint: disable=import-outside-toplevel
+        plan_memory(args)
+    elif args.plan_action == 'cpu':
+        from .placement import plan_placement # pylint: disable=import-outside-toplevel
+        plan_placement(args)
+    else:
+        print('no plan given, use "mcm plan memory" or "mcm plan cpu"')
+
+
+def handle_bench(args):
+    """
+    dispatch jvm flag benchmarks
+    """
+    from .bench import bench_server # pylint: disable=import-outside-toplevel
+    bench_server(args)
+
+
+def handle_exec(args):
+    """
+    dispatch rcon commands
+    """
+    from .rcon import handle_exec as exec_command # pylint: disable=import-outside-toplevel
+    exec_command(args)
 
 
-def main():
+def handle_rcon(args):
+    """
+    dispatch rcon setup
+    """
+    from .rcon import handle_rcon as setup # pylint: disable=import-outside-toplevel
+    setup(args)
+
+
+def handle_exporter(args):
+    """
+    dispatch the metrics exporter
+    """
+    from .exporter import run_exporter # pylint: disable=import-outside-toplevel
+    run_exporter(args)
+
+
+def handle_logs(args):
+    """
+    dispatch log searches
+    """
+    from .logs import handle_logs as search # pylint: disable=import-outside-toplevel
+    search(args)
+
+
+def handle_backup(args):
+    """
+    dispatch world backups
+    """
+    from .backup import handle_backup as backup # pylint: disable=import-outside-toplevel
+    backup(args)
+
+
+def handle_restore(args):
+    """
+    dispatch world restores
+    """
+    from .backup import handle_restore as restore # pylint: disable=import-outside-toplevel
+    restore(args)
+
+
+def handle_world(args):
+    """
+    dispatch world analysis and pruning
+    """
+    from .world import handle_world as world_action # pylint: disable=import-outside-toplevel
+    world_action(args)
+
+
+def handle_pregen(args):
+    """
+    dispatch world pre-generation
+    """
+    from .pregen import pregen_server # pylint: disable=import-outside-toplevel
+    pregen_server(args)
+
+
+def handle_plugins(args):
+    """
+    dispatch plugin and mod management
+    """
+    from .plugins import handle_plugins as plugins_action # pylint: disable=import-outside-toplevel
+    plugins_action(args)
+
+
+def handle_versions(args):
+    """
+    dispatch version index queries
+    """
+    from .versions import handle_versions as versions_action # pylint: disable=import-outside-toplevel
+    versions_action(args)
+
+
+def handle_watchdog(args):
+    """
+    dispatch the server watchdog
+    """
+    from .watchdog import handle_watchdog as watchdog_action # pylint: disable=import-outside-toplevel
+    watchdog_action(args)
+
+
+def add_target_arguments(parser):
+    """
+    add the arguments used to pick one or more saved servers
+    """
+    parser.add_argument('--name', '-n', action='append',
+        help='a server to act on, can be given more than once')
+    parser.add_argument('--all', '-a', action='store_true', help='act on every saved server')
+    parser.add_argument('--match', help='with --all, only servers whose name matches this glob')
+
+
+def main(): # pylint: disable=too-many-locals,too-many-statements
     """
     main method for parsing arguments
     """
     parser = argparse.ArgumentParser(prog='mcm')
+    parser.add_argument('--offline', action='store_true',
+        help='resolve versions and jars only from the local cache')
+    parser.add_argument('--profile', action='store_true',
+        help='time each phase and write a chrome trace of it')
+    parser.add_argument('--profile-file', default='mcm-profile.json', metavar='FILE',
+        help='where --profile writes its trace, mcm-profile.json by default')
 
     subparsers = parser.add_subparsers(title='available actions',
         metavar='action')
@@ -55,27 +197,356 @@ def main():
     create_parser.add_argument('--path', '-p', help='path to save the jar to')
     create_parser.add_argument('--name', '-n',
         help='the name of the server, mostly used for the systemd file')
+    create_parser.add_argument('--cds', action='store_true',
+        help='record a class data archive on the first run and load it on later starts')
+    create_parser.add_argument('--rcon', action='store_true',
+        help='enable rcon with its own port and password, for mcm exec, backups and restarts')
     create_parser.set_defaults(handle=handle_create)
 
     update_parser = subparsers.add_parser(
         'update',
         help='update a server given its name'
     )
-    update_parser.add_argument('name', help='the name of the server to update')
+    update_parser.add_argument('name', nargs='?', help='the name of the server to update')
     update_parser.add_argument('--version', '-v', help='the version of the selected server to use')
+    update_parser.add_argument('--all', '-a', action='store_true',
+        help='update every saved server matching the filters below')
+    update_parser.add_argument('--fork', choices=['vanilla', 'paper', 'forge'],
+        help='with --all, only update servers of this fork')
+    update_parser.add_argument('--from-version',
+        help='with --all, only update servers whose version matches this glob')
+    update_parser.add_argument('--match',
+        help='with --all, only update servers whose name matches this glob')
+    update_parser.add_argument('--workers', '-w', type=int, default=4,
+        help='how many servers to update at once')
+    update_parser.add_argument('--cds', action='store_true', default=None,
+        help='keep a class data archive of the jar to load on start, rebuilt after updates')
+    update_parser.add_argument('--no-cds', dest='cds', action='store_false',
+        help='stop using a class data archive')
+    update_parser.add_argument('--stage', action='store_true',
+        help='download and patch the new version while the server keeps running')
+    update_parser.add_argument('--restart-when-empty', action='store_true',
+        help='stage, then restart onto the new version once nobody is online')
+    update_parser.add_argument('--restart-at', metavar='HH:MM',
+        help='stage, then restart at this time after warning players over rcon')
+    update_parser.add_argument('--done-timeout', type=float, default=600,
+        help='seconds the new version has to reach Done before it is rolled back')
     update_parser.set_defaults(handle=handle_update)
 
     update_parser = subparsers.add_parser(
         'list',
         help='list all available servers'
     )
+    update_parser.add_argument('--status', '-s', action='store_true',
+        help='ping every server for its online state, players and latency')
+    update_parser.add_argument('--timeout', '-t', type=float, default=2,
+        help='seconds to wait for each server to answer a ping')
+    update_parser.add_argument('--cache', type=float, default=0, metavar='SECONDS',
+        help='reuse ping results younger than this, for watch loops')
     update_parser.set_defaults(handle=handle_list)
 
+    cache_parser = subparsers.add_parser(
+        'cache',
+        help='inspect or clean the shared jar cache'
+    )
+    cache_subparsers = cache_parser.add_subparsers(title='cache actions',
+        metavar='cache_action', dest='cache_action')
+    cache_subparsers.add_parser('ls', help='list cached jars and the servers using them')
+    gc_parser = cache_subparsers.add_parser('gc',
+        help='remove cached jars no saved server uses')
+    gc_parser.add_argument('--dry-run', action='store_true',
+        help='only print what would be removed')
+    cache_parser.set_defaults(handle=handle_cache)
+
+    plan_parser = subparsers.add_parser(
+        'plan',
+        help='share host resources between all saved servers'
+    )
+    plan_subparsers = plan_parser.add_subparsers(title='plans',
+        metavar='plan_action', dest='plan_action')
+    memory_parser = plan_subparsers.add_parser('memory',
+        help='size every server\'s heap to fit host ram')
+    memory_parser.add_argument('--weight', action='append', metavar='NAME=WEIGHT',
+        help='give a server a larger or smaller share of ram, 1 by default')
+    memory_parser.add_argument('--max-heap', action='append', metavar='NAME=GIB',
+        help='cap a server\'s heap, 6G by default')
+    memory_parser.add_argument('--apply', action='store_true',
+        help='write the planned heaps to the start scripts')
+    cpu_parser = plan_subparsers.add_parser('cpu',
+        help='pin every server to its own cpus and set cgroup limits in its unit')
+    cpu_parser.add_argument('--reserve', type=int, default=0,
+        help='number of cpus to leave to the os')
+    cpu_parser.add_argument('--apply', action='store_true',
+        help='write the placement to the start scripts and systemd units')
+    plan_parser.set_defaults(handle=handle_plan)
+
+    bench_parser = subparsers.add_parser(
+        'bench',
+        help='compare server startup under different jvm flag profiles'
+    )
+    bench_parser.add_argument('name', help='the name of the server to benchmark')
+    bench_parser.add_argument('--profiles',
+        help='comma separated profiles to try: aikar, zgc, shenandoah. all by default')
+    bench_parser.add_argument('--heaps',
+        help='comma separated heap sizes to try, such as 4G,6G. the current heap by default')
+    bench_parser.add_argument('--runs', '-r', type=int, default=3,
+        help='how many times to start the server under each profile')
+    bench_parser.add_argument('--settle', type=int, default=0,
+        help='seconds to keep each run going after Done to catch lag warnings')
+    bench_parser.add_argument('--timeout', type=int, default=600,
+        help='seconds to wait for a run to reach Done')
+    bench_parser.add_argument('--java', default='java', help='the java binary to run')
+    bench_parser.add_argument('--jar', help='run this jar instead of the server\'s own')
+    bench_parser.add_argument('--write', action='store_true',
+        help='write the fastest profile and heap to the server\'s start script')
+    bench_parser.set_defaults(handle=handle_bench)
+
+    exec_parser = subparsers.add_parser(
+        'exec',
+        help='run a console command on servers over rcon'
+    )
+    exec_parser.add_argument('command', help='the console command to run')
+    add_target_arguments(exec_parser)
+    exec_parser.add_argument('--timeout', '-t', type=float, default=5,
+        help='seconds to wait for each server to answer')
+    exec_parser.set_defaults(handle=handle_exec)
+
+    rcon_parser = subparsers.add_parser(
+        'rcon',
+        help='enable rcon with per-server credentials on existing servers'
+    )
+    add_target_arguments(rcon_parser)
+    rcon_parser.set_defaults(handle=handle_rcon)
+
+    exporter_parser = subparsers.add_parser(
+        'exporter',
+        help='serve metrics for every saved server in the prometheus format'
+    )
+    exporter_parser.add_argument('--bind', default='127.0.0.1', help='the address to listen on')
+    exporter_parser.add_argument('--port', '-p', type=int, default=9225,
+        help='the port to serve /metrics on')
+    exporter_parser.add_argument('--interval', '-i', type=float, default=15,
+        help='seconds between collections')
+    exporter_parser.add_argument('--world-interval', type=float, default=300,
+        help='seconds between world size scans, which walk every region file')
+    exporter_parser.set_defaults(handle=handle_exporter)
+
+    logs_parser = subparsers.add_parser(
+        'logs',
+        help='search the current and rotated logs of servers'
+    )
+    logs_parser.add_argument('name', nargs='?', help='the name of the server to search')
+    logs_parser.add_argument('--all', '-a', action='store_true', help='search every saved server')
+    logs_parser.add_argument('--match',
+        help='with --all, only servers whose name matches this glob')
+    logs_parser.add_argument('--grep', '-g', metavar='PATTERN',
+        help='only print lines matching this regular expression')
+    logs_parser.add_argument('--ignore-case', '-i', action='store_true',
+        help='match the pattern without regard to case')
+    logs_parser.add_argument('--since',
+        help='only lines from this time on, such as 2h, 3d, 14:30 or 2021-05-01 14:30')
+    logs_parser.add_argument('--until', help='only lines up to this time, in the same formats')
+    logs_parser.add_argument('--follow', '-f', action='store_true',
+        help='keep printing matching lines as they are logged')
+    logs_parser.add_argument('--workers', '-w', type=int, default=None,
+        help='how many logs to decompress at once, one per cpu by default')
+    logs_parser.set_defaults(handle=handle_logs)
+
+    backup_parser = subparsers.add_parser(
+        'backup',
+        help='take a deduplicated snapshot of servers\' worlds'
+    )
+    backup_parser.add_argument('name', nargs='?', help='the name of the server to back up')
+    backup_parser.add_argument('--all', '-a', action='store_true',
+        help='back up every saved server')
+    backup_parser.add_argument('--match',
+        help='with --all, only servers whose name matches this glob')
+    backup_parser.add_argument('--repo',
+        help='the backup repository, ~/.local/share/mcm/backups by default')
+    backup_parser.add_argument('--workers', '-w', type=int, default=None,
+        help='how many files to read and compress at once, one per cpu by default')
+    backup_parser.add_argument('--keep-last', type=int, default=0,
+        help='after backing up, keep this many of the newest snapshots')
+    backup_parser.add_argument('--keep-daily', type=int, default=0,
+        help='after backing up, keep the newest snapshot of this many days')
+    backup_parser.add_argument('--keep-weekly', type=int, default=0,
+        help='after backing up, keep the newest snapshot of this many weeks')
+    backup_parser.add_argument('--snapshot', '-s', action='store_true',
+        help='pause saving over rcon on running servers just long enough to stage a copy')
+    backup_parser.add_argument('--gc', action='store_true',
+        help='remove objects no snapshot uses, done anyway when snapshots are removed')
+    backup_parser.add_argument('--list', '-l', action='store_true',
+        help='list snapshots instead of taking one')
+    backup_parser.set_defaults(handle=handle_backup)
+
+    restore_parser = subparsers.add_parser(
+        'restore',
+        help='rebuild a server\'s worlds from a snapshot'
+    )
+    restore_parser.add_argument('name', help='the name of the server to restore')
+    restore_parser.add_argument('snapshot', nargs='?',
+        help='the snapshot to restore, the newest by default')
+    restore_parser.add_argument('--to', help='restore into this directory instead of the server')
+    restore_parser.add_argument('--force', action='store_true',
+        help='replace worlds that already exist')
+    restore_parser.add_argument('--repo',
+        help='the backup repository, ~/.local/share/mcm/backups by default')
+    restore_parser.add_argument('--workers', '-w', type=int, default=None,
+        help='how many files to write at once, one per cpu by default')
+    restore_parser.set_defaults(handle=handle_restore)
+
+    world_parser = subparsers.add_parser(
+        'world',
+        help='see where a world\'s disk space goes and prune unvisited chunks'
+    )
+    world_subparsers = world_parser.add_subparsers(title='world actions',
+        metavar='world_action', dest='world_action')
+    analyze_parser = world_subparsers.add_parser('analyze',
+        help='report size by dimension and region and time spent in chunks')
+    analyze_parser.add_argument('name', help='the name of the server to analyze')
+    analyze_parser.add_argument('--top', type=int, default=10,
+        help='how many of the largest regions to list')
+    analyze_parser.add_argument('--workers', '-w', type=int, default=None,
+        help='how many regions to read at once, one per cpu by default')
+    prune_parser = world_subparsers.add_parser('prune',
+        help='drop chunks players barely visited and compact the region files')
+    prune_parser.add_argument('name', help='the name of the server to prune')
+    prune_parser.add_argument('--inhabited-below', metavar='DURATION',
+        help='only prune chunks players spent less than this in, such as 5m or 6000t')
+    prune_parser.add_argument('--outside-radius', type=int, metavar='BLOCKS',
+        help='only prune chunks further than this from spawn')
+    prune_parser.add_argument('--dry-run', action='store_true',
+        help='only print what would be pruned')
+    prune_parser.add_argument('--workers', '-w', type=int, default=None,
+        help='how many regions to rewrite at once, one per cpu by default')
+    world_parser.set_defaults(handle=handle_world)
+
+    pregen_parser = subparsers.add_parser(
+        'pregen',
+        help='generate the chunks around spawn of a running server ahead of players'
+    )
+    pregen_parser.add_argument('name', help='the name of the server to pre-generate')
+    pregen_parser.add_argument('--radius', '-r', type=int,
+        help='radius in blocks to generate, not needed when resuming')
+    pregen_parser.add_argument('--dimension', default='minecraft:overworld',
+        help='the dimension to generate, around 0, 0 outside the overworld')
+    pregen_parser.add_argument('--batch', type=int, default=16,
+        help='chunks to load at once to begin with, adjusted to the tick time')
+    pregen_parser.add_argument('--target-mspt', type=float, default=40,
+        help='tick time in ms to keep the server under')
+    pregen_parser.add_argument('--window', metavar='HH:MM-HH:MM',
+        help='only generate between these times of day, waiting outside them')
+    pregen_parser.add_argument('--restart', action='store_true',
+        help='discard saved progress and start over')
+    pregen_parser.set_defaults(handle=handle_pregen)
+
+    versions_parser = subparsers.add_parser(
+        'versions',
+        help='list the versions each fork publishes from a local index'
+    )
+    versions_parser.add_argument('fork', nargs='?', choices=['vanilla', 'paper', 'forge'],
+        help='the fork to list versions of, the newest of each fork if omitted')
+    versions_parser.add_argument('version', nargs='?',
+        help='only list versions under this one or a line such as 1.16.x')
+    versions_parser.add_argument('--newer-than', metavar='VERSION',
+        help='only list versions released after this one')
+    versions_parser.add_argument('--snapshots', action='store_true',
+        help='include vanilla snapshots and pre-releases')
+    versions_parser.add_argument('--outdated', action='store_true',
+        help='compare saved servers against the index without going online')
+    versions_parser.add_argument('--refresh', action='store_true',
+        help='refresh the index now instead of once it is stale')
+    versions_parser.set_defaults(handle=handle_versions)
+
+    plugins_parser = subparsers.add_parser(
+        'plugins',
+        help='keep the plugins or mods of servers in line with their manifests'
+    )
+    plugins_subparsers = plugins_parser.add_subparsers(title='plugin actions',
+        metavar='plugins_action', dest='plugins_action')
+    sync_parser = plugins_subparsers.add_parser('sync',
+        help='install the plugins or mods in a server\'s manifest and lock their versions')
+    sync_parser.add_argument('name', nargs='?', help='the name of the server to sync')
+    sync_parser.add_argument('--all', '-a', action='store_true',
+        help='sync every saved server with a manifest')
+    sync_parser.add_argument('--match',
+        help='with --all, only servers whose name matches this glob')
+    sync_parser.add_argument('--update', '-u', action='store_true',
+        help='resolve the newest matching versions instead of the locked ones')
+    sync_parser.add_argument('--workers', '-w', type=int, default=8,
+        help='how many lookups and downloads to run at once')
+    add_parser = plugins_subparsers.add_parser('add',
+        help='add a plugin or mod to a server\'s manifest')
+    add_parser.add_argument('name', help='the name of the server')
+    add_parser.add_argument('project', help='the project\'s slug or id in the repository')
+    add_parser.add_argument('--version', '-v', default='*',
+        help='a glob the version number must match, any by default')
+    remove_parser = plugins_subparsers.add_parser('remove',
+        help='remove a plugin or mod from a server\'s manifest')
+    remove_parser.add_argument('name', help='the name of the server')
+    remove_parser.add_argument('project', help='the project\'s slug or id in the repository')
+    plugins_parser.set_defaults(handle=handle_plugins)
+
+    watchdog_parser = subparsers.add_parser(
+        'watchdog',
+        help='supervise servers, acting on lag, stalls, crashes and memory trouble'
+    )
+    watchdog_subparsers = watchdog_parser.add_subparsers(title='watchdog actions',
+        metavar='watchdog_action', dest='watchdog_action')
+    run_parser = watchdog_subparsers.add_parser('run',
+        help='watch every saved server until interrupted')
+    run_parser.add_argument('--interval', '-i', type=float, default=10,
+        help='seconds between checks of each server')
+    run_parser.add_argument('--ping-interval', type=float, default=30,
+        help='seconds between pings of each server')
+    run_parser.add_argument('--ping-timeout', type=float, default=5,
+        help='seconds to wait for a server to answer a ping')
+    run_parser.add_argument('--ping-failures', type=int, default=3,
+        help='failed pings in a row before a server counts as unresponsive')
+    run_parser.add_argument('--lag-warnings', type=int, default=5,
+        help='"Can\'t keep up!" warnings within the lag window that count as lag')
+    run_parser.add_argument('--lag-window', type=float, default=300,
+        help='seconds lag warnings are counted over')
+    run_parser.add_argument('--gc-share', type=float, default=0.5,
+        help='share of a jvm\'s cpu time spent in gc that counts as gc thrashing')
+    run_parser.add_argument('--rss-margin', type=float, default=1.25,
+        help='how far past its expected footprint a jvm may grow before it counts')
+    run_parser.add_argument('--crash-limit', type=int, default=3,
+        help='crashes and restarts within the crash window before quarantining a server')
+    run_parser.add_argument('--crash-window', type=float, default=900,
+        help='seconds crashes are counted over')
+    run_parser.add_argument('--done-timeout', type=float, default=600,
+        help='seconds a restarted server has to log Done')
+    run_parser.add_argument('--alert-command',
+        help='a shell command to run on alerts, given MCM_SERVER, MCM_EVENT and MCM_MESSAGE')
+    policy_parser = watchdog_subparsers.add_parser('policy',
+        help='show or change what the watchdog does about each event on a server')
+    policy_parser.add_argument('name', help='the name of the server')
+    policy_parser.add_argument('--on', action='append', metavar='EVENT=ACTION',
+        help='what to do about an event: ignore, alert, dump or restart, ' + \
+            'can be given more than once')
+    release_parser = watchdog_subparsers.add_parser('release',
+        help='let the watchdog look after a quarantined server again')
+    release_parser.add_argument('name', help='the name of the server')
+    watchdog_parser.set_defaults(handle=handle_watchdog)
+
     args = parser.parse_args()
-    if hasattr(args, 'handle'):
-        args.handle(args)
-    else:
+    if args.offline:
+        from .metadata import set_offline # pylint: disable=import-outside-toplevel
+        set_offline(True)
+    if not hasattr(args, 'handle'):
         parser.print_help()
+        return
+    if not args.profile:
+        args.handle(args)
+        return
+    from .profile import enable, span, write_trace # pylint: disable=import-outside-toplevel
+    enable()
+    try:
+        with span(args.handle.__name__[len('handle_'):]):
+            args.handle(args)
+    finally:
+        write_trace(args.profile_file)
 
 
 if __name__ == '__main__':
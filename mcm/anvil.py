@@ -0,0 +1,128 @@
+"""
+read and write anvil region files. a region starts with an 8 KiB header,
+1024 chunk locations then 1024 timestamps, followed by chunks in 4 KiB
+sectors, each a 4 byte length, a compression type and the chunk data
+"""
+import os
+import gzip
+import zlib
+import struct
+from pathlib import Path
+
+
+SECTOR = 4096
+HEADER = 2 * SECTOR
+CHUNKS = 1024
+GZIP = 1
+ZLIB = 2
+UNCOMPRESSED = 3
+# set on the compression type when the chunk lives in a separate .mcc file
+EXTERNAL = 128
+TAG_INT = 3
+TAG_LONG = 4
+# how much nbt to inflate at a time while looking for a tag
+INFLATE_STEP = 4096
+
+
+def read_header(buffer):
+    """
+    return (index, sector offset, sector count, timestamp) for every chunk
+    present in a region
+    """
+    if len(buffer) < HEADER:
+        return []
+    locations = struct.unpack_from(f'>{CHUNKS}I', buffer, 0)
+    timestamps = struct.unpack_from(f'>{CHUNKS}i', buffer, SECTOR)
+    return [(index, location >> 8, location & 0xFF, timestamps[index])
+        for index, location in enumerate(locations) if location]
+
+
+def read_chunk(buffer, offset):
+    """
+    return the compression type and stored bytes of the chunk at a sector
+    offset
+    """
+    start = offset * SECTOR
+    if offset < 2 or start + 5 > len(buffer):
+        raise ValueError(f'chunk at sector {offset} is outside the region')
+    length, compression = struct.unpack_from('>iB', buffer, start)
+    if length < 1 or start + 4 + length > len(buffer):
+        raise ValueError(f'chunk at sector {offset} runs past the end of the region')
+    return compression, bytes(buffer[start + 5:start + 4 + length])
+
+
+def decompress(compression, data):
+    """
+    return the nbt of a stored chunk
+    """
+    if compression == GZIP:
+        return gzip.decompress(data)
+    if compression == ZLIB:
+        return zlib.decompress(data)
+    if compression == UNCOMPRESSED:
+        return data
+    raise ValueError(f'unsupported chunk compression {compression}')
+
+
+def find_tag(compression, data, kind, name):
+    """
+    return the value of the first int or long tag with a name in a stored
+    chunk or gzipped nbt file, inflating only as far as the tag. returns None
+    if it isn't there
+    """
+    needle = struct.pack('>BH', kind, len(name)) + name.encode('utf-8')
+    value_format = '>i' if kind == TAG_INT else '>q'
+    wanted = len(needle) + struct.calcsize(value_format)
+    if compression == UNCOMPRESSED:
+        found = data.find(needle)
+        return struct.unpack_from(value_format, data, found + len(needle))[0] \
+            if found != -1 and found + wanted <= len(data) else None
+    if compression not in (GZIP, ZLIB):
+        raise ValueError(f'unsupported chunk compression {compression}')
+    inflater = zlib.decompressobj(zlib.MAX_WBITS | (16 if compression == GZIP else 0))
+    nbt = b''
+    pending = data
+    while True:
+        searched = max(len(nbt) - wanted, 0)
+        nbt += inflater.decompress(pending, INFLATE_STEP) if pending else inflater.flush()
+        found = nbt.find(needle, searched)
+        if found != -1 and found + wanted <= len(nbt):
+            return struct.unpack_from(value_format, nbt, found + len(needle))[0]
+        if not pending:
+            return None
+        pending = inflater.unconsumed_tail
+
+
+def chunk_position(region, index):
+    """
+    return the world chunk coordinates of a chunk given its region file name
+    and index in the header
+    """
+    _, region_x, region_z, _ = Path(region).name.split('.')
+    return int(region_x) * 32 + index % 32, int(region_z) * 32 + index // 32
+
+
+def write_region(path, chunks):
+    """
+    write a region file from (index, timestamp, compression, data) tuples,
+    packing the chunks into consecutive sectors. the file is replaced atomically
+    """
+    locations = [0] * CHUNKS
+    timestamps = [0] * CHUNKS
+    body = bytearray()
+    sector = HEADER // SECTOR
+    for index, timestamp, compression, data in sorted(chunks):
+        payload = struct.pack('>iB', len(data) + 1, compression) + data
+        sectors = -(-len(payload) // SECTOR)
+        if sectors > 0xFF:
+            raise ValueError(f'chunk {index} of {path} is too large for a region')
+        body += payload + bytes(sectors * SECTOR - len(payload))
+        locations[index] = sector << 8 | sectors
+        timestamps[index] = timestamp
+        sector += sectors
+    tmp = Path(Path(path).parent, f'.{Path(path).name}.{os.getpid()}')
+    with open(tmp, 'wb') as region:
+        region.write(struct.pack(f'>{CHUNKS}I', *locations))
+        region.write(struct.pack(f'>{CHUNKS}i', *timestamps))
+        region.write(body)
+    os.replace(tmp, path)
@@ -0,0 +1,448 @@
+"""
+deduplicated world backups. region files are split into chunks, and every
+chunk and every other world file is stored once in a content-addressed
+object store. each snapshot is a manifest of what made up the worlds
+"""
+import os
+import sys
+import gzip
+import json
+import mmap
+import time
+import zlib
+import fcntl
+import shutil
+import asyncio
+import hashlib
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .anvil import HEADER, GZIP, ZLIB, UNCOMPRESSED, read_header, read_chunk, decompress, \
+    write_region
+from .cache import clone_file
+from .rcon import RconError, send_command
+from .saves import get_targets, get_save_from_name
+from .utils import get_worlds, screen_running
+
+
+BACKUP_DIR = Path(os.environ.get('XDG_DATA_HOME', Path(Path.home(), '.local/share')),
+    'mcm', 'backups')
+SNAPSHOT_FORMAT = '%Y%m%dT%H%M%SZ'
+STAGING_NAME = '.mcm-staging'
+COMMAND_TIMEOUT = 10
+# a flush writes out every dirty chunk, which takes a while on big worlds
+FLUSH_TIMEOUT = 600
+
+
+@contextmanager
+def locked(repo, exclusive=False):
+    """
+    hold the repository lock, shared while backing up and restoring and
+    exclusive while collecting garbage
+    """
+    Path(repo).mkdir(parents=True, exist_ok=True)
+    with open(Path(repo, 'lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def object_path(repo, digest):
+    """
+    return where an object is stored
+    """
+    return Path(repo, 'objects', digest[:2], digest)
+
+
+def put_object(repo, digest, data):
+    """
+    store data under its digest unless it is already there, returning the
+    number of bytes written
+    """
+    path = object_path(repo, digest)
+    if path.exists():
+        return 0
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(path.parent, f'.{digest}.{os.getpid()}')
+    with open(tmp, 'wb') as file:
+        file.write(data)
+    os.replace(tmp, path)
+    return len(data)
+
+
+def get_object(repo, digest):
+    """
+    read a stored object
+    """
+    with open(object_path(repo, digest), 'rb') as file:
+        return file.read()
+
+
+def store_region(repo, path, previous): # pylint: disable=too-many-locals
+    """
+    store every chunk of a region file that isn't stored yet. chunks whose
+    timestamp is unchanged since the previous snapshot are not read at all.
+    returns [index, timestamp, compression, digest] per chunk, the bytes
+    written and 0. when chunks can't be read the whole file is stored as it
+    is instead, returning its digest, the bytes written and how many chunks
+    were unreadable
+    """
+    known = {index: chunk for index, *chunk in previous}
+    chunks = []
+    written = torn = 0
+    with open(path, 'rb') as region, \
+            mmap.mmap(region.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        for index, offset, _, timestamp in read_header(buffer):
+            if index in known and known[index][0] == timestamp:
+                chunks.append([index, *known[index]])
+                continue
+            try:
+                compression, data = read_chunk(buffer, offset)
+            except ValueError:
+                torn += 1
+                continue
+            try:
+                if compression not in (GZIP, ZLIB, UNCOMPRESSED):
+                    raise ValueError(compression)
+                # chunks are keyed by their nbt so a recompressed chunk still matches
+                nbt = decompress(compression, data)
+                digest = hashlib.sha256(nbt).hexdigest()
+                if not object_path(repo, digest).exists():
+                    written += put_object(repo, digest, zlib.compress(nbt))
+                compression = ZLIB
+            except (ValueError, OSError, EOFError, zlib.error):
+                # lz4, external and damaged chunks are kept exactly as stored
+                digest = hashlib.sha256(data).hexdigest()
+                written += put_object(repo, digest, data)
+            chunks.append([index, timestamp, compression, digest])
+    if torn:
+        # dropping the chunk would have a restore regenerate its terrain
+        digest, raw = store_file(repo, path)
+        return digest, written + raw, torn
+    return chunks, written, 0
+
+
+def store_file(repo, path):
+    """
+    store a whole file, returning its digest and the bytes written
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if object_path(repo, digest).exists():
+        return digest, 0
+    return digest, put_object(repo, digest, zlib.compress(data))
+
+
+def list_snapshots(repo, name):
+    """
+    return the snapshots of a save, oldest first
+    """
+    return sorted(path.name[:-len('.json.gz')] for path in
+        Path(repo, 'snapshots', name).glob('*.json.gz'))
+
+
+def load_manifest(repo, name, snapshot):
+    """
+    read a snapshot's manifest
+    """
+    with gzip.open(Path(repo, 'snapshots', name, f'{snapshot}.json.gz'), 'rt') as file:
+        return json.loads(file.read())
+
+
+def save_manifest(repo, name, snapshot, manifest):
+    """
+    write a snapshot's manifest atomically
+    """
+    directory = Path(repo, 'snapshots', name)
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp = Path(directory, f'.{snapshot}.{os.getpid()}')
+    with gzip.open(tmp, 'wt') as file:
+        file.write(json.dumps(manifest))
+    os.replace(tmp, Path(directory, f'{snapshot}.json.gz'))
+
+
+def walk_worlds(root, worlds):
+    """
+    yield the path relative to root and stat of every regular file in worlds
+    """
+    for world in worlds:
+        for directory, _, names in os.walk(Path(root, world)):
+            for name in names:
+                path = Path(directory, name)
+                try:
+                    stat = path.lstat()
+                except FileNotFoundError:
+                    continue
+                if path.is_file() and not path.is_symlink():
+                    yield str(path.relative_to(root)), stat
+
+
+def backup_save(save, repo, executor, root=None): # pylint: disable=too-many-locals
+    """
+    take a snapshot of a save's worlds, reading them from root if given.
+    files unchanged since the last snapshot are referenced without being
+    read. returns the snapshot, the number of files read and bytes written
+    """
+    root = Path(root or save['path'])
+    snapshots = list_snapshots(repo, save['name'])
+    previous = load_manifest(repo, save['name'], snapshots[-1])['files'] if snapshots else {}
+    files = {}
+    jobs = {}
+    for rel, stat in walk_worlds(root, get_worlds(save['path'])):
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'mode': stat.st_mode & 0o7777}
+        old = previous.get(rel)
+        if old is not None and (old['size'], old['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            files[rel] = old
+        elif rel.endswith('.mca') and stat.st_size >= HEADER:
+            old_chunks = old.get('chunks', []) if old is not None else []
+            jobs[rel] = entry, executor.submit(store_region, str(repo), str(Path(root, rel)),
+                old_chunks)
+        else:
+            jobs[rel] = entry, executor.submit(store_file, str(repo), str(Path(root, rel)))
+
+    written = 0
+    for rel, (entry, job) in jobs.items():
+        try:
+            result, size, *torn = job.result()
+        except FileNotFoundError:
+            # removed by the server while we were reading
+            continue
+        if torn and torn[0]:
+            print(f'warning: {save["name"]}: {torn[0]} chunks of {rel} could not be read, ' + \
+                'stored the region file as it is')
+        if isinstance(result, list):
+            files[rel] = dict(entry, type='region', chunks=result)
+        else:
+            files[rel] = dict(entry, type='file', object=result)
+        written += size
+
+    snapshot = datetime.utcnow().strftime(SNAPSHOT_FORMAT)
+    while Path(repo, 'snapshots', save['name'], f'{snapshot}.json.gz').exists():
+        # snapshots are named to the second, wait for a free name
+        time.sleep(0.1)
+        snapshot = datetime.utcnow().strftime(SNAPSHOT_FORMAT)
+    save_manifest(repo, save['name'], snapshot, {'name': save['name'], 'created': time.time(),
+        'files': files})
+    return snapshot, len(jobs), written
+
+
+def stage_worlds(save, staging, workers=None):
+    """
+    copy a save's worlds into staging, reflinking where the filesystem allows
+    and otherwise copying files in parallel. hardlinks won't do, the server
+    rewrites region files in place. returns how many files were reflinked
+    and how many copied
+    """
+    def stage(rel):
+        src, dest = Path(save['path'], rel), Path(staging, rel)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shared = clone_file(src, dest)
+        # the unchanged file check of the next backup relies on mtimes
+        shutil.copystat(src, dest)
+        return shared
+
+    files = [rel for rel, _ in walk_worlds(save['path'], get_worlds(save['path']))]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shared = sum(executor.map(stage, files))
+    return shared, len(files) - shared
+
+
+def stage_snapshot(save, workers=None):
+    """
+    stage a consistent copy of a running server's worlds, pausing saving
+    only while the copy is made. returns the staging directory, the pause
+    in seconds and the reflinked and copied file counts
+    """
+    staging = Path(save['path'], STAGING_NAME)
+    shutil.rmtree(staging, ignore_errors=True)
+    # flush while saving is still on, so little is left to write once it is off
+    send_command(save, 'save-all flush', FLUSH_TIMEOUT)
+    send_command(save, 'save-off', COMMAND_TIMEOUT)
+    start = time.monotonic()
+    try:
+        send_command(save, 'save-all flush', FLUSH_TIMEOUT)
+        shared, copied = stage_worlds(save, staging, workers)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    finally:
+        try:
+            send_command(save, 'save-on', COMMAND_TIMEOUT)
+        except (OSError, RconError, asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+            print(f'warning: could not turn saving back on for {save["name"]}: {err}, ' + \
+                f'run "mcm exec save-on -n {save["name"]}"')
+    return staging, time.monotonic() - start, shared, copied
+
+
+def select_kept(snapshots, keep_last=0, keep_daily=0, keep_weekly=0):
+    """
+    return the snapshots a retention policy keeps: the newest keep_last, and
+    the newest of each of the last keep_daily days and keep_weekly weeks
+    """
+    ordered = sorted(snapshots, reverse=True)
+    kept = set(ordered[:keep_last])
+    for count, period_format in ((keep_daily, '%Y-%m-%d'), (keep_weekly, '%G-%V')):
+        periods = set()
+        for snapshot in ordered:
+            period = datetime.strptime(snapshot, SNAPSHOT_FORMAT).strftime(period_format)
+            if period in periods:
+                continue
+            if len(periods) == count:
+                break
+            periods.add(period)
+            kept.add(snapshot)
+    return kept
+
+
+def apply_retention(repo, name, keep_last, keep_daily, keep_weekly):
+    """
+    delete the snapshots of a save that the retention policy doesn't keep,
+    returning them. a restore reading one of them holds the shared lock, so
+    this waits for it
+    """
+    with locked(repo, exclusive=True):
+        snapshots = list_snapshots(repo, name)
+        kept = select_kept(snapshots, keep_last, keep_daily, keep_weekly)
+        removed = [snapshot for snapshot in snapshots if snapshot not in kept]
+        for snapshot in removed:
+            Path(repo, 'snapshots', name, f'{snapshot}.json.gz').unlink()
+    return removed
+
+
+def collect_garbage(repo):
+    """
+    delete every object no snapshot refers to, returning how many were
+    deleted and the bytes freed
+    """
+    with locked(repo, exclusive=True):
+        referenced = set()
+        for manifest in Path(repo, 'snapshots').glob('*/*.json.gz'):
+            with gzip.open(manifest, 'rt') as file:
+                for entry in json.loads(file.read())['files'].values():
+                    if entry['type'] == 'region':
+                        referenced.update(chunk[3] for chunk in entry['chunks'])
+                    else:
+                        referenced.add(entry['object'])
+        removed = freed = 0
+        for path in Path(repo, 'objects').glob('*/*'):
+            if path.name not in referenced:
+                freed += path.stat().st_size
+                path.unlink()
+                removed += 1
+    return removed, freed
+
+
+def restore_file(repo, dest, entry):
+    """
+    write one file of a snapshot to dest
+    """
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if entry['type'] == 'region':
+        write_region(dest, [(index, timestamp, compression, get_object(repo, digest))
+            for index, timestamp, compression, digest in entry['chunks']])
+    else:
+        tmp = Path(dest.parent, f'.{dest.name}.{os.getpid()}')
+        with open(tmp, 'wb') as file:
+            file.write(zlib.decompress(get_object(repo, entry['object'])))
+        os.replace(tmp, dest)
+    os.chmod(dest, entry['mode'])
+    os.utime(dest, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+
+def handle_backup(args): # pylint: disable=too-many-locals,too-many-branches
+    """
+    back up one or every save's worlds, then apply the retention policy
+    """
+    try:
+        saves = get_targets(args.name, args.all, args.match)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    repo = Path(args.repo or BACKUP_DIR)
+    if args.list:
+        for save in saves:
+            for snapshot in list_snapshots(repo, save['name']):
+                print(f'{save["name"]} {snapshot}')
+        return
+
+    pruned = failed = False
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for save in saves:
+            staging = None
+            if screen_running(save['name']) and args.snapshot:
+                try:
+                    staging, pause, shared, copied = stage_snapshot(save, args.workers)
+                except (OSError, RconError, asyncio.TimeoutError,
+                        asyncio.IncompleteReadError) as err:
+                    print(f'{save["name"]}: could not stage a snapshot: {err}')
+                    failed = True
+                    continue
+                print(f'{save["name"]}: saving paused for {pause:.2f}s to stage ' + \
+                    f'{shared} reflinked and {copied} copied files')
+            elif screen_running(save['name']):
+                print(f'warning: {save["name"]} is running, its world may be caught ' + \
+                    'halfway through a save, use --snapshot to pause saving')
+            start = time.time()
+            try:
+                with locked(repo):
+                    snapshot, read, written = backup_save(save, repo, executor, staging)
+            finally:
+                if staging is not None:
+                    shutil.rmtree(staging, ignore_errors=True)
+            print(f'{save["name"]}: snapshot {snapshot}, {read} files read, ' + \
+                f'{written / (1024 * 1024):.1f} MB new, {time.time() - start:.1f}s')
+            if args.keep_last or args.keep_daily or args.keep_weekly:
+                removed = apply_retention(repo, save['name'], args.keep_last, args.keep_daily,
+                    args.keep_weekly)
+                if removed:
+                    pruned = True
+                    print(f'{save["name"]}: removed snapshots {", ".join(removed)}')
+    if pruned or args.gc:
+        removed, freed = collect_garbage(repo)
+        print(f'removed {removed} unreferenced objects, freed {freed / (1024 * 1024):.1f} MB')
+    if failed:
+        sys.exit(1)
+
+
+def handle_restore(args):
+    """
+    rebuild a save's worlds from a snapshot, in place or into another directory
+    """
+    save = get_save_from_name(args.name)
+    if save is None:
+        print(f'could not find save with name {args.name}')
+        sys.exit(1)
+    repo = Path(args.repo or BACKUP_DIR)
+    root = Path(args.to or save['path'])
+    if root == Path(save['path']) and screen_running(save['name']):
+        print(f'{save["name"]} is running, stop it before restoring over its worlds')
+        sys.exit(1)
+
+    # retention and garbage collection wait until the snapshot is restored
+    with locked(repo):
+        snapshots = list_snapshots(repo, save['name'])
+        snapshot = args.snapshot or (snapshots[-1] if snapshots else None)
+        if snapshot not in snapshots:
+            print(f'no snapshot {snapshot} of {save["name"]}' if snapshot else \
+                f'{save["name"]} has no snapshots')
+            sys.exit(1)
+        files = load_manifest(repo, save['name'], snapshot)['files']
+        worlds = sorted({Path(rel).parts[0] for rel in files})
+        existing = [world for world in worlds if Path(root, world).exists()]
+        if existing and not args.force:
+            print(f'{", ".join(existing)} already exists in {root}, use --force to replace it')
+            sys.exit(1)
+        for world in existing:
+            shutil.rmtree(Path(root, world))
+
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            jobs = [executor.submit(restore_file, str(repo), str(Path(root, rel)), entry)
+                for rel, entry in files.items()]
+            for job in jobs:
+                job.result()
+    print(f'restored {len(files)} files of {save["name"]} snapshot {snapshot} to {root} ' + \
+        f'in {time.time() - start:.1f}s')
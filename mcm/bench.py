@@ -0,0 +1,202 @@
+"""
+benchmark a saved server's startup under several jvm flag profiles
+"""
+import os
+import re
+import sys
+import time
+import queue
+import shlex
+import tempfile
+import threading
+import statistics
+import subprocess
+from pathlib import Path
+
+from .memory import get_current_heap
+from .saves import get_save_from_name, update_save
+from .utils import screen_running
+from .scripts import PROFILES, default_heap, java_flags, find_jar, rewrite_start_script, \
+    start_options
+
+
+DONE_PATTERN = re.compile(r'Done \((\d+[.,]\d+)s\)!')
+LAG_PATTERN = re.compile(r'Can\'t keep up!.*?Running (\d+)ms')
+GC_PAUSE_PATTERN = re.compile(r'Pause.*?(\d+[.,]\d+)ms$')
+VERSION_PATTERN = re.compile(r'version "(?:1\.)?(\d+)')
+
+
+def get_java_major(java):
+    """
+    return the major version of a java binary, or 8 if it can't be told
+    """
+    try:
+        output = subprocess.run([java, '-version'], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True, check=False).stdout
+    except OSError:
+        return 8
+    match = VERSION_PATTERN.search(output)
+    return int(match.group(1)) if match else 8
+
+
+def parse_gc_log(path):
+    """
+    return the number and total length in ms of gc pauses in a unified gc log
+    """
+    pauses = []
+    try:
+        with open(path, 'r') as log:
+            for line in log:
+                match = GC_PAUSE_PATTERN.search(line.strip())
+                if match:
+                    pauses.append(float(match.group(1).replace(',', '.')))
+    except OSError:
+        pass
+    return len(pauses), sum(pauses)
+
+
+def pump(stream, lines):
+    """
+    move lines from a process's output onto a queue, then a None at eof
+    """
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+def run_once(command, cwd, settle, timeout):
+    """
+    start a server headlessly, wait for Done, watch it settle, then stop it.
+    returns the startup time and lag warnings, or None if it never finished
+    """
+    process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    lines = queue.Queue()
+    threading.Thread(target=pump, args=(process.stdout, lines), daemon=True).start()
+    deadline = time.time() + timeout
+    done = None
+    lag = []
+    try:
+        while time.time() < deadline:
+            try:
+                line = lines.get(timeout=deadline - time.time())
+            except queue.Empty:
+                break
+            if line is None:
+                break
+            if done is None:
+                match = DONE_PATTERN.search(line)
+                if match:
+                    done = float(match.group(1).replace(',', '.'))
+                    deadline = time.time() + settle
+            else:
+                match = LAG_PATTERN.search(line)
+                if match:
+                    lag.append(int(match.group(1)))
+        process.stdin.write('stop\n')
+        process.stdin.flush()
+        process.wait(timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        process.kill()
+        process.wait()
+    return done, lag
+
+
+def parse_heap(heap):
+    """
+    parse a heap size such as 6G or 4096M into MiB
+    """
+    match = re.fullmatch(r'(\d+)([MmGg]?)', heap)
+    if match is None:
+        raise ValueError(f'invalid heap size {heap}')
+    return int(match.group(1)) * (1 if match.group(2).lower() == 'm' else 1024)
+
+
+def get_variants(args, save):
+    """
+    return every (profile, heap) combination to benchmark
+    """
+    profiles = args.profiles.split(',') if args.profiles else list(PROFILES)
+    for profile in profiles:
+        if profile not in PROFILES:
+            raise ValueError(f'unknown profile {profile}, choose from {", ".join(PROFILES)}')
+    if args.heaps:
+        heaps = [parse_heap(heap) for heap in args.heaps.split(',')]
+    else:
+        # the heap start.sh asks for, or the one a fresh start.sh would get
+        heaps = [get_current_heap(save) or default_heap()]
+    return [(profile, heap) for profile in profiles for heap in heaps]
+
+
+def summarize(name, times, lag, pauses):
+    """
+    print the medians and spread of one variant's runs
+    """
+    if not times:
+        print(f'{name}: never reached Done')
+        return
+    spread = statistics.stdev(times) if len(times) > 1 else 0
+    line = f'{name}: startup median {statistics.median(times):.3f}s, ' + \
+        f'stdev {spread:.3f}s, {len(lag)} lag warnings'
+    if pauses:
+        line += f', gc pauses median {statistics.median(count for count, _ in pauses):g} ' + \
+            f'totalling {statistics.median(total for _, total in pauses):.1f}ms'
+    print(line)
+
+
+def bench_server(args): # pylint: disable=too-many-locals
+    """
+    run a saved server under each flag profile and report startup medians
+    """
+    save = get_save_from_name(args.name)
+    if save is None:
+        print(f'could not find save with name {args.name}')
+        sys.exit(1)
+    if screen_running(save['name']):
+        print(f'{save["name"]} is running, stop it before benchmarking')
+        sys.exit(1)
+    try:
+        variants = get_variants(args, save)
+        jar = args.jar or find_jar(save)
+    except (OSError, ValueError) as err:
+        print(err)
+        sys.exit(1)
+    options = start_options(save)
+    unified_logging = get_java_major(args.java) >= 9
+
+    results = {}
+    for profile, heap in variants:
+        name = f'{profile}@{heap}M'
+        times, lag, pauses = [], [], []
+        for run in range(args.runs):
+            gc_log = Path(tempfile.gettempdir(), f'mcm-bench-{os.getpid()}-gc.log')
+            flags = java_flags(heap, options['cpus'], profile)
+            if unified_logging:
+                flags += f' -Xlog:gc:file={gc_log}'
+            command = [args.java] + shlex.split(flags) + ['-jar', jar, 'nogui']
+            print(f'{name} run {run + 1}/{args.runs}')
+            try:
+                done, run_lag = run_once(command, save['path'], args.settle, args.timeout)
+            except OSError as err:
+                print(f'could not start {args.java}: {err}')
+                sys.exit(1)
+            if done is not None:
+                times.append(done)
+                lag.extend(run_lag)
+                if unified_logging:
+                    pauses.append(parse_gc_log(gc_log))
+            if gc_log.exists():
+                gc_log.unlink()
+        results[(profile, heap)] = times
+        summarize(name, times, lag, pauses)
+
+    finished = {variant: times for variant, times in results.items() if times}
+    if not finished:
+        print('no profile reached Done')
+        sys.exit(1)
+    profile, heap = min(finished, key=lambda variant: statistics.median(finished[variant]))
+    print(f'fastest: {profile}@{heap}M')
+    if args.write:
+        update_save(save['name'], profile=profile, heap=heap)
+        rewrite_start_script(get_save_from_name(save['name']))
+        print(f'wrote {profile}@{heap}M to {save["path"]}/start.sh')
@@ -0,0 +1,237 @@
+"""
+content-addressed cache of server jars shared by every server on the host
+"""
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+
+from .utils import CACHE_DIR
+from .download import download, hash_file
+from .saves import get_saves
+from .metadata import is_offline
+from .profile import span, add
+
+
+JAR_DIR = Path(CACHE_DIR, 'jars')
+URL_INDEX = Path(JAR_DIR, 'urls.json')
+# jars fetched from several threads share the index and its temporary file
+INDEX_LOCK = threading.Lock()
+
+# linux ioctl number for FICLONE, used to reflink on btrfs and xfs
+FICLONE = 0x40049409
+
+
+def load_url_index():
+    """
+    load the url to digest index used for jars with no published hash
+    """
+    if not URL_INDEX.exists():
+        return {}
+    with open(URL_INDEX, 'r') as file:
+        return json.loads(file.read())
+
+
+def save_url_index(index):
+    """
+    atomically write the url index
+    """
+    JAR_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = Path(JAR_DIR, f'.urls.json.{os.getpid()}')
+    with open(tmp, 'wt') as file:
+        file.write(json.dumps(index, indent=4))
+    os.replace(tmp, URL_INDEX)
+
+
+def cached_jar(url, digest=None):
+    """
+    return the cached jar for a digest, or for a url if no digest is known
+    """
+    if digest is None:
+        digest = load_url_index().get(url)
+    if digest is None or not Path(JAR_DIR, digest).exists():
+        return None
+    return Path(JAR_DIR, digest)
+
+
+def fetch(url, digest=None, progress=None):
+    """
+    download a jar into the cache, verifying its hash before it is stored
+    """
+    JAR_DIR.mkdir(parents=True, exist_ok=True)
+    if digest is not None:
+        download(url, Path(JAR_DIR, digest), digest, progress=progress)
+    else:
+        # unhashed jars are named once their content has been hashed
+        tmp = Path(JAR_DIR, '.unhashed-' + hashlib.sha1(url.encode('utf-8')).hexdigest())
+        digest = download(url, tmp, progress=progress)
+        os.replace(tmp, Path(JAR_DIR, digest))
+    if progress is None:
+        print()
+
+    # remember which digest the url produced so unhashed jars are reused too
+    with INDEX_LOCK:
+        index = load_url_index()
+        index[url] = digest
+        save_url_index(index)
+    return Path(JAR_DIR, digest)
+
+
+def clone_file(src, dest):
+    """
+    copy a file, sharing its extents with a reflink where the filesystem allows.
+    returns whether it was reflinked
+    """
+    with open(src, 'rb') as src_fd, open(dest, 'wb') as dest_fd:
+        try:
+            fcntl.ioctl(dest_fd.fileno(), FICLONE, src_fd.fileno())
+            shared = True
+        except OSError:
+            shutil.copyfileobj(src_fd, dest_fd)
+            shared = False
+    shutil.copymode(src, dest)
+    return shared
+
+
+def link_jar(src, dest):
+    """
+    place a cached jar at dest by hardlink, falling back to a reflink or copy
+    """
+    tmp = Path(Path(dest).parent, f'.{Path(dest).name}.{os.getpid()}')
+    try:
+        os.link(src, tmp)
+    except OSError:
+        clone_file(src, tmp)
+    os.replace(tmp, dest)
+
+
+def ensure_cached(url, digest=None, progress=None):
+    """
+    return the cached jar for url, downloading it if needed, and whether the
+    cache was hit
+    """
+    src = cached_jar(url, digest)
+    if src is not None:
+        add('jar_cache_hits')
+        return src, True
+    if is_offline():
+        raise ValueError(f'{url} is not in the jar cache and --offline was given')
+    add('jar_cache_misses')
+    return fetch(url, digest, progress), False
+
+
+def install_jar(url, dest, digest=None):
+    """
+    place the jar at url into dest, downloading it only if it isn't cached yet.
+    returns whether the cache was hit
+    """
+    with span('install_jar', jar=Path(dest).name):
+        src, hit = ensure_cached(url, digest)
+        link_jar(src, dest)
+    return hit
+
+
+def install_target(target, path):
+    """
+    install a resolved jar into a server directory, or print why it couldn't
+    be fetched and exit
+    """
+    try:
+        hit = install_jar(target['url'], Path(path, target['jar']), target['hash'])
+    except (OSError, ValueError) as err:
+        print(f'error downloading {target["jar"]}: {err}')
+        sys.exit(1)
+    print(f'{"Linked cached" if hit else "Downloaded"} {target["jar"]} to {path}')
+
+
+def get_entries():
+    """
+    return all cached jars with the saves that reference them
+    """
+    if not JAR_DIR.exists():
+        return []
+    entries = []
+    for jar in sorted(JAR_DIR.iterdir()):
+        # digests are plain hex, anything else is an index or partial download
+        if '.' in jar.name:
+            continue
+        stat = jar.stat()
+        entries.append({
+            'digest': jar.name,
+            'path': jar,
+            'size': stat.st_size,
+            'inode': (stat.st_dev, stat.st_ino),
+            'refs': [],
+        })
+
+    for save in get_saves():
+        if 'jar' in save:
+            jars = [Path(save['path'], save['jar'])]
+        else:
+            jars = list(Path(save['path']).glob('*.jar'))
+        # plugins and mods placed by mcm plugins sync come from the cache too
+        jars += list(Path(save['path'], 'plugins').glob('*.jar')) + \
+            list(Path(save['path'], 'mods').glob('*.jar'))
+        for jar in jars:
+            if not jar.exists():
+                continue
+            stat = jar.stat()
+            for entry in entries:
+                # hardlinked jars share an inode, copies need to be hashed
+                if entry['inode'] == (stat.st_dev, stat.st_ino) or \
+                    (entry['size'] == stat.st_size and \
+                        hash_file(jar, entry['digest']) == entry['digest']):
+                    entry['refs'].append(save['name'])
+                    break
+    return entries
+
+
+def list_cache():
+    """
+    print every cached jar with its size and referencing servers
+    """
+    entries = get_entries()
+    if not entries:
+        print('jar cache is empty')
+        return
+    for entry in entries:
+        refs = ', '.join(entry['refs']) if entry['refs'] else 'unused'
+        print(f'{entry["digest"][:12]}  {entry["size"] / (1024 * 1024):7.1f} MB  ' + \
+            f'{len(entry["refs"])} refs ({refs})')
+
+
+def gc_cache(dry_run=False):
+    """
+    remove cached jars that no saved server references
+    """
+    freed = 0
+    removed = set()
+    for entry in get_entries():
+        if entry['refs']:
+            continue
+        print(f'{"would remove" if dry_run else "removing"} {entry["digest"][:12]}')
+        freed += entry['size']
+        removed.add(entry['digest'])
+        if not dry_run:
+            entry['path'].unlink()
+    if removed and not dry_run:
+        save_url_index({url: digest for url, digest in load_url_index().items()
+            if digest not in removed})
+    print(f'{"would free" if dry_run else "freed"} {freed / (1024 * 1024):.1f} MB')
+
+
+def handle_cache(args):
+    """
+    dispatch cache subcommands
+    """
+    if args.cache_action == 'ls':
+        list_cache()
+    elif args.cache_action == 'gc':
+        gc_cache(args.dry_run)
+    else:
+        print('no cache action given, use "mcm cache ls" or "mcm cache gc"')
+        sys.exit(1)
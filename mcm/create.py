@@ -3,20 +3,15 @@ module for creating servers
 """
 import os
 import sys
-import time
-import json
 from pathlib import Path
-from urllib.request import urlopen, urlretrieve
 
-import requests
-from bs4 import BeautifulSoup
-
-from .utils import reporthook
+from .cache import install_target
+from .resolve import resolve_or_exit
 from .scripts import create_start_script, create_systemd_file
-from .saves import add_server, save_exists
-
-
-MEM_SIZE = min(((os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))/(1024.**3)), 6)
+from .profile import span
+from .rcon import setup_rcon
+from .saves import add_server, save_exists, get_save_from_name, update_save
+from .utils import get_mem_size
 
 
 def get_path(args):
@@ -52,22 +47,10 @@ def get_path(args):
     return path
 
 
-def create_vanilla(args): # pylint: disable=too-many-branches,too-many-statements
+def validate_name(args):
     """
-    repl loop for vanilla minecraft
+    if a name argument was provided, make sure it's valid
     """
-    # load list of all versions from mojang's metadata
-    versions = json.loads(
-        urlopen('https://launchermeta.mojang.com/mc/game/version_manifest.json')\
-            .read().decode('utf-8'))
-
-    # get the latest version of minecraft if none was provide
-    if args.version is None or args.version.lower() == 'latest':
-        selected_version = versions['latest']['release']
-    else:
-        selected_version = args.version.lower()
-
-    # if a name argument was provided, make sure it's valid
     if args.name:
         server_name = args.name.strip()
         for char in server_name:
@@ -76,172 +59,73 @@ def create_vanilla(args): # pylint: disable=too-many-branches,too-many-statement
                 sys.exit(1)
 
 
-    # get the download url for the server jar or exit if the version is not found
-    server_url = None
-    for version in versions['versions']:
-        if version['id'] == selected_version:
-            version_json = json.loads(urlopen(version['url']).read().decode('utf-8'))
-            server_url = version_json['downloads']['server']['url']
-            break
-    if server_url is None:
-        print(f'Invalid version {selected_version}. Exiting')
-        sys.exit(1)
-    print(f'Using vanilla server version {selected_version}')
+def create_server(args, target):
+    """
+    download a resolved server jar and set up scripts and the save entry
+    """
+    validate_name(args)
 
     path = get_path(args)
 
     # if no name was given, derive it from the base name of the directory
-    if not args.name:
-        server_name = path.name
+    server_name = args.name.strip() if args.name else path.name
 
     if save_exists(server_name, path):
         print('a server with that name or path already exists')
         sys.exit(1)
 
-    urlretrieve(server_url, f'{path}/minecraft-server-{selected_version}.jar', reporthook)
-    time.sleep(0.5)
-    print(f'\nDownloaded minecraft-server-{selected_version}.jar to {path}')
+    install_target(target, path)
 
-    create_start_script(server_name, path, f'minecraft-server-{selected_version}.jar')
+    create_start_script(server_name, path, f'{path}/{target["jar"]}', cds=args.cds)
     create_systemd_file(server_name, path)
-    add_server(server_name, 'vanilla', f'{selected_version}', path)
+    add_server(server_name, target['fork'], target['version'], path, target['jar'])
+    if args.cds:
+        update_save(server_name, cds=True)
+        print('The first run records a class data archive when the server stops, ' + \
+            'later starts load it to start faster')
+    if args.rcon:
+        with span('create.rcon'):
+            credentials = setup_rcon(get_save_from_name(server_name))
+        print(f'Enabled rcon on port {credentials["port"]}, run commands with "mcm exec"')
+    else:
+        print(f'To run commands with "mcm exec", enable rcon with "mcm rcon -n {server_name}"')
 
     print('If you opted to create a systemd service, start the server by running ' + \
         f'"systemctl start {server_name}" as root')
-    print(f'Otherwise, run it with "java -jar -Xms{MEM_SIZE}G -Xmx{MEM_SIZE}G ' + \
-        f'minecraft-server-{selected_version}.jar nogui". The -Xm options refer to ' + \
+    mem_size = get_mem_size()
+    print(f'Otherwise, run it with "java -jar -Xms{mem_size}G -Xmx{mem_size}G ' + \
+        f'{target["jar"]} nogui". The -Xm options refer to ' + \
         'minimum and maximum memory allocated to the JVM. Only edit these if you ' + \
         'experience performance issues and you know what you\'re doing.')
+    print('If this host runs several servers, run "mcm plan memory" to fit their heaps in ram')
+    print(f'Once it is running, run "mcm pregen {server_name} --radius 2000" to generate ' + \
+        'terrain ahead of players')
     sys.exit(0)
 
 
+def create_vanilla(args):
+    """
+    vanilla minecraft download handler
+    """
+    target = resolve_or_exit('vanilla', args.version)
+    print(f'Using vanilla server version {target["version"]}')
+    create_server(args, target)
+
+
 def create_paper(args):
     """
     papermc download handler
     """
-    # valid versions can have 4 structures
-    # no version provided defaults to the latest build, as does 'latest'
-    # a single string with no '-' will be treated as a simple version
-    # the latest build of the specified version will be downloaded, if available
-    # a string with a '-', such as '1.16.3-224' will be treated as a version and build
-    paper_versions = json.loads(
-        urlopen('https://papermc.io/api/v1/paper')\
-            .read().decode('utf-8'))
-    if args.version is None or args.version == 'latest':
-        version = paper_versions['versions'][0]
-    else:
-        version = args.version.partition('-')[0]
-        if version not in paper_versions['versions']:
-            print(f'invalid paper version {args.version}')
-            sys.exit(1)
-    # now that we have a good version, get the build number
-    paper_builds = json.loads(
-        urlopen(f'https://papermc.io/api/v1/paper/{version}')\
-            .read().decode('utf-8'))
-    if args.version is not None and '-' in args.version:
-        build = args.version.partition('-')[2]
-        if build not in paper_builds['builds']['all']:
-            print(f'invalid paper build {build}')
-            sys.exit(1)
-    else:
-        build = paper_builds['builds']['latest']
+    target = resolve_or_exit('paper', args.version)
+    version, _, build = target['version'].partition('-')
     print(f'using paper version {version}, build {build}')
-
-    # if a name argument was provided, make sure it's valid
-    if args.name:
-        server_name = args.name.strip()
-        for char in server_name:
-            if not (char.isalpha() or char.isnumeric()):
-                print(f'invalid character "{char}" in name. only letters and numbers are allowed')
-                sys.exit(1)
-
-    path = get_path(args)
-
-    # if no name was given, derive it from the base name of the directory
-    if not args.name:
-        server_name = path.name
-
-    if save_exists(server_name, path):
-        print('a server with that name or path already exists')
-        sys.exit(1)
-
-    urlretrieve(f'https://papermc.io/api/v1/paper/{version}/{build}/download', \
-        f'{path}/paper-{version}-{build}.jar', reporthook)
-    time.sleep(0.5)
-    print(f'\nDownloaded paper-{version}-{build}.jar to {path}')
-
-    create_start_script(server_name, path, f'{path}/paper-{version}-{build}.jar')
-    create_systemd_file(server_name, path)
-    add_server(server_name, 'paper', f'{version}-{build}', path)
-
-    print('If you opted to create a systemd service, start the server by running ' + \
-        f'"systemctl start {server_name}" as root')
-    print(f'Otherwise, run it with "java -jar -Xms{MEM_SIZE}G -Xmx{MEM_SIZE}G ' + \
-        f'paper-{version}-{build}.jar nogui". The -Xm options refer to ' + \
-        'minimum and maximum memory allocated to the JVM. Only edit these if you ' + \
-        'experience performance issues and you know what you\'re doing.')
-    sys.exit(0)
+    create_server(args, target)
 
 
-def create_forge(args): # pylint: disable=too-many-branches
+def create_forge(args):
     """
     forge download handler
     """
-    if args.version is None or args.version == 'latest':
-        page = requests.get('https://files.minecraftforge.net/')
-    else:
-        version = args.version.partition('-')[0]
-        page = requests.get(f'https://files.minecraftforge.net/maven/net/minecraftforge/forge/index_{version}.html')
-    if page.status_code  != 200:
-        print(f'invalid forge version {version}')
-        sys.exit(1)
-
-    parsed_page = BeautifulSoup(page.text, 'html.parser')
-    if args.version is not None and '-' in args.version:
-        links = [e['href'] for e in parsed_page.find_all('a') if \
-            'Direct Download' in e.text and 'universal' in e['href'] \
-            and f'/{args.version}' in e['href']]
-        if len(links) > 0:
-            link = links[0]
-        else:
-            print(f'invalid build {args.version}')
-            sys.exit(1)
-
-    link = parsed_page.find_all('div', attrs={'class': 'download'})[0 if args.version == 'latest' or len(parsed_page.find_all('div', attrs={'class': 'download'})) == 1 else 1].find_all('div', attrs={'class': 'link'})[-1].find_all('a')[0]['href'].partition('url=')[2]
-
-    version = link.partition('/forge/')[2].partition('/')[0].partition('-')[0] + '-' + link.partition('/forge/')[2].partition('-')[2].partition('-')[0].partition('/')[0]
-    print(f'using forge version {version}')
-
-    # if a name argument was provided, make sure it's valid
-    if args.name:
-        server_name = args.name.strip()
-        for char in server_name:
-            if not (char.isalpha() or char.isnumeric()):
-                print(f'invalid character "{char}" in name. only letters and numbers are allowed')
-                sys.exit(1)
-
-    path = get_path(args)
-
-    # if no name was given, derive it from the base name of the directory
-    if not args.name:
-        server_name = path.name
-
-    if save_exists(server_name, path):
-        print('a server with that name or path already exists')
-        sys.exit(1)
-
-    urlretrieve(link, f'{path}/forge-{version}.jar', reporthook)
-    time.sleep(0.5)
-    print(f'\nDownloaded forge-{version}.jar to {path}')
-
-    create_start_script(server_name, path, f'{path}/forge-{version}.jar')
-    create_systemd_file(server_name, path)
-    add_server(server_name, 'forge', f'{version}', path)
-
-    print('If you opted to create a systemd service, start the server by running ' + \
-        f'"systemctl start {server_name}" as root')
-    print(f'Otherwise, run it with "java -jar -Xms{MEM_SIZE}G -Xmx{MEM_SIZE}G ' + \
-        f'forge-{version}.jar nogui". The -Xm options refer to ' + \
-        'minimum and maximum memory allocated to the JVM. Only edit these if you ' + \
-        'experience performance issues and you know what you\'re doing.')
-    sys.exit(0)
+    target = resolve_or_exit('forge', args.version)
+    print(f'using forge version {target["version"]}')
+    create_server(args, target)
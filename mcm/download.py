@@ -0,0 +1,205 @@
+"""
+resumable, parallel range-request downloads with atomic completion
+"""
+import os
+import json
+import fcntl
+import hashlib
+import threading
+from functools import partial
+from pathlib import Path
+from contextlib import contextmanager
+from urllib.request import Request, urlopen
+from concurrent.futures import ThreadPoolExecutor
+
+from .profile import span
+from .utils import Progress
+
+
+BLOCK_SIZE = 64 * 1024
+SEGMENT_SIZE = 4 * 1024 * 1024
+WORKERS = 4
+RETRIES = 3
+
+
+def hash_algorithm(digest):
+    """
+    return the hash algorithm matching the length of a hex digest
+    """
+    return hashlib.sha1() if len(digest) == 40 else hashlib.sha256()
+
+
+def hash_file(path, digest=None):
+    """
+    hash a file with the algorithm matching the given digest, sha256 by default
+    """
+    hasher = hash_algorithm(digest) if digest else hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def probe(url):
+    """
+    return the final url, size and range support of a download
+    """
+    with urlopen(Request(url, method='HEAD')) as response:
+        size = int(response.headers.get('Content-Length', 0))
+        ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return response.geturl(), size, ranges and size > 0
+
+
+def load_state(state_path, url, size):
+    """
+    load the completed segments of an interrupted download of the same file
+    """
+    if not state_path.exists():
+        return set()
+    try:
+        with open(state_path, 'r') as file:
+            state = json.loads(file.read())
+    except ValueError:
+        return set()
+    if state.get('url') != url or state.get('size') != size:
+        return set()
+    return set(state['done'])
+
+
+def save_state(state_path, url, size, done):
+    """
+    atomically record which segments of a download are on disk
+    """
+    tmp = Path(state_path.parent, f'{state_path.name}.tmp')
+    with open(tmp, 'wt') as file:
+        file.write(json.dumps({'url': url, 'size': size, 'done': sorted(done)}))
+    os.replace(tmp, state_path)
+
+
+def fetch_segment(url, part_fd, start, end, progress):
+    """
+    fetch bytes start through end of url into part_fd at the same offset
+    """
+    request = Request(url, headers={'Range': f'bytes={start}-{end}'})
+    for attempt in range(RETRIES):
+        offset = start
+        try:
+            with urlopen(request) as response:
+                if response.status != 206:
+                    raise OSError(f'server ignored range request for {url}')
+                for block in iter(partial(response.read, BLOCK_SIZE), b''):
+                    os.pwrite(part_fd, block, offset)
+                    offset += len(block)
+                    progress(len(block))
+            if offset == end + 1:
+                return
+            raise OSError(f'short read on {url} bytes {start}-{end}')
+        except OSError:
+            # don't count the bytes of a failed attempt twice
+            progress(start - offset)
+            if attempt == RETRIES - 1:
+                raise
+
+
+def fetch_ranges(url, part_fd, size, state_path, progress, workers): # pylint: disable=too-many-arguments
+    """
+    fetch every missing segment of url concurrently, checkpointing as they land
+    """
+    done = load_state(state_path, url, size)
+    os.ftruncate(part_fd, size)
+    segments = [start for start in range(0, size, SEGMENT_SIZE) if start not in done]
+    progress(sum(min(SEGMENT_SIZE, size - start) for start in done))
+    lock = threading.Lock()
+
+    def worker(start):
+        fetch_segment(url, part_fd, start, min(start + SEGMENT_SIZE, size) - 1, progress)
+        with lock:
+            done.add(start)
+            save_state(state_path, url, size, done)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(worker, start) for start in segments]:
+            future.result()
+
+
+def fetch_stream(url, part_fd, progress):
+    """
+    fetch url in a single stream, for servers without range support
+    """
+    os.ftruncate(part_fd, 0)
+    offset = 0
+    with urlopen(url) as response:
+        for block in iter(partial(response.read, BLOCK_SIZE), b''):
+            os.pwrite(part_fd, block, offset)
+            offset += len(block)
+            progress(len(block))
+
+
+@contextmanager
+def exclusive(lock_path):
+    """
+    hold an exclusive lock on lock_path, which is deleted on release so no
+    lock files pile up. a waiter that wakes up on a deleted lock file locks
+    the current one instead
+    """
+    while True:
+        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(lock_fd).st_ino == os.stat(lock_path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        os.close(lock_fd)
+    try:
+        yield
+    finally:
+        os.unlink(lock_path)
+        os.close(lock_fd)
+
+
+def download(url, dest, digest=None, workers=WORKERS, progress=None):
+    """
+    download url to dest, resuming from dest.part and renaming into place only
+    once the hash checks out. concurrent downloads of the same dest wait on
+    dest.lock. returns the hex digest of the file
+    """
+    with span('download', url=url) as timing:
+        dest = Path(dest)
+        part = Path(dest.parent, f'{dest.name}.part')
+        state_path = Path(dest.parent, f'{dest.name}.part.json')
+        lock_path = Path(dest.parent, f'{dest.name}.lock')
+        url, size, ranges = probe(url)
+        if progress is None:
+            progress = Progress(size)
+
+        def counted(count):
+            timing.add('bytes', count)
+            progress(count)
+
+        # another mcm process may be fetching the same file
+        with exclusive(lock_path):
+            if dest.exists() and (digest is None or hash_file(dest, digest) == digest):
+                if part.exists():
+                    part.unlink()
+                return hash_file(dest, digest)
+            part_fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if ranges:
+                    fetch_ranges(url, part_fd, size, state_path, counted, workers)
+                else:
+                    fetch_stream(url, part_fd, counted)
+                os.fsync(part_fd)
+            finally:
+                os.close(part_fd)
+            actual = hash_file(part, digest)
+            if digest is not None and actual != digest:
+                part.unlink()
+                if state_path.exists():
+                    state_path.unlink()
+                raise ValueError(f'hash mismatch downloading {url}: ' + \
+                    f'expected {digest}, got {actual}')
+            os.replace(part, dest)
+            if state_path.exists():
+                state_path.unlink()
+            return actual
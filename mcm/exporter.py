@@ -0,0 +1,258 @@
+"""
+prometheus exporter for every saved server. a collector thread samples
+/proc, rcon and the logs on an interval and renders a snapshot, which the
+http handler serves as is
+"""
+import os
+import re
+import sys
+import time
+import asyncio
+import threading
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from .rcon import RconPool, RconError
+from .saves import get_saves
+from .utils import get_worlds, find_java_processes, read_process
+
+
+TPS_PATTERN = re.compile(r'(\d+(?:\.\d+)?),?\s*\*?(\d+(?:\.\d+)?),?\s*\*?(\d+(?:\.\d+)?)\s*$')
+MSPT_PATTERN = re.compile(r'(\d+(?:\.\d+)?)/(\d+(?:\.\d+)?)/(\d+(?:\.\d+)?)')
+LIST_PATTERN = re.compile(r'(\d+) of a max(?: of)? (\d+)')
+COLOR_PATTERN = re.compile('§.')
+LAG_MARKER = b'Can\'t keep up!'
+RCON_TIMEOUT = 2
+# every metric and its prometheus type, in the order they are rendered
+METRICS = (
+    ('mcm_up', 'gauge'),
+    ('mcm_process_resident_bytes', 'gauge'),
+    ('mcm_process_cpu_seconds_total', 'counter'),
+    ('mcm_process_threads', 'gauge'),
+    ('mcm_tps', 'gauge'),
+    ('mcm_mspt', 'gauge'),
+    ('mcm_players_online', 'gauge'),
+    ('mcm_players_max', 'gauge'),
+    ('mcm_lag_warnings_total', 'counter'),
+    ('mcm_world_size_bytes', 'gauge'),
+    ('mcm_collect_duration_seconds', 'gauge'),
+)
+
+
+def get_world_size(save):
+    """
+    return the bytes on disk of a save's overworld, nether and end
+    """
+    total = 0
+    for world in get_worlds(save['path']):
+        for root, _, files in os.walk(Path(save['path'], world)):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_blocks * 512
+                except OSError:
+                    pass
+    return total
+
+
+def render(samples):
+    """
+    render samples, a dict of metric name to (labels, value) pairs, in the
+    prometheus text format with each metric's samples grouped together
+    """
+    lines = []
+    for metric, kind in METRICS:
+        if not samples.get(metric):
+            continue
+        lines.append(f'# TYPE {metric} {kind}')
+        for labels, value in samples[metric]:
+            lines.append(f'{metric}{{{labels}}} {value}' if labels else f'{metric} {value}')
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def strip_colors(text):
+    """
+    remove minecraft formatting codes
+    """
+    return COLOR_PATTERN.sub('', text)
+
+
+async def query_all(pool, saves):
+    """
+    query every save's server over rcon at once
+    """
+    return await asyncio.gather(*[query_rcon(pool, save) for save in saves])
+
+
+async def query_rcon(pool, save):
+    """
+    ask a server for tps, mspt and players. paper answers tps and mspt,
+    vanilla only answers list
+    """
+    metrics = {}
+    if 'rcon' not in save:
+        return metrics
+    try:
+        players = LIST_PATTERN.search(strip_colors(
+            await pool.command(save, 'list', RCON_TIMEOUT)))
+        if players:
+            metrics['players'], metrics['max_players'] = map(int, players.groups())
+        if save['fork'] == 'paper':
+            tps = TPS_PATTERN.search(strip_colors(
+                await pool.command(save, 'tps', RCON_TIMEOUT)).splitlines()[0])
+            if tps:
+                metrics['tps'] = dict(zip(('1m', '5m', '15m'), map(float, tps.groups())))
+            mspt = MSPT_PATTERN.search(strip_colors(
+                await pool.command(save, 'mspt', RCON_TIMEOUT)))
+            if mspt:
+                metrics['mspt'] = float(mspt.group(1))
+    except (OSError, RconError, IndexError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        pass
+    return metrics
+
+
+class Collector:
+    """
+    samples every saved server and keeps the latest rendered snapshot
+    """
+    def __init__(self, interval, world_interval):
+        self.interval = interval
+        self.world_interval = world_interval
+        self.snapshot = b''
+        self.ready = threading.Event()
+        self.pool = None
+        self.loop = None
+        self.world_sizes = {}
+        self.world_checked = 0
+        # per log file: inode, offset read so far, and lag warnings seen
+        self.logs = {}
+
+    def count_lag(self, save):
+        """
+        count lag warnings in latest.log, reading only what was appended
+        """
+        log = Path(save['path'], 'logs', 'latest.log')
+        try:
+            stat = log.stat()
+        except OSError:
+            return self.logs.get(save['name'], (None, 0, 0))[2]
+        inode, offset, count = self.logs.get(save['name'], (None, 0, 0))
+        if inode != stat.st_ino or stat.st_size < offset:
+            # rotated, keep the running total but start the new file over
+            offset = 0
+        with open(log, 'rb') as log_fd:
+            log_fd.seek(offset)
+            data = log_fd.read()
+        # only count complete lines, the rest is read next time
+        complete = data.rpartition(b'\n')[0]
+        count += complete.count(LAG_MARKER)
+        self.logs[save['name']] = (stat.st_ino, offset + len(complete) + (1 if complete else 0),
+            count)
+        return count
+
+    def collect(self):
+        """
+        sample every server and render the snapshot
+        """
+        start = time.time()
+        saves = get_saves()
+        processes = find_java_processes()
+        if time.time() - self.world_checked >= self.world_interval:
+            self.world_sizes = {save['name']: get_world_size(save) for save in saves}
+            self.world_checked = time.time()
+        rcon = self.loop.run_until_complete(query_all(self.pool, saves))
+
+        samples = {metric: [] for metric, _ in METRICS}
+        for save, server_rcon in zip(saves, rcon):
+            labels = f'server="{save["name"]}",fork="{save["fork"]}"'
+            pid = processes.get(os.path.realpath(save['path']))
+            process = None
+            if pid is not None:
+                try:
+                    process = read_process(pid)
+                except OSError:
+                    pass
+            samples['mcm_up'].append((labels, 1 if process else 0))
+            if process:
+                samples['mcm_process_resident_bytes'].append((labels, process['rss']))
+                samples['mcm_process_cpu_seconds_total'].append((labels, process['cpu']))
+                samples['mcm_process_threads'].append((labels, process['threads']))
+            for window, tps in server_rcon.get('tps', {}).items():
+                samples['mcm_tps'].append((f'{labels},window="{window}"', tps))
+            if 'mspt' in server_rcon:
+                samples['mcm_mspt'].append((labels, server_rcon['mspt']))
+            if 'players' in server_rcon:
+                samples['mcm_players_online'].append((labels, server_rcon['players']))
+                samples['mcm_players_max'].append((labels, server_rcon['max_players']))
+            samples['mcm_lag_warnings_total'].append((labels, self.count_lag(save)))
+            if save['name'] in self.world_sizes:
+                samples['mcm_world_size_bytes'].append((labels, self.world_sizes[save['name']]))
+        samples['mcm_collect_duration_seconds'].append((None, f'{time.time() - start:.6f}'))
+        self.snapshot = render(samples)
+
+    def run(self):
+        """
+        collect forever on the interval. the event loop and rcon connections
+        live on this thread for its whole life
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.pool = RconPool()
+        while True:
+            started = time.time()
+            try:
+                self.collect()
+            except Exception as err: # pylint: disable=broad-except
+                print(f'collection failed: {err}', file=sys.stderr)
+            self.ready.set()
+            time.sleep(max(self.interval - (time.time() - started), 0))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    http server handling each scrape on its own thread
+    """
+    daemon_threads = True
+
+
+def make_handler(collector):
+    """
+    build a request handler serving the collector's snapshot
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """
+        serves /metrics from the last snapshot, doing no i/o of its own
+        """
+        def do_GET(self): # pylint: disable=invalid-name
+            """
+            answer a scrape
+            """
+            if self.path.partition('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            snapshot = collector.snapshot
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(snapshot)))
+            self.end_headers()
+            self.wfile.write(snapshot)
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            pass
+
+    return MetricsHandler
+
+
+def run_exporter(args):
+    """
+    start the collector thread and serve /metrics
+    """
+    collector = Collector(args.interval, args.world_interval)
+    threading.Thread(target=collector.run, daemon=True).start()
+    collector.ready.wait()
+    server = ThreadingHTTPServer((args.bind, args.port), make_handler(collector))
+    print(f'serving metrics on http://{args.bind}:{args.port}/metrics')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,156 @@
+"""
+resolve forge versions from the machine-readable promotions and maven
+metadata, falling back to scraping the files.minecraftforge.net index
+"""
+import codecs
+from html.parser import HTMLParser
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+from xml.etree import ElementTree
+
+from .metadata import is_offline
+from .profile import span
+from .utils import upstream
+from .versions import FORGE_FILES, FORGE_MAVEN, get_index, forge_version, version_key, \
+    latest_matching, is_pattern
+
+
+BLOCK_SIZE = 16 * 1024
+
+
+def universal_url(full_version):
+    """
+    return the maven url of the universal jar for a full forge version
+    """
+    return f'{FORGE_MAVEN}/{full_version}/forge-{full_version}-universal.jar'
+
+
+def target(link):
+    """
+    build the resolved target for a universal jar link
+    """
+    version = forge_version(link.partition('/forge/')[2].partition('/')[0])
+    return {
+        'fork': 'forge',
+        'version': version,
+        'url': upstream(link),
+        'jar': f'forge-{version}.jar',
+        'hash': None,
+    }
+
+
+def resolve_from_metadata(version_arg):
+    """
+    resolve a version argument against the indexed promotions and maven versions
+    """
+    index = get_index('forge')
+    if is_pattern(version_arg):
+        latest = latest_matching('forge', index, version_arg)
+        if latest is None:
+            raise ValueError(f'invalid forge version {version_arg}')
+        version_arg = latest
+    if version_arg is not None and '-' in version_arg:
+        wanted = version_arg
+    else:
+        promos = index['promos']
+        if version_arg is None or version_arg == 'latest':
+            mc_version = max((key.partition('-')[0] for key in promos), key=version_key)
+        else:
+            mc_version = version_arg
+        # only latest asks for the newest build, anything else gets the recommended one
+        # when there is one
+        if version_arg == 'latest':
+            build = promos[f'{mc_version}-latest']
+        else:
+            build = promos.get(f'{mc_version}-recommended', promos.get(f'{mc_version}-latest'))
+            if build is None:
+                raise ValueError(f'invalid forge version {version_arg}')
+        wanted = f'{mc_version}-{build}'
+
+    # old builds carry the minecraft version again as a suffix in maven
+    full_versions = {forge_version(full_version): full_version for full_version in index['versions']}
+    if wanted not in full_versions:
+        raise ValueError(f'invalid build {version_arg}')
+    return target(universal_url(full_versions[wanted]))
+
+
+class LinkFinder(HTMLParser): # pylint: disable=abstract-method
+    """
+    incremental parser that pulls the wanted universal jar link out of a forge
+    index page and marks itself done as soon as it has it
+    """
+    def __init__(self, version_arg):
+        super().__init__()
+        self.build = version_arg if version_arg is not None and '-' in version_arg else None
+        # the first download block is latest, the second recommended
+        self.block = 0 if version_arg == 'latest' else 1
+        self.blocks = []
+        self.depth = 0
+        self.link = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'div' and self.depth:
+            self.depth += 1
+        elif tag == 'div' and 'download' in (attrs.get('class') or '').split():
+            self.depth = 1
+            self.blocks.append(None)
+        elif tag == 'a' and attrs.get('href'):
+            href = attrs['href'].partition('url=')[2] or attrs['href']
+            if self.build is not None:
+                if self.link is None and 'universal' in href and f'/{self.build}' in href:
+                    self.link = href
+            elif self.depth and 'url=' in attrs['href']:
+                # the last link of a download block is the one we want
+                self.blocks[-1] = href
+
+    def handle_endtag(self, tag):
+        if tag == 'div' and self.depth:
+            self.depth -= 1
+            if not self.depth and len(self.blocks) - 1 == self.block:
+                self.link = self.blocks[-1]
+
+    def close(self):
+        super().close()
+        # pages with a single download block have no recommended build
+        if self.link is None and self.build is None and self.blocks:
+            self.link = self.blocks[0]
+
+
+def resolve_from_page(version_arg):
+    """
+    stream a forge index page, stopping as soon as the wanted link is found
+    """
+    if version_arg is None or version_arg == 'latest':
+        url = f'{FORGE_FILES}/'
+    else:
+        url = f'{FORGE_FILES}/maven/net/minecraftforge/forge/index_{version_arg.partition("-")[0]}.html'
+    finder = LinkFinder(version_arg)
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    try:
+        with span('forge.page', url=url) as timing, urlopen(url) as response:
+            for block in iter(lambda: response.read(BLOCK_SIZE), b''):
+                timing.add('bytes', len(block))
+                finder.feed(decoder.decode(block))
+                if finder.link is not None:
+                    break
+            else:
+                finder.close()
+    except HTTPError:
+        raise ValueError(f'invalid forge version {version_arg}') from None
+    if finder.link is None:
+        raise ValueError(f'invalid build {version_arg}')
+    return target(finder.link)
+
+
+def resolve_forge(version_arg):
+    """
+    resolve a forge version to its universal jar. forge publishes no hash
+    """
+    try:
+        return resolve_from_metadata(version_arg)
+    except (URLError, ElementTree.ParseError, KeyError) as err:
+        if is_offline():
+            raise ValueError(f'could not resolve forge {version_arg} offline: {err}') from None
+        print(f'forge metadata unavailable ({err}), falling back to the files index')
+        return resolve_from_page(version_arg)
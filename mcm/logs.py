@@ -0,0 +1,379 @@
+"""
+search the logs of saved servers. rotated logs are decompressed in a process
+pool, latest.log is mmapped, and a sidecar index of where each hour starts
+lets time bounded searches skip whole files
+"""
+import os
+import re
+import sys
+import json
+import gzip
+import mmap
+import time
+import bisect
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from .saves import get_targets
+
+
+INDEX_NAME = '.mcm-index.json'
+CHUNK_SIZE = 4 * 1024 * 1024
+ROTATED_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})-(\d+)\.log\.gz')
+LINE_TIME = re.compile(rb'\[(\d\d):(\d\d):(\d\d)\]')
+FIRST_HOUR = re.compile(rb'^\[(\d\d):\d\d:\d\d\]', re.M)
+# the next line stamped with any hour but the given one
+HOUR_CHANGES = [re.compile(rb'^\[(?!%02d:)(\d\d):\d\d:\d\d\]' % hour, re.M) for hour in range(24)]
+EVERY_LINE = rb'^.'
+RELATIVE_TIME = re.compile(r'(\d+)([smhd])')
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M',
+    '%Y-%m-%d')
+
+
+def parse_time(text, now=None):
+    """
+    parse a time given as 2h, 30m or 3d ago, as HH:MM today, or as a date
+    with an optional time
+    """
+    now = now or datetime.now()
+    match = RELATIVE_TIME.fullmatch(text)
+    if match:
+        unit = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2)]
+        return now - timedelta(**{unit: int(match.group(1))})
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(text, time_format)
+        except ValueError:
+            pass
+    try:
+        return datetime.combine(now.date(), datetime.strptime(text, '%H:%M').time())
+    except ValueError:
+        raise ValueError(f'could not understand time {text}') from None
+
+
+def index_hours(buffer, start, end, offset, hours):
+    """
+    append [offset, day, hour] to hours for every line in buffer[start:end]
+    whose hour differs from the line before it. days count from the first
+    line, going up whenever the clock wraps past midnight
+    """
+    pos = start
+    while pos < end:
+        _, day, current = hours[-1] if hours else (None, 0, None)
+        pattern = FIRST_HOUR if current is None else HOUR_CHANGES[current]
+        match = pattern.search(buffer, pos, end)
+        if match is None:
+            return
+        hour = int(match.group(1))
+        if current is not None and hour < current:
+            day += 1
+        hours.append([offset + match.start(), day, hour])
+        pos = match.end()
+
+
+def hour_times(entry):
+    """
+    return the start time of every indexed hour of a file
+    """
+    base = datetime.strptime(entry['base'], '%Y-%m-%d')
+    return [base + timedelta(days=day, hours=hour)
+        for _, day, hour in entry['hours']]
+
+
+def get_bounds(entry, times, since, until):
+    """
+    return the offsets between which lines from since to until can be found
+    """
+    offsets = [offset for offset, _, _ in entry['hours']]
+    first = bisect.bisect_right(times, since) - 1
+    last = bisect.bisect_right(times, until)
+    return offsets[first] if first > 0 else 0, \
+        offsets[last] if last < len(offsets) else None
+
+
+def line_time(buffer, line_start, line, hour_start):
+    """
+    return the time of a line. lines without a stamp, such as stack traces,
+    take the time of the nearest stamped line above them
+    """
+    match = LINE_TIME.match(line)
+    if match is None:
+        above = buffer.rfind(b'\n[', 0, line_start)
+        match = LINE_TIME.match(buffer, above + 1) if above != -1 else None
+    if match is None:
+        return hour_start
+    return hour_start.replace(hour=int(match.group(1)), minute=int(match.group(2)),
+        second=int(match.group(3)))
+
+
+def search_buffer(buffer, pattern, span, offset, entry, limits):
+    """
+    return (time, line) for every line of buffer[start:end] matching pattern
+    and stamped between since and until
+    """
+    (start, end), (since, until) = span, limits
+    offsets = [item[0] for item in entry['hours']]
+    times = hour_times(entry)
+    matches = []
+    pos = start
+    while pos < end:
+        match = pattern.search(buffer, pos, end)
+        if match is None:
+            break
+        line_start = buffer.rfind(b'\n', 0, match.start()) + 1
+        line_end = buffer.find(b'\n', match.end(), end)
+        line_end = end if line_end == -1 else line_end
+        line = buffer[line_start:line_end]
+        pos = line_end + 1
+        index = bisect.bisect_right(offsets, offset + line_start) - 1
+        hour_start = times[max(index, 0)] if times else datetime.min
+        stamp = line_time(buffer, line_start, line, hour_start)
+        if since <= stamp <= until:
+            matches.append((stamp, line.rstrip(b'\r').decode('utf-8', 'replace')))
+    return matches
+
+
+def get_base(path, hours, mtime):
+    """
+    return the date of the first line of a log. rotated logs carry it in
+    their name, latest.log counts back from when it was last written
+    """
+    match = ROTATED_PATTERN.fullmatch(Path(path).name)
+    if match:
+        return match.group(1)
+    modified = datetime.fromtimestamp(mtime)
+    if not hours:
+        return modified.date().isoformat()
+    _, days, hour = hours[-1]
+    # the last stamped hour is later in the day than the write, so it was yesterday
+    days += hour > modified.hour
+    return (modified.date() - timedelta(days=days)).isoformat()
+
+
+def search_plain(path, pattern, limits, entry):
+    """
+    search an uncompressed log through mmap, extending its index from where
+    it was last indexed
+    """
+    with open(path, 'rb') as log:
+        stat = os.fstat(log.fileno())
+        if stat.st_size == 0:
+            return [], {'inode': stat.st_ino, 'size': 0, 'mtime': stat.st_mtime,
+                'base': get_base(path, [], stat.st_mtime), 'hours': [], 'tail': 0}
+        with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            # a line being written right now is left for the next search
+            tail = buffer.rfind(b'\n') + 1
+            if entry is None or entry['inode'] != stat.st_ino or entry['tail'] > tail:
+                entry = {'hours': [], 'tail': 0}
+            hours = [list(item) for item in entry['hours']]
+            index_hours(buffer, entry['tail'], tail, 0, hours)
+            entry = {'inode': stat.st_ino, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'base': entry.get('base') or get_base(path, hours, stat.st_mtime),
+                'hours': hours, 'tail': tail}
+            start, end = get_bounds(entry, hour_times(entry), *limits)
+            end = tail if end is None else end
+            return search_buffer(buffer, pattern, (start, end), 0, entry, limits), entry
+
+
+def search_gzip(path, pattern, limits, entry):
+    """
+    stream decompress a rotated log and search it a chunk at a time. with an
+    index, decompression stops once past until
+    """
+    stat = os.stat(path)
+    if entry is not None and (entry['inode'], entry['size'], entry['mtime']) != \
+            (stat.st_ino, stat.st_size, stat.st_mtime):
+        entry = None
+    building = entry is None
+    if building:
+        entry = {'inode': stat.st_ino, 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'base': get_base(path, [], stat.st_mtime), 'hours': []}
+        start, end = 0, None
+    else:
+        start, end = get_bounds(entry, hour_times(entry), *limits)
+
+    matches = []
+    offset = 0
+    carry = b''
+    with gzip.open(path, 'rb') as log:
+        while building or end is None or offset < end:
+            data = log.read(CHUNK_SIZE)
+            eof = not data
+            data = carry + data
+            if not data:
+                break
+            cut = len(data) if eof else data.rfind(b'\n') + 1
+            chunk, carry = data[:cut], data[cut:]
+            if building:
+                index_hours(chunk, 0, len(chunk), offset, entry['hours'])
+            low = max(start - offset, 0)
+            high = len(chunk) if end is None else min(end - offset, len(chunk))
+            if low < high:
+                matches.extend(search_buffer(chunk, pattern, (low, high), offset, entry, limits))
+            offset += len(chunk)
+            if eof:
+                break
+    return matches, entry
+
+
+def search_file(path, pattern, flags, limits, entry):
+    """
+    search one log file, returning the matches and the file's updated index
+    """
+    pattern = re.compile(pattern, flags | re.M)
+    if path.endswith('.gz'):
+        return search_gzip(path, pattern, limits, entry)
+    return search_plain(path, pattern, limits, entry)
+
+
+def get_log_files(logs):
+    """
+    return the rotated logs of a server oldest first, then latest.log
+    """
+    rotated = []
+    for path in logs.glob('*.log.gz'):
+        match = ROTATED_PATTERN.fullmatch(path.name)
+        if match:
+            rotated.append((match.group(1), int(match.group(2)), path))
+    files = [path for _, _, path in sorted(rotated)]
+    if Path(logs, 'latest.log').exists():
+        files.append(Path(logs, 'latest.log'))
+    return files
+
+
+def load_index(logs):
+    """
+    load a server's log index, a dict of file name to entry
+    """
+    try:
+        with open(Path(logs, INDEX_NAME), 'r') as file:
+            return json.loads(file.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(logs, index):
+    """
+    write a server's log index, quietly giving up if the logs aren't writable
+    """
+    tmp = Path(logs, f'{INDEX_NAME}.{os.getpid()}')
+    try:
+        with open(tmp, 'wt') as file:
+            file.write(json.dumps(index))
+        os.replace(tmp, Path(logs, INDEX_NAME))
+    except OSError:
+        pass
+
+
+def can_skip(path, entry, since, until):
+    """
+    whether a file's index shows it has nothing between since and until
+    """
+    if entry is None or not entry['hours'] or path.name == 'latest.log':
+        return False
+    stat = path.stat()
+    if (entry['inode'], entry['size'], entry['mtime']) != \
+            (stat.st_ino, stat.st_size, stat.st_mtime):
+        return False
+    times = hour_times(entry)
+    return until < times[0] or since >= times[-1] + timedelta(hours=1)
+
+
+def search_logs(saves, pattern, flags, limits, workers):
+    """
+    search every save's logs at once, returning (time, name, line) sorted by
+    time
+    """
+    from concurrent.futures import ProcessPoolExecutor # pylint: disable=import-outside-toplevel
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        jobs = []
+        for save in saves:
+            logs = Path(save['path'], 'logs')
+            index = load_index(logs)
+            for path in get_log_files(logs):
+                entry = index.get(path.name)
+                if not can_skip(path, entry, *limits):
+                    jobs.append((save['name'], logs, index, path.name, executor.submit(
+                        search_file, str(path), pattern, flags, limits, entry)))
+        changed = {}
+        for name, logs, index, file_name, job in jobs:
+            try:
+                matches, entry = job.result()
+            except OSError as err:
+                print(f'could not read {Path(logs, file_name)}: {err}', file=sys.stderr)
+                continue
+            results.extend((stamp, name, line) for stamp, line in matches)
+            if index.get(file_name) != entry:
+                index[file_name] = entry
+                changed[str(logs)] = (logs, index)
+    for logs, index in changed.values():
+        present = {path.name for path in get_log_files(logs)}
+        save_index(logs, {name: entry for name, entry in index.items() if name in present})
+    results.sort(key=lambda result: result[0])
+    return results
+
+
+def follow_logs(saves, pattern, prefix):
+    """
+    print matching lines as they are appended to each save's latest.log
+    """
+    positions = {}
+    for save in saves:
+        path = Path(save['path'], 'logs', 'latest.log')
+        try:
+            stat = path.stat()
+            positions[save['name']] = (stat.st_ino, stat.st_size)
+        except OSError:
+            positions[save['name']] = (None, 0)
+    try:
+        while True:
+            for save in saves:
+                path = Path(save['path'], 'logs', 'latest.log')
+                inode, offset = positions[save['name']]
+                try:
+                    stat = path.stat()
+                    if stat.st_ino != inode or stat.st_size < offset:
+                        # rotated, the new file is read from the start
+                        offset = 0
+                    with open(path, 'rb') as log:
+                        log.seek(offset)
+                        data = log.read()
+                except OSError:
+                    continue
+                complete = data[:data.rfind(b'\n') + 1]
+                positions[save['name']] = (stat.st_ino, offset + len(complete))
+                for line in complete.splitlines():
+                    if pattern.search(line):
+                        text = line.decode('utf-8', 'replace')
+                        print(f'{save["name"]}: {text}' if prefix else text, flush=True)
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+
+
+def handle_logs(args):
+    """
+    search one or every save's logs, then optionally follow them
+    """
+    try:
+        saves = get_targets(args.name, args.all, args.match)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    try:
+        limits = (parse_time(args.since) if args.since else datetime.min,
+            parse_time(args.until) if args.until else datetime.max)
+        flags = re.I if args.ignore_case else 0
+        pattern = args.grep.encode('utf-8') if args.grep else EVERY_LINE
+        compiled = re.compile(pattern, flags)
+    except (ValueError, re.error) as err:
+        print(err)
+        sys.exit(1)
+
+    prefix = len(saves) > 1
+    for stamp, name, line in search_logs(saves, pattern, flags, limits, args.workers):
+        day = stamp.date().isoformat() if stamp != datetime.min else '?'
+        print(f'{name}: {day} {line}' if prefix else f'{day} {line}')
+    if args.follow:
+        follow_logs(saves, compiled, prefix)
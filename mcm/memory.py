@@ -0,0 +1,149 @@
+"""
+plan jvm heap sizes across every saved server so they fit in host ram together
+"""
+import os
+import re
+import sys
+from pathlib import Path
+
+from .saves import get_saves, update_save, get_save_from_name
+from .scripts import rewrite_start_script
+
+
+# ram kept back for the os and page cache, at least this many MiB or this share of ram
+OS_HEADROOM = 2048
+OS_HEADROOM_RATIO = 0.1
+# memory a jvm uses beyond its heap: metaspace, code cache, thread stacks, direct buffers
+OFF_HEAP_BASE = 512
+OFF_HEAP_RATIO = 0.2
+MIN_HEAP = 1024
+DEFAULT_MAX_HEAP = 6 * 1024
+# heaps are rounded down to this many MiB
+HEAP_STEP = 256
+
+
+def get_host_ram():
+    """
+    return physical ram in MiB
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+
+
+def get_budget(ram):
+    """
+    return the MiB of ram available to jvms, heap and off-heap together
+    """
+    return ram - max(OS_HEADROOM, int(ram * OS_HEADROOM_RATIO))
+
+
+def footprint(heap):
+    """
+    return the expected resident size of a jvm with the given heap
+    """
+    return heap * (1 + OFF_HEAP_RATIO) + OFF_HEAP_BASE
+
+
+def plan_heaps(saves, budget):
+    """
+    split the budget between saves by weight, clamping each heap between
+    MIN_HEAP and the save's max_heap and handing what capped servers can't
+    use to the rest. returns a dict of name to heap in MiB
+    """
+    heaps = {}
+    pending = list(saves)
+    # what's left for heaps once every jvm's fixed off-heap cost is paid
+    remaining = (budget - OFF_HEAP_BASE * len(saves)) / (1 + OFF_HEAP_RATIO)
+    while pending:
+        total_weight = sum(save.get('weight', 1) for save in pending)
+        share = {save['name']: remaining * save.get('weight', 1) / total_weight
+            for save in pending}
+        clamped = [save for save in pending if \
+            not MIN_HEAP <= share[save['name']] <= save.get('max_heap', DEFAULT_MAX_HEAP)]
+        if not clamped:
+            heaps.update(share)
+            break
+        for save in clamped:
+            heaps[save['name']] = min(max(share[save['name']], MIN_HEAP),
+                save.get('max_heap', DEFAULT_MAX_HEAP))
+            remaining -= heaps[save['name']]
+            pending.remove(save)
+    return {name: int(heap // HEAP_STEP * HEAP_STEP) for name, heap in heaps.items()}
+
+
+def get_current_heap(save):
+    """
+    return the heap a save's start script currently asks for, in MiB
+    """
+    if 'heap' in save:
+        return save['heap']
+    try:
+        with open(Path(save['path'], 'start.sh'), 'r') as script_fd:
+            match = re.search(r'-Xmx(\d+)([MG])', script_fd.read())
+    except OSError:
+        return None
+    if match is None:
+        return None
+    return int(match.group(1)) * (1024 if match.group(2) == 'G' else 1)
+
+
+def parse_assignments(assignments, option):
+    """
+    parse NAME=NUMBER arguments into a dict
+    """
+    parsed = {}
+    for assignment in assignments or []:
+        name, _, value = assignment.partition('=')
+        if get_save_from_name(name) is None:
+            print(f'could not find save with name {name}')
+            sys.exit(1)
+        try:
+            parsed[name] = float(value)
+        except ValueError:
+            print(f'invalid {option} "{assignment}", expected NAME=NUMBER')
+            sys.exit(1)
+    return parsed
+
+
+def plan_memory(args):
+    """
+    print the heap plan for every save and optionally apply it
+    """
+    for name, weight in parse_assignments(args.weight, '--weight').items():
+        update_save(name, weight=weight)
+    for name, max_heap in parse_assignments(args.max_heap, '--max-heap').items():
+        update_save(name, max_heap=int(max_heap * 1024))
+
+    saves = get_saves()
+    if not saves:
+        print('no saved servers to plan for')
+        return
+    ram = get_host_ram()
+    budget = get_budget(ram)
+    heaps = plan_heaps(saves, budget)
+    used = sum(footprint(heap) for heap in heaps.values())
+    print(f'host ram {ram} MiB, {budget} MiB for servers, {int(used)} MiB planned')
+    if used > budget:
+        print('warning: even minimum heaps overcommit this host, ' + \
+            'consider moving servers elsewhere')
+
+    changed = []
+    for save in saves:
+        current = get_current_heap(save)
+        heap = heaps[save['name']]
+        print(f'{save["name"]}: weight {save.get("weight", 1):g}, ' + \
+            f'heap {current if current is not None else "?"} -> {heap} MiB')
+        if current != heap:
+            changed.append(save)
+
+    if not args.apply:
+        if changed:
+            print('run with --apply to write these heap sizes to the start scripts')
+        return
+    for save in changed:
+        update_save(save['name'], heap=heaps[save['name']])
+        try:
+            rewrite_start_script(get_save_from_name(save['name']))
+        except (OSError, ValueError) as err:
+            print(f'could not rewrite start script for {save["name"]}: {err}')
+    print(f'updated {len(changed)} start scripts. ' + \
+        'if you\'re using systemd, be sure to restart the changed servers')
@@ -0,0 +1,135 @@
+"""
+persistent http cache for version manifests and build lists
+"""
+import os
+import time
+import json
+import hashlib
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from .profile import span
+from .utils import CACHE_DIR, upstream
+
+
+META_DIR = Path(CACHE_DIR, 'meta')
+
+# seconds a cached response is trusted before it is revalidated, by url prefix.
+# per-version documents from mojang never change once published
+TTLS = (
+    (upstream('https://launchermeta.mojang.com/mc/game/version_manifest.json'), 10 * 60),
+    (upstream('https://launchermeta.mojang.com/'), 30 * 24 * 60 * 60),
+    (upstream('https://papermc.io/'), 5 * 60),
+    (upstream('https://files.minecraftforge.net/'), 30 * 60),
+    (upstream('https://maven.minecraftforge.net/'), 30 * 60),
+)
+DEFAULT_TTL = 10 * 60
+
+OFFLINE = False
+
+
+def set_offline(offline):
+    """
+    resolve metadata only from the cache when offline is set
+    """
+    global OFFLINE # pylint: disable=global-statement
+    OFFLINE = offline
+
+
+def is_offline():
+    """
+    return whether network access has been disabled
+    """
+    return OFFLINE
+
+
+def get_ttl(url):
+    """
+    return how long a response for url stays fresh
+    """
+    return next((ttl for prefix, ttl in TTLS if url.startswith(prefix)), DEFAULT_TTL)
+
+
+def entry_path(url):
+    """
+    return the cache file for a url
+    """
+    return Path(META_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def load_entry(url):
+    """
+    load the cached response for a url, if any
+    """
+    path = entry_path(url)
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'r') as file:
+            return json.loads(file.read())
+    except ValueError:
+        return None
+
+
+def store_entry(url, entry):
+    """
+    atomically write the cached response for a url
+    """
+    META_DIR.mkdir(parents=True, exist_ok=True)
+    path = entry_path(url)
+    tmp = Path(META_DIR, f'.{path.name}.{os.getpid()}')
+    with open(tmp, 'wt') as file:
+        file.write(json.dumps(entry))
+    os.replace(tmp, path)
+
+
+def get_text(url):
+    """
+    return the body of url, revalidating the cached copy with a conditional
+    request once its ttl has passed
+    """
+    with span('metadata.get', url=url) as timing:
+        entry = load_entry(url)
+        if entry is not None and (OFFLINE or time.time() - entry['fetched'] < get_ttl(url)):
+            timing.add('cache_hits')
+            return entry['body']
+        if OFFLINE:
+            raise ValueError(f'{url} is not cached and --offline was given')
+
+        request = Request(url)
+        if entry is not None and entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        if entry is not None and entry.get('last_modified'):
+            request.add_header('If-Modified-Since', entry['last_modified'])
+        try:
+            with urlopen(request) as response:
+                body = response.read()
+                entry = {
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'body': body.decode('utf-8'),
+                }
+            timing.add('cache_misses')
+            timing.add('bytes', len(body))
+        except HTTPError as err:
+            if err.code != 304 or entry is None:
+                raise
+            timing.add('revalidated')
+        except URLError as err:
+            # a stale answer beats no answer when upstream is unreachable
+            if entry is None:
+                raise
+            print(f'could not reach {url} ({err.reason}), using cached copy')
+            return entry['body']
+        entry['fetched'] = time.time()
+        store_entry(url, entry)
+        return entry['body']
+
+
+def get_json(url):
+    """
+    fetch and decode a json document through the cache
+    """
+    return json.loads(get_text(url))
@@ -0,0 +1,157 @@
+"""
+query servers with the minecraft server list ping protocol
+"""
+import os
+import json
+import time
+import struct
+import asyncio
+from pathlib import Path
+
+from .utils import CACHE_DIR, read_properties, run_async
+
+
+STATUS_CACHE = Path(CACHE_DIR, 'status.json')
+DEFAULT_PORT = 25565
+# any protocol version works for a status request, -1 is the convention
+PROTOCOL_VERSION = -1
+
+
+def pack_varint(value):
+    """
+    encode an int as a protocol varint
+    """
+    value &= 0xFFFFFFFF
+    data = b''
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        data += struct.pack('B', byte | (0x80 if value else 0))
+        if not value:
+            return data
+
+
+async def read_varint(reader):
+    """
+    read a protocol varint from a stream
+    """
+    value = 0
+    for shift in range(0, 35, 7):
+        byte = (await reader.readexactly(1))[0]
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value
+    raise ValueError('varint too long')
+
+
+def pack_packet(packet_id, payload=b''):
+    """
+    frame a packet with its length and id
+    """
+    body = pack_varint(packet_id) + payload
+    return pack_varint(len(body)) + body
+
+
+def get_address(save):
+    """
+    return the host and port a save's server listens on
+    """
+    properties = read_properties(save['path'])
+    return properties.get('server-ip') or '127.0.0.1', \
+        int(properties.get('server-port') or DEFAULT_PORT)
+
+
+def flatten_motd(description):
+    """
+    turn a chat component motd into plain text
+    """
+    if isinstance(description, str):
+        return description
+    return description.get('text', '') + \
+        ''.join(flatten_motd(extra) for extra in description.get('extra', []))
+
+
+async def ping(host, port):
+    """
+    ask a server for its status and measure the round trip of a ping
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        encoded_host = host.encode('utf-8')
+        writer.write(pack_packet(0x00, pack_varint(PROTOCOL_VERSION) + \
+            pack_varint(len(encoded_host)) + encoded_host + struct.pack('>H', port) + \
+            pack_varint(1)))
+        writer.write(pack_packet(0x00))
+        await writer.drain()
+        await read_varint(reader)
+        await read_varint(reader)
+        status = json.loads((await reader.readexactly(await read_varint(reader))).decode('utf-8'))
+
+        start = time.monotonic()
+        writer.write(pack_packet(0x01, struct.pack('>q', int(start))))
+        await writer.drain()
+        await read_varint(reader)
+        await read_varint(reader)
+        await reader.readexactly(8)
+        latency = (time.monotonic() - start) * 1000
+    finally:
+        writer.close()
+    return {
+        'online': True,
+        'players': status.get('players', {}).get('online', 0),
+        'max_players': status.get('players', {}).get('max', 0),
+        'motd': flatten_motd(status.get('description', '')),
+        'version': status.get('version', {}).get('name', ''),
+        'latency': round(latency, 1),
+    }
+
+
+async def ping_save(save, timeout):
+    """
+    ping a save's server, reporting it offline on any error or timeout
+    """
+    try:
+        return await asyncio.wait_for(ping(*get_address(save)), timeout)
+    except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+        return {'online': False, 'error': str(err) or type(err).__name__}
+
+
+async def ping_saves(saves, timeout):
+    """
+    ping every save at once, returning a dict of name to status
+    """
+    results = await asyncio.gather(*[ping_save(save, timeout) for save in saves])
+    return {save['name']: result for save, result in zip(saves, results)}
+
+
+def get_statuses(saves, timeout, max_age=0):
+    """
+    return the status of every save, reusing a cached result younger than max_age
+    """
+    if max_age and STATUS_CACHE.exists():
+        try:
+            with open(STATUS_CACHE, 'r') as file:
+                cached = json.loads(file.read())
+            if time.time() - cached['time'] < max_age and \
+                    all(save['name'] in cached['results'] for save in saves):
+                return cached['results']
+        except (OSError, ValueError, KeyError):
+            pass
+    results = run_async(ping_saves(saves, timeout))
+    if max_age:
+        STATUS_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(STATUS_CACHE.parent, f'.status.json.{os.getpid()}')
+        with open(tmp, 'wt') as file:
+            file.write(json.dumps({'time': time.time(), 'results': results}))
+        os.replace(tmp, STATUS_CACHE)
+    return results
+
+
+def format_status(status):
+    """
+    describe a status on one line
+    """
+    if not status['online']:
+        return 'offline'
+    return f'online, {status["players"]}/{status["max_players"]} players, ' + \
+        f'{status["latency"]:g} ms, "{status["motd"]}"'
@@ -0,0 +1,139 @@
+"""
+give each saved server its own cpus, numa-local where the topology allows,
+and matching cgroup limits in its systemd unit
+"""
+import os
+from pathlib import Path
+
+from .memory import footprint, get_current_heap
+from .saves import get_saves, update_save, get_save_from_name
+from .scripts import rewrite_start_script, create_systemd_file
+
+
+NODE_DIR = Path('/sys/devices/system/node')
+
+
+def parse_cpulist(cpulist):
+    """
+    parse a kernel cpu list such as 0-3,8-11 into a list of cpus
+    """
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """
+    format cpus as a compact kernel cpu list
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(start) if start == end else f'{start}-{end}' for start, end in ranges)
+
+
+def get_topology(reserved=0):
+    """
+    return the usable cpus grouped by numa node, leaving the first
+    reserved cpus to the os
+    """
+    usable = sorted(os.sched_getaffinity(0))[reserved:]
+    nodes = []
+    for node in sorted(NODE_DIR.glob('node[0-9]*'), key=lambda node: int(node.name[4:])):
+        cpus = [cpu for cpu in parse_cpulist(Path(node, 'cpulist').read_text()) if cpu in usable]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [usable]
+
+
+def plan_cpus(saves, nodes):
+    """
+    split every cpu between saves by weight, placing each server inside a
+    single numa node when one has room and spilling into the next node when
+    none does. servers share cpus only when there are more servers than
+    cpus. returns a dict of name to cpu list
+    """
+    total = sum(len(node) for node in nodes)
+    total_weight = sum(save.get('weight', 1) for save in saves)
+    shares = {save['name']: total * save.get('weight', 1) / total_weight for save in saves}
+    counts = {name: max(int(share), 1) for name, share in shares.items()}
+    # hand the cpus lost to rounding to the servers that lost the most
+    spare = total - sum(counts.values())
+    for name in sorted(counts, key=lambda name: counts[name] - shares[name])[:max(spare, 0)]:
+        counts[name] += 1
+    # servers raised to one cpu are paid for by the biggest, while there are enough cpus
+    while sum(counts.values()) > max(total, len(counts)):
+        counts[max(counts, key=counts.get)] -= 1
+    free = [list(node) for node in nodes]
+    placed = {}
+    # biggest servers first, each into the node with the most free cpus
+    for save in sorted(saves, key=lambda save: -counts[save['name']]):
+        cpus = []
+        while len(cpus) < counts[save['name']]:
+            if not any(free):
+                # more servers than cpus, start handing out cpus again
+                free = [[cpu for cpu in node if cpu not in cpus] for node in nodes]
+            node = max(free, key=len)
+            taken = node[:counts[save['name']] - len(cpus)]
+            del node[:len(taken)]
+            cpus += taken
+        placed[save['name']] = cpus
+    return placed
+
+
+def get_resources(save, cpus):
+    """
+    return the systemd resource controls for a server pinned to cpus
+    """
+    weight = save.get('weight', 1)
+    resources = {
+        'CPUAffinity': format_cpulist(cpus).replace(',', ' '),
+        'AllowedCPUs': format_cpulist(cpus),
+        'CPUWeight': min(max(int(100 * weight), 1), 10000),
+        'IOWeight': min(max(int(100 * weight), 1), 10000),
+    }
+    heap = get_current_heap(save)
+    if heap is not None:
+        resources['MemoryMax'] = f'{int(footprint(heap))}M'
+    return resources
+
+
+def plan_placement(args):
+    """
+    print the cpu placement for every save and optionally apply it
+    """
+    saves = get_saves()
+    if not saves:
+        print('no saved servers to place')
+        return
+    nodes = get_topology(args.reserve)
+    placed = plan_cpus(saves, nodes)
+    print(f'{sum(len(node) for node in nodes)} usable cpus on {len(nodes)} numa nodes')
+    if len(saves) > sum(len(node) for node in nodes):
+        print('warning: more servers than cpus, some servers will share cpus')
+
+    for save in saves:
+        current = format_cpulist(save['cpus']) if 'cpus' in save else 'all'
+        print(f'{save["name"]}: cpus {current} -> {format_cpulist(placed[save["name"]])}')
+
+    if not args.apply:
+        print('run with --apply to write this placement to the start scripts and systemd units')
+        return
+    for save in saves:
+        update_save(save['name'], cpus=placed[save['name']])
+        save = get_save_from_name(save['name'])
+        try:
+            rewrite_start_script(save)
+        except (OSError, ValueError) as err:
+            print(f'could not rewrite start script for {save["name"]}: {err}')
+        if create_systemd_file(save['name'], save['path'],
+                get_resources(save, placed[save['name']]), overwrite=True):
+            print(f'wrote resource controls for {save["name"]}')
+    print('run "systemctl daemon-reload" as root and restart the servers to apply the placement')
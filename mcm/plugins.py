@@ -0,0 +1,268 @@
+"""
+keep the plugins of paper servers and the mods of forge servers in line
+with a manifest. versions are resolved against a modrinth style repository,
+pinned in a lockfile and placed from the shared jar cache
+"""
+import os
+import sys
+import json
+import threading
+from fnmatch import fnmatch
+from pathlib import Path
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import ensure_cached, link_jar
+from .download import hash_file
+from .metadata import get_json
+from .saves import get_targets
+from .utils import upstream
+from .versions import minecraft_version
+
+
+PLUGIN_REPOSITORY = upstream('https://api.modrinth.com/v2')
+MANIFEST_NAME = 'mcm-plugins.json'
+LOCK_NAME = 'mcm-plugins.lock.json'
+# the loaders whose builds run on each fork, and where they are installed
+LOADERS = {
+    'paper': (['paper', 'spigot', 'bukkit'], 'plugins'),
+    'forge': (['forge'], 'mods'),
+}
+
+
+def load_json(path, default):
+    """
+    read a json file, or return default if it doesn't exist
+    """
+    try:
+        with open(path, 'r') as file:
+            return json.loads(file.read())
+    except FileNotFoundError:
+        return default
+
+
+def write_json(path, data):
+    """
+    atomically write a json file
+    """
+    tmp = Path(Path(path).parent, f'.{Path(path).name}.{os.getpid()}')
+    with open(tmp, 'wt') as file:
+        file.write(json.dumps(data, indent=4) + '\n')
+    os.replace(tmp, path)
+
+
+def get_loaders(save):
+    """
+    return the loaders and install directory of a save's fork
+    """
+    if save['fork'] not in LOADERS:
+        raise ValueError(f'{save["name"]} runs {save["fork"]}, which takes no plugins or mods')
+    return LOADERS[save['fork']]
+
+
+def pick_version(versions, minecraft, loaders, spec):
+    """
+    return the newest release of a project built for a minecraft version and
+    one of the loaders whose version number matches spec, or None
+    """
+    compatible = [version for version in versions
+        if minecraft in version['game_versions'] and set(loaders) & set(version['loaders']) and
+        fnmatch(version['version_number'], spec) and version['files']]
+    return max(compatible, key=lambda version: version['date_published'], default=None)
+
+
+class Resolver:
+    """
+    resolves each project for a minecraft version and loader set once, no
+    matter how many servers ask for it
+    """
+    def __init__(self):
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def versions(self, repository, project, minecraft, loaders):
+        """
+        return the versions of a project the repository lists as compatible,
+        fetching them only in the first thread to ask
+        """
+        key = (repository, project, minecraft, tuple(loaders))
+        with self.lock:
+            owner = key not in self.results
+            if owner:
+                self.results[key] = {'done': threading.Event(), 'versions': None, 'error': None}
+            result = self.results[key]
+        if owner:
+            try:
+                query = urlencode({'loaders': json.dumps(loaders),
+                    'game_versions': json.dumps([minecraft])})
+                result['versions'] = get_json(f'{repository}/project/{project}/version?{query}')
+            except (OSError, ValueError) as err:
+                result['error'] = err
+            finally:
+                result['done'].set()
+        result['done'].wait()
+        if result['error'] is not None:
+            raise ValueError(f'could not look up {project}: {result["error"]}')
+        return result['versions']
+
+    def resolve(self, repository, project, minecraft, loaders, spec): # pylint: disable=too-many-arguments
+        """
+        return the lock entry of the version of a project to install
+        """
+        version = pick_version(self.versions(repository, project, minecraft, loaders),
+            minecraft, loaders, spec)
+        if version is None:
+            raise ValueError(f'no version of {project} matching {spec} for {minecraft}')
+        file = next((file for file in version['files'] if file.get('primary')),
+            version['files'][0])
+        return {'version': version['version_number'], 'minecraft': minecraft,
+            'file': file['filename'], 'url': file['url'], 'sha1': file['hashes']['sha1']}
+
+
+def plan_save(save, resolver, update):
+    """
+    return the install directory, locked entries and wanted entries of a
+    save, reusing locked entries that still satisfy the manifest
+    """
+    loaders, directory = get_loaders(save)
+    manifest = load_json(Path(save['path'], MANIFEST_NAME), None)
+    if manifest is None:
+        raise ValueError(f'{save["name"]} has no {MANIFEST_NAME}, add plugins with ' + \
+            f'"mcm plugins add {save["name"]} <project>"')
+    locked = load_json(Path(save['path'], LOCK_NAME), {}).get('plugins', {})
+    repository = manifest.get('repository', PLUGIN_REPOSITORY).rstrip('/')
+    minecraft = minecraft_version(save['fork'], save['version'])
+    wanted = {}
+    for project, spec in manifest.get('plugins', {}).items():
+        entry = locked.get(project)
+        if update or entry is None or entry['minecraft'] != minecraft or \
+                not fnmatch(entry['version'], spec):
+            entry = resolver.resolve(repository, project, minecraft, loaders, spec)
+        wanted[project] = entry
+    return Path(save['path'], directory), locked, wanted
+
+
+def apply_plan(directory, locked, wanted, jars):
+    """
+    link the wanted jars into place and remove the ones that are no longer
+    wanted, leaving files the lockfile doesn't know about alone. files whose
+    lock entry is unchanged are trusted, only changed entries are hashed.
+    returns the number of files added, replaced, removed and left unchanged
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    added = replaced = unchanged = 0
+    for project, entry in wanted.items():
+        dest = Path(directory, entry['file'])
+        if not dest.exists():
+            added += 1
+        elif locked.get(project) == entry or hash_file(dest, entry['sha1']) == entry['sha1']:
+            unchanged += 1
+            continue
+        else:
+            replaced += 1
+        link_jar(jars[entry['sha1']], dest)
+    removed = 0
+    keep = {entry['file'] for entry in wanted.values()}
+    for entry in locked.values():
+        if entry['file'] not in keep and Path(directory, entry['file']).exists():
+            Path(directory, entry['file']).unlink()
+            removed += 1
+    return added, replaced, removed, unchanged
+
+
+def fetch_jar(url, sha1):
+    """
+    return the cached jar for a plugin and None, or None and the error
+    """
+    try:
+        return ensure_cached(upstream(url), sha1, lambda n: None)[0], None
+    except (OSError, ValueError) as err:
+        return None, err
+
+
+def sync_plugins(args): # pylint: disable=too-many-locals
+    """
+    bring the plugins or mods of one or more saves in line with their
+    manifests, resolving and downloading in parallel
+    """
+    try:
+        saves = get_targets(args.name, args.all, args.match)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    if args.all:
+        saves = [save for save in saves if save['fork'] in LOADERS and \
+            Path(save['path'], MANIFEST_NAME).exists()]
+
+    resolver = Resolver()
+
+    def plan(save):
+        try:
+            return plan_save(save, resolver, args.update), None
+        except (OSError, ValueError, KeyError) as err:
+            return None, err
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        plans = list(executor.map(plan, saves))
+        urls = {entry['sha1']: entry['url'] for result, _ in plans if result
+            for entry in result[2].values()}
+        # each jar is fetched once however many servers use it
+        fetched = dict(zip(urls, executor.map(
+            lambda sha1: fetch_jar(urls[sha1], sha1), urls)))
+
+    failed = False
+    for save, (result, err) in zip(saves, plans):
+        if result is not None:
+            directory, locked, wanted = result
+            missing = [fetched[entry['sha1']][1] for entry in wanted.values()
+                if fetched[entry['sha1']][0] is None]
+            err = missing[0] if missing else None
+        if err is not None:
+            failed = True
+            print(f'{save["name"]}: failed: {err}')
+            continue
+        jars = {sha1: jar for sha1, (jar, _) in fetched.items()}
+        added, replaced, removed, unchanged = apply_plan(directory, locked, wanted, jars)
+        write_json(Path(save['path'], LOCK_NAME), {'minecraft': minecraft_version(save['fork'],
+            save['version']), 'plugins': wanted})
+        print(f'{save["name"]}: {added} added, {replaced} replaced, {removed} removed, ' + \
+            f'{unchanged} unchanged')
+    if failed:
+        sys.exit(1)
+
+
+def edit_manifest(args):
+    """
+    add a project to a save's manifest or remove one from it
+    """
+    try:
+        save = get_targets(args.name)[0]
+        get_loaders(save)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    path = Path(save['path'], MANIFEST_NAME)
+    manifest = load_json(path, {'plugins': {}})
+    if args.plugins_action == 'add':
+        manifest.setdefault('plugins', {})[args.project] = args.version
+        print(f'added {args.project} {args.version} to {save["name"]}, ' + \
+            f'run "mcm plugins sync {save["name"]}" to install it')
+    elif manifest.get('plugins', {}).pop(args.project, None) is None:
+        print(f'{args.project} is not in the manifest of {save["name"]}')
+        sys.exit(1)
+    else:
+        print(f'removed {args.project} from {save["name"]}, ' + \
+            f'run "mcm plugins sync {save["name"]}" to uninstall it')
+    write_json(path, manifest)
+
+
+def handle_plugins(args):
+    """
+    dispatch plugin actions
+    """
+    if args.plugins_action == 'sync':
+        sync_plugins(args)
+    elif args.plugins_action in ('add', 'remove'):
+        edit_manifest(args)
+    else:
+        print('no action given, use "mcm plugins sync", "mcm plugins add" or "mcm plugins remove"')
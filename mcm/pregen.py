@@ -0,0 +1,301 @@
+"""
+pre-generate a world around spawn over rcon. chunks are forceloaded in
+batches along a spiral, and the batch size follows the server's tick time
+so it stays responsive. progress is checkpointed next to the server
+"""
+import re
+import sys
+import json
+import math
+import time
+import signal
+import asyncio
+from pathlib import Path
+from datetime import datetime
+
+from .exporter import MSPT_PATTERN, strip_colors
+from .rcon import RconPool, RconError
+from .saves import get_save_from_name
+from .utils import run_async, screen_running
+from .versions import minecraft_version, version_key
+from .world import get_spawn
+
+
+CHECKPOINT_NAME = '.mcm-pregen.json'
+COMMAND_TIMEOUT = 10
+MAX_BATCH = 256
+POLL_INTERVAL = 0.5
+# vanilla has no mspt command, a command's round trip waits for the main thread instead
+PROBE_COMMAND = 'list'
+# execute if loaded came with 1.19.4, first appearing in snapshot 23w03a
+LOADED_TEST_RELEASE = (1, 19, 4)
+LOADED_TEST_SNAPSHOT = (23, 3)
+
+
+def spiral(radius):
+    """
+    yield chunk offsets ring by ring outwards from the center, keeping those
+    within radius chunks
+    """
+    yield 0, 0
+    for ring in range(1, radius + 1):
+        # walk each ring's four sides, every side ending on a corner
+        side = [(ring, z) for z in range(-ring + 1, ring + 1)] + \
+            [(x, ring) for x in range(ring - 1, -ring - 1, -1)] + \
+            [(-ring, z) for z in range(ring - 1, -ring - 1, -1)] + \
+            [(x, -ring) for x in range(-ring + 1, ring + 1)]
+        for offset_x, offset_z in side:
+            if math.hypot(offset_x, offset_z) <= radius:
+                yield offset_x, offset_z
+
+
+def parse_window(window):
+    """
+    parse an HH:MM-HH:MM window into two times of day
+    """
+    try:
+        start, end = window.split('-')
+        return datetime.strptime(start, '%H:%M').time(), datetime.strptime(end, '%H:%M').time()
+    except ValueError:
+        raise ValueError(f'invalid window {window}, use HH:MM-HH:MM') from None
+
+
+def in_window(window, now=None):
+    """
+    whether now falls in a window, which may wrap past midnight
+    """
+    if window is None:
+        return True
+    now = (now or datetime.now()).time()
+    start, end = window
+    return start <= now < end if start <= end else now >= start or now < end
+
+
+def load_checkpoint(save):
+    """
+    return the saved progress of a server's pre-generation, or None
+    """
+    try:
+        with open(Path(save['path'], CHECKPOINT_NAME), 'r') as file:
+            return json.loads(file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(save, checkpoint):
+    """
+    write pre-generation progress next to the server
+    """
+    with open(Path(save['path'], CHECKPOINT_NAME), 'wt') as file:
+        file.write(json.dumps(checkpoint, indent=4))
+
+
+def can_test_loaded(save):
+    """
+    whether a save's minecraft version has execute if loaded to tell when
+    chunks are fully generated
+    """
+    version = minecraft_version(save['fork'], save['version'])
+    snapshot = re.fullmatch(r'(\d+)w(\d+)[a-z]', version)
+    if snapshot:
+        return (int(snapshot.group(1)), int(snapshot.group(2))) >= LOADED_TEST_SNAPSHOT
+    return version_key(version) >= LOADED_TEST_RELEASE
+
+
+class Pregenerator:
+    """
+    forceloads batches of chunks over rcon, sizing each batch by tick time
+    """
+    def __init__(self, save, dimension, target_mspt):
+        self.save = save
+        self.pool = RconPool()
+        self.within = '' if dimension == 'minecraft:overworld' else f'in {dimension} '
+        self.prefix = f'execute {self.within}run ' if self.within else ''
+        # older servers can't say when chunks are done, their batches are paced by tick time
+        self.can_test = can_test_loaded(save)
+        self.target = target_mspt
+        self.stopping = False
+
+    def stop(self, *_):
+        """
+        ask the run to stop after releasing its batch, as a signal handler
+        """
+        self.stopping = True
+
+    async def run(self, command):
+        """
+        run a command on the server
+        """
+        return await self.pool.command(self.save, command, COMMAND_TIMEOUT)
+
+    async def measure(self):
+        """
+        return the server's tick time in ms, from paper's mspt command or
+        else from how long a command waits for the main thread
+        """
+        if self.save['fork'] == 'paper':
+            match = MSPT_PATTERN.search(strip_colors(await self.run('mspt')))
+            if match:
+                return float(match.group(1))
+        start = time.monotonic()
+        await self.run(PROBE_COMMAND)
+        return (time.monotonic() - start) * 1000
+
+    async def forceload(self, action, chunks):
+        """
+        add or remove forceload tickets for chunks
+        """
+        for chunk_x, chunk_z in chunks:
+            await self.run(f'{self.prefix}forceload {action} {chunk_x * 16} {chunk_z * 16}')
+
+    async def unfinished(self, chunks):
+        """
+        return the chunks that have not reached full status yet
+        """
+        if not self.can_test:
+            return []
+        left = []
+        for chunk_x, chunk_z in chunks:
+            reply = await self.run(f'execute {self.within}if loaded {chunk_x * 16} 0 {chunk_z * 16}')
+            if 'Test failed' in reply:
+                left.append((chunk_x, chunk_z))
+            elif 'Test passed' not in reply:
+                raise RconError(f'unexpected reply to execute if loaded: {reply.strip()}')
+        return left
+
+    async def generate(self, chunks):
+        """
+        load a batch of chunks and wait until every one of them is fully
+        generated and the server caught up, returning the tick time it
+        settled at, or None if stopped first
+        """
+        await self.forceload('add', chunks)
+        mspt = None
+        left = list(chunks)
+        while not self.stopping:
+            await asyncio.sleep(POLL_INTERVAL)
+            left = await self.unfinished(left)
+            if left:
+                continue
+            mspt = await self.measure()
+            if mspt <= self.target:
+                break
+        await self.forceload('remove', chunks)
+        return None if self.stopping else mspt
+
+    def resize(self, batch, mspt):
+        """
+        grow the batch while the server has headroom and halve it when it lags
+        """
+        if mspt > self.target * 0.8:
+            return max(batch // 2, 1)
+        if mspt < self.target * 0.5:
+            return min(batch + max(batch // 4, 1), MAX_BATCH)
+        return batch
+
+
+async def release(generator, save, checkpoint):
+    """
+    remove the forceloads of a batch that was interrupted
+    """
+    if checkpoint.get('loading'):
+        await generator.forceload('remove', checkpoint['loading'])
+        checkpoint['loading'] = []
+        save_checkpoint(save, checkpoint)
+
+
+async def pregenerate(generator, save, checkpoint, args):
+    """
+    walk the spiral from the checkpoint, saving progress after every batch
+    """
+    center_x, center_z = checkpoint['center']
+    chunks = [(center_x + offset_x, center_z + offset_z)
+        for offset_x, offset_z in spiral(checkpoint['radius'])]
+    window = parse_window(args.window) if args.window else None
+    batch = checkpoint['batch']
+    last_report = 0
+    try:
+        await release(generator, save, checkpoint)
+        while checkpoint['done'] < len(chunks) and not generator.stopping:
+            if not in_window(window):
+                print(f'outside {args.window}, waiting', flush=True)
+                while not in_window(window) and not generator.stopping:
+                    await asyncio.sleep(1)
+                continue
+            pending = chunks[checkpoint['done']:checkpoint['done'] + batch]
+            # forceloads outlive restarts, so the batch is recorded before it is loaded
+            checkpoint['loading'] = pending
+            save_checkpoint(save, checkpoint)
+            mspt = await generator.generate(pending)
+            checkpoint['loading'] = []
+            if mspt is None:
+                # stopped partway, the batch is loaded again on resume
+                save_checkpoint(save, checkpoint)
+                break
+            checkpoint['done'] += len(pending)
+            batch = checkpoint['batch'] = generator.resize(batch, mspt)
+            save_checkpoint(save, checkpoint)
+            if time.monotonic() - last_report > 10 or checkpoint['done'] == len(chunks):
+                last_report = time.monotonic()
+                print(f'{checkpoint["done"]}/{len(chunks)} chunks, ' + \
+                    f'{checkpoint["done"] * 100 / len(chunks):.1f}%, batch {batch}, ' + \
+                    f'{mspt:.1f} mspt', flush=True)
+    finally:
+        generator.pool.close()
+
+
+def pregen_server(args): # pylint: disable=too-many-branches
+    """
+    pre-generate a running server's world, resuming from its checkpoint
+    """
+    save = get_save_from_name(args.name)
+    if save is None:
+        print(f'could not find save with name {args.name}')
+        sys.exit(1)
+    if 'rcon' not in save:
+        print(f'rcon is not set up for {save["name"]}, run "mcm rcon -n {save["name"]}"')
+        sys.exit(1)
+    if not screen_running(save['name']):
+        print(f'{save["name"]} is not running, start it before pre-generating')
+        sys.exit(1)
+    try:
+        if args.window:
+            parse_window(args.window)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+
+    checkpoint = None if args.restart else load_checkpoint(save)
+    if checkpoint is not None and args.radius is not None and \
+            (checkpoint['radius'], checkpoint['dimension']) != \
+            (math.ceil(args.radius / 16), args.dimension):
+        print('a pre-generation with another radius or dimension is in progress, ' + \
+            'use --restart to start over')
+        sys.exit(1)
+    if checkpoint is None:
+        if args.radius is None:
+            print('give the radius to pre-generate with --radius')
+            sys.exit(1)
+        spawn_x, spawn_z = get_spawn(save)
+        checkpoint = {'radius': math.ceil(args.radius / 16), 'dimension': args.dimension,
+            'center': [spawn_x // 16, spawn_z // 16] if args.dimension == 'minecraft:overworld' \
+                else [0, 0],
+            'batch': args.batch, 'done': 0, 'loading': []}
+    else:
+        print(f'resuming after {checkpoint["done"]} chunks')
+
+    generator = Pregenerator(save, checkpoint['dimension'], args.target_mspt)
+    if not generator.can_test:
+        print(f'{save["version"]} predates execute if loaded, so batches are only paced by ' + \
+            'tick time and may be released before they are fully generated')
+    signal.signal(signal.SIGINT, generator.stop)
+    signal.signal(signal.SIGTERM, generator.stop)
+    try:
+        run_async(pregenerate(generator, save, checkpoint, args))
+    except (OSError, RconError, asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+        print(f'lost the server after {checkpoint["done"]} chunks: {err}, run again to resume')
+        sys.exit(1)
+    if generator.stopping:
+        print(f'paused after {checkpoint["done"]} chunks, run again to resume')
+    else:
+        print(f'pre-generated {checkpoint["done"]} chunks of {save["name"]}')
@@ -0,0 +1,125 @@
+"""
+optional timing of the phases a command goes through. spans record wall
+time and counters such as bytes transferred and cache hits, and are written
+out as a chrome trace. while profiling is off a span is a shared no-op
+"""
+import os
+import sys
+import json
+import time
+import threading
+
+
+# the trace events recorded so far, or None while profiling is off
+EVENTS = None
+LOCAL = threading.local()
+# counters may be added to from worker threads, such as download segments
+LOCK = threading.Lock()
+
+
+class NullSpan:
+    """
+    stands in for a span while profiling is off
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def add(self, counter, value=1):
+        """
+        ignore a counter
+        """
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """
+    times a phase and collects counters, nesting under the span open on the
+    same thread
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.start = None
+
+    def __enter__(self):
+        LOCAL.__dict__.setdefault('stack', []).append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        end = time.perf_counter()
+        LOCAL.stack.pop()
+        with LOCK:
+            EVENTS.append({'name': self.name, 'ph': 'X', 'pid': os.getpid(),
+                'tid': threading.get_ident(), 'ts': self.start * 1e6,
+                'dur': (end - self.start) * 1e6, 'args': self.fields})
+        return False
+
+    def add(self, counter, value=1):
+        """
+        add to one of the span's counters
+        """
+        with LOCK:
+            self.fields[counter] = self.fields.get(counter, 0) + value
+
+
+def enable():
+    """
+    start recording spans
+    """
+    global EVENTS # pylint: disable=global-statement
+    EVENTS = []
+
+
+def span(name, **fields):
+    """
+    return a context manager timing a phase, with fields kept alongside it
+    """
+    if EVENTS is None:
+        return NULL_SPAN
+    return Span(name, fields)
+
+
+def add(counter, value=1):
+    """
+    add to a counter of the innermost span open on this thread
+    """
+    if EVENTS is None:
+        return
+    stack = LOCAL.__dict__.get('stack')
+    if stack:
+        stack[-1].add(counter, value)
+
+
+def summarize(events):
+    """
+    print the total time and counters of each phase, slowest first
+    """
+    totals = {}
+    for event in events:
+        total = totals.setdefault(event['name'], {'calls': 0, 'dur': 0, 'counters': {}})
+        total['calls'] += 1
+        total['dur'] += event['dur']
+        for key, value in event['args'].items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                total['counters'][key] = total['counters'].get(key, 0) + value
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]['dur']):
+        counters = ''.join(f', {key} {value:g}' for key, value in sorted(total['counters'].items()))
+        print(f'{name}: {total["dur"] / 1000:.1f} ms over {total["calls"]} calls{counters}',
+            file=sys.stderr)
+
+
+def write_trace(path):
+    """
+    write the recorded spans to path as a chrome trace and summarize them
+    """
+    with open(path, 'wt') as file:
+        file.write(json.dumps({'traceEvents': EVENTS, 'displayTimeUnit': 'ms'}))
+    summarize(EVENTS)
+    print(f'wrote {len(EVENTS)} spans to {path}, open it in chrome://tracing or Perfetto',
+        file=sys.stderr)
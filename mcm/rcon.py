@@ -0,0 +1,250 @@
+"""
+asyncio rcon client with pooled connections, and per-server rcon setup
+"""
+import sys
+import struct
+import asyncio
+import secrets
+from fnmatch import fnmatch
+from pathlib import Path
+
+from .utils import run_async, write_properties
+from .saves import get_saves, get_save_from_name, update_save
+
+
+RCON_HOST = '127.0.0.1'
+RCON_BASE_PORT = 25575
+LOGIN = 3
+COMMAND = 2
+RESPONSE = 0
+# minecraft answers a packet type it doesn't know with a single response,
+# which marks the end of a command's possibly fragmented output
+MARKER = 200
+
+
+class RconError(Exception):
+    """
+    raised when rcon authentication or a command fails
+    """
+
+
+class RconClient:
+    """
+    a single authenticated rcon connection, running one command at a time
+    """
+    def __init__(self, host, port, password):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.reader = None
+        self.writer = None
+        self.request_id = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def connected(self):
+        """
+        whether the connection is open
+        """
+        return self.writer is not None and not self.writer.transport.is_closing()
+
+    async def send(self, kind, payload):
+        """
+        send a packet and return its request id
+        """
+        self.request_id += 1
+        body = struct.pack('<ii', self.request_id, kind) + payload.encode('utf-8') + b'\x00\x00'
+        self.writer.write(struct.pack('<i', len(body)) + body)
+        await self.writer.drain()
+        return self.request_id
+
+    async def receive(self):
+        """
+        read one packet, returning its request id and payload
+        """
+        length = struct.unpack('<i', await self.reader.readexactly(4))[0]
+        body = await self.reader.readexactly(length)
+        request_id = struct.unpack('<i', body[:4])[0]
+        return request_id, body[8:-2].decode('utf-8', 'replace')
+
+    async def connect(self):
+        """
+        open the connection and log in
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        request_id = await self.send(LOGIN, self.password)
+        response_id, _ = await self.receive()
+        if response_id == -1 or response_id != request_id:
+            self.close()
+            raise RconError(f'rcon login to {self.host}:{self.port} was refused')
+
+    async def command(self, command):
+        """
+        run a command and return its full output
+        """
+        async with self.lock:
+            if not self.connected:
+                await self.connect()
+            try:
+                request_id = await self.send(COMMAND, command)
+                marker_id = await self.send(MARKER, '')
+                output = []
+                while True:
+                    response_id, payload = await self.receive()
+                    if response_id == marker_id:
+                        return ''.join(output)
+                    if response_id == request_id:
+                        output.append(payload)
+            except (OSError, asyncio.IncompleteReadError, asyncio.CancelledError):
+                # a half-read reply would desync the next command
+                self.close()
+                raise
+
+    def close(self):
+        """
+        close the connection
+        """
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class RconPool:
+    """
+    keeps one open rcon connection per server for reuse across commands
+    """
+    def __init__(self):
+        self.clients = {}
+
+    def get(self, save):
+        """
+        return the pooled client for a save
+        """
+        if 'rcon' not in save:
+            raise RconError(f'rcon is not set up for {save["name"]}, ' + \
+                f'run "mcm rcon -n {save["name"]}"')
+        key = (RCON_HOST, save['rcon']['port'])
+        if key not in self.clients:
+            self.clients[key] = RconClient(RCON_HOST, save['rcon']['port'],
+                save['rcon']['password'])
+        return self.clients[key]
+
+    async def command(self, save, command, timeout):
+        """
+        run a command on a save's server, giving up after timeout seconds
+        """
+        return await asyncio.wait_for(self.get(save).command(command), timeout)
+
+    def close(self):
+        """
+        close every pooled connection
+        """
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+
+
+def send_command(save, command, timeout):
+    """
+    run one command on a save's server over its own connection and return
+    the output
+    """
+    pool = RconPool()
+
+    async def run():
+        try:
+            return await pool.command(save, command, timeout)
+        finally:
+            pool.close()
+
+    return run_async(run())
+
+
+def setup_rcon(save):
+    """
+    give a save its own rcon port and password and enable rcon in its
+    server.properties, which is made readable by its owner only as it now
+    holds the password. returns the credentials
+    """
+    if 'rcon' in save:
+        credentials = save['rcon']
+    else:
+        used = {item['rcon']['port'] for item in get_saves() if 'rcon' in item}
+        port = next(port for port in range(RCON_BASE_PORT, 65536) if port not in used)
+        credentials = {'port': port, 'password': secrets.token_urlsafe(24)}
+        update_save(save['name'], rcon=credentials)
+    properties = Path(save['path'], 'server.properties')
+    properties.touch(mode=0o600)
+    properties.chmod(0o600)
+    write_properties(save['path'], {
+        'enable-rcon': 'true',
+        'rcon.port': credentials['port'],
+        'rcon.password': credentials['password'],
+        'broadcast-rcon-to-ops': 'false',
+    })
+    return credentials
+
+
+def select_targets(args):
+    """
+    return the saves named on the command line, or all matching saves
+    """
+    if args.all:
+        return [save for save in get_saves() if args.match is None or \
+            fnmatch(save['name'], args.match)]
+    saves = []
+    for name in args.name or []:
+        save = get_save_from_name(name)
+        if save is None:
+            print(f'could not find save with name {name}')
+            sys.exit(1)
+        saves.append(save)
+    if not saves:
+        print('give the name of a server with --name, or --all')
+        sys.exit(1)
+    return saves
+
+
+async def fan_out(saves, command, timeout):
+    """
+    run a command on every save's server at once, returning a list of
+    (save, output, error)
+    """
+    pool = RconPool()
+
+    async def run(save):
+        try:
+            return save, await pool.command(save, command, timeout), None
+        except (OSError, RconError, asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+            return save, None, err
+
+    try:
+        return await asyncio.gather(*[run(save) for save in saves])
+    finally:
+        pool.close()
+
+
+def handle_exec(args):
+    """
+    run a console command on one or more servers over rcon
+    """
+    saves = select_targets(args)
+    failed = False
+    for save, output, err in run_async(fan_out(saves, args.command, args.timeout)):
+        if err is not None:
+            failed = True
+            print(f'{save["name"]}: error: {err if str(err) else type(err).__name__}')
+        else:
+            print(f'{save["name"]}: {output.strip()}')
+    if failed:
+        sys.exit(1)
+
+
+def handle_rcon(args):
+    """
+    enable rcon with per-server credentials on one or more servers
+    """
+    for save in select_targets(args):
+        credentials = setup_rcon(save)
+        print(f'{save["name"]}: rcon on port {credentials["port"]}')
+    print('restart the servers for rcon changes to take effect')
@@ -0,0 +1,118 @@
+"""
+resolve a fork and version argument to a downloadable server jar
+"""
+import sys
+
+from .forge import resolve_forge
+from .metadata import get_json
+from .profile import span
+from .utils import upstream
+from .versions import PAPER_API, get_index, fetch_builds, save_index, paper_download, is_pattern, \
+    latest_matching
+
+
+def resolve_vanilla(version_arg):
+    """
+    resolve a vanilla version to its server jar and sha1
+    """
+    index = get_index('vanilla')
+
+    # get the latest version of minecraft if none was provide
+    if version_arg is None or version_arg.lower() == 'latest':
+        selected_version = index['latest']['release']
+    elif is_pattern(version_arg):
+        selected_version = latest_matching('vanilla', index, version_arg.lower())
+    else:
+        selected_version = version_arg.lower()
+
+    # get the download url for the server jar or fail if the version is not found
+    version = index['versions'].get(selected_version)
+    if version is None:
+        raise ValueError(f'Invalid version {version_arg}. Exiting')
+    server = get_json(upstream(version['url']))['downloads']['server']
+    return {
+        'fork': 'vanilla',
+        'version': selected_version,
+        'url': upstream(server['url']),
+        'jar': f'minecraft-server-{selected_version}.jar',
+        'hash': server['sha1'],
+    }
+
+
+def resolve_paper(version_arg):
+    """
+    resolve a paper version to its server jar and sha256
+    """
+    # valid versions can have 5 structures
+    # no version provided defaults to the latest build, as does 'latest'
+    # a line such as '1.16.x' resolves to the latest build of its newest version
+    # a single string with no '-' will be treated as a simple version
+    # the latest build of the specified version will be downloaded, if available
+    # a string with a '-', such as '1.16.3-224' will be treated as a version and build
+    index = get_index('paper')
+    if version_arg is None or version_arg == 'latest':
+        version = index['versions'][-1]
+    elif is_pattern(version_arg):
+        version = (latest_matching('paper', index, version_arg) or '').partition('-')[0]
+        if not version:
+            raise ValueError(f'invalid paper version {version_arg}')
+    else:
+        version = version_arg.partition('-')[0]
+        if version not in index['builds']:
+            raise ValueError(f'invalid paper version {version_arg}')
+    # now that we have a good version, get the build number
+    paper_builds = [str(build) for build in index['builds'][version]]
+    if version_arg is not None and '-' in version_arg:
+        build = version_arg.partition('-')[2]
+        if build not in paper_builds:
+            # older lines are not refreshed with the index, so look once more
+            index['builds'][version] = fetch_builds(version)
+            save_index('paper', index)
+            if build not in [str(number) for number in index['builds'][version]]:
+                raise ValueError(f'invalid paper build {build}')
+    else:
+        build = paper_builds[-1]
+
+    # the build endpoint carries the file name and hash of the jar
+    download = paper_download(index, version, build)
+    return {
+        'fork': 'paper',
+        'version': f'{version}-{build}',
+        'url': f'{PAPER_API}/versions/{version}/builds/{build}/downloads/{download["name"]}',
+        'jar': f'paper-{version}-{build}.jar',
+        'hash': download['sha256'],
+    }
+
+
+RESOLVERS = {
+    'vanilla': resolve_vanilla,
+    'minecraft': resolve_vanilla,
+    'paper': resolve_paper,
+    'forge': resolve_forge,
+}
+
+
+def resolve(fork, version_arg):
+    """
+    resolve a version argument for any supported fork
+    """
+    if fork not in RESOLVERS:
+        raise ValueError(f'there\'s no resolver for the {fork} fork yet')
+    return RESOLVERS[fork](version_arg)
+
+
+def resolve_or_exit(fork, version_arg):
+    """
+    resolve a version argument for a command, or print why it can't be and
+    exit
+    """
+    try:
+        with span('resolve', fork=fork, version=version_arg):
+            return resolve(fork, version_arg)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    except OSError as err:
+        # http and url errors carry the useful part in reason
+        print(f'could not resolve {fork} {version_arg or "latest"}: {getattr(err, "reason", err)}')
+        sys.exit(1)
@@ -0,0 +1,394 @@
+"""
+staged updates. the new jar is downloaded and patched while the server
+keeps running, then the server is restarted once nobody is online or at a
+set time, and rolled back if the new version never finishes starting
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import asyncio
+import zipfile
+import subprocess
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from .backup import stage_snapshot
+from .bench import DONE_PATTERN, get_java_major
+from .cache import install_jar, clone_file
+from .ping import ping_save
+from .rcon import RconError, send_command
+from .resolve import resolve
+from .saves import get_save_from_name, update_save
+from .scripts import SYSTEMD_DIR, create_start_script, find_jar, start_options
+from .utils import get_worlds, run_async, screen_running
+
+
+SCRATCH_NAME = '.mcm-update'
+CONFIG_NAME = '.mcm-configs'
+# where paperclip leaves the patched server and its libraries
+PATCHED_DIRS = ('cache', 'versions', 'libraries')
+# files a new version may migrate on its first start
+CONFIGS = ('server.properties', 'bukkit.yml', 'spigot.yml', 'paper.yml', 'commands.yml',
+    'permissions.yml', 'config')
+# vanilla, spigot and paper all answer list with this
+PLAYERS_PATTERN = re.compile(r'There are (\d+)')
+# seconds before a scheduled restart at which players are warned
+COUNTDOWN = (600, 300, 60, 30, 10, 5, 4, 3, 2, 1)
+PLAYER_POLL = 30
+PING_TIMEOUT = 5
+COMMAND_TIMEOUT = 10
+PATCH_TIMEOUT = 600
+STOP_TIMEOUT = 120
+# how long the screen session may take to appear after start.sh returns
+START_GRACE = 10
+
+
+def required_java(jar):
+    """
+    return the java release a jar's main class was compiled for, or None if
+    it can't be told
+    """
+    try:
+        with zipfile.ZipFile(jar) as archive:
+            manifest = archive.read('META-INF/MANIFEST.MF').decode('utf-8', 'replace')
+            main = next(line.partition(':')[2].strip() for line in manifest.splitlines()
+                if line.startswith('Main-Class:'))
+            header = archive.read(main.replace('.', '/') + '.class')[:8]
+    except (OSError, KeyError, StopIteration, zipfile.BadZipFile):
+        return None
+    # class files store their format version after the magic, java 8 is 52
+    return int.from_bytes(header[6:8], 'big') - 44 if header[:4] == b'\xca\xfe\xba\xbe' else None
+
+
+def patch_jar(save, jar):
+    """
+    run paperclip's patch step for a jar in a scratch directory and move what
+    it produced next to the server, where the running version leaves it be.
+    returns how many files were added
+    """
+    scratch = Path(save['path'], SCRATCH_NAME)
+    shutil.rmtree(scratch, ignore_errors=True)
+    scratch.mkdir()
+    try:
+        clone_file(jar, Path(scratch, Path(jar).name))
+        result = subprocess.run(['java', '-Dpaperclip.patchonly=true', '-jar', Path(jar).name],
+            cwd=scratch, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, timeout=PATCH_TIMEOUT, check=False)
+        if result.returncode != 0:
+            raise ValueError('patching failed: ' + ' '.join(result.stdout.splitlines()[-3:]))
+        added = 0
+        for directory in PATCHED_DIRS:
+            for src in sorted(Path(scratch, directory).glob('**/*')):
+                dest = Path(save['path'], src.relative_to(scratch))
+                if src.is_file() and not dest.exists():
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(src, dest)
+                    added += 1
+        return added
+    except subprocess.TimeoutExpired:
+        raise ValueError(f'patching took longer than {PATCH_TIMEOUT}s') from None
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def stage_jar(save, target):
+    """
+    download a resolved jar next to the server and prepare it to start,
+    returning its path
+    """
+    jar = Path(save['path'], target['jar'])
+    hit = install_jar(target['url'], jar, target['hash'])
+    print(f'{"Linked cached" if hit else "Downloaded"} {target["jar"]} to {save["path"]}')
+    wanted, installed = required_java(jar), get_java_major('java')
+    if wanted is not None and wanted > installed:
+        raise ValueError(f'{target["jar"]} needs java {wanted}, but java {installed} is installed')
+    if save['fork'] == 'paper':
+        print(f'patched {target["jar"]}, {patch_jar(save, jar)} files added')
+    return jar
+
+
+def next_time(text):
+    """
+    return the next occurrence of an HH:MM time of day
+    """
+    try:
+        clock = datetime.strptime(text, '%H:%M').time()
+    except ValueError:
+        raise ValueError(f'invalid time {text}, use HH:MM') from None
+    moment = datetime.combine(datetime.now().date(), clock)
+    return moment if moment > datetime.now() else moment + timedelta(days=1)
+
+
+def broadcast(save, message):
+    """
+    tell everyone on a server something, warning if it can't be reached
+    """
+    try:
+        send_command(save, f'say {message}', COMMAND_TIMEOUT)
+    except (OSError, RconError, asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+        print(f'warning: could not broadcast to {save["name"]}: {err}')
+
+
+def describe(seconds):
+    """
+    describe a countdown in words
+    """
+    seconds = max(round(seconds), 1)
+    if seconds >= 60:
+        minutes = round(seconds / 60)
+        return f'{minutes} minute{"s" if minutes != 1 else ""}'
+    return f'{seconds} second{"s" if seconds != 1 else ""}'
+
+
+def count_players(save):
+    """
+    return how many players are online, asking over rcon when the status
+    ping fails, or None if neither answers
+    """
+    status = run_async(ping_save(save, PING_TIMEOUT))
+    if status['online']:
+        return status['players']
+    # a lagging server can miss a ping with players still on it
+    try:
+        match = PLAYERS_PATTERN.search(send_command(save, 'list', COMMAND_TIMEOUT))
+    except (OSError, RconError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return None
+    return int(match.group(1)) if match else None
+
+
+def wait_for_restart(save, when_empty, restart_at):
+    """
+    block until the server is empty, if when_empty is set, or restart_at
+    comes, warning players as it nears. returns the reason
+    """
+    warned = set()
+    while True:
+        remaining = (restart_at - datetime.now()).total_seconds() if restart_at else None
+        if remaining is not None and remaining <= 0:
+            return 'scheduled'
+        if when_empty:
+            # unknown counts are polled again rather than taken as empty
+            if count_players(save) == 0:
+                return 'empty'
+        delay = PLAYER_POLL if when_empty else None
+        if remaining is not None:
+            due = [mark for mark in COUNTDOWN if mark >= remaining and mark not in warned]
+            if due:
+                warned.update(due)
+                broadcast(save, f'restarting for an update in {describe(remaining)}')
+            later = [mark for mark in COUNTDOWN if mark < remaining]
+            until_mark = remaining - max(later) if later else remaining
+            delay = until_mark if delay is None else min(delay, until_mark)
+        time.sleep(delay)
+
+
+def systemd_unit(save):
+    """
+    return whether a save runs under the systemd unit mcm creates
+    """
+    return Path(SYSTEMD_DIR, f'{save["name"]}-mc.service').exists()
+
+
+def stop_server(save):
+    """
+    stop a server through systemd or over rcon, waiting for it to exit
+    """
+    if systemd_unit(save):
+        subprocess.run(['systemctl', 'stop', f'{save["name"]}-mc'], check=True)
+        return
+    try:
+        send_command(save, 'stop', COMMAND_TIMEOUT)
+    except (OSError, RconError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        # the connection drops as the server shuts down
+        pass
+    deadline = time.monotonic() + STOP_TIMEOUT
+    while screen_running(save['name']) and time.monotonic() < deadline:
+        time.sleep(0.5)
+    if screen_running(save['name']):
+        subprocess.run(['screen', '-S', f'{save["name"]}-mc', '-X', 'quit'], check=False)
+
+
+def start_server(save):
+    """
+    start a server through systemd or its start script
+    """
+    if systemd_unit(save):
+        subprocess.run(['systemctl', 'start', f'{save["name"]}-mc'], check=True)
+    else:
+        subprocess.run([str(Path(save['path'], 'start.sh'))], cwd=save['path'], check=True)
+
+
+def log_inode(save):
+    """
+    return the inode of a server's latest.log, which changes as it starts
+    """
+    try:
+        return Path(save['path'], 'logs', 'latest.log').stat().st_ino
+    except OSError:
+        return None
+
+
+def wait_for_done(save, old_inode, timeout):
+    """
+    wait for a freshly started server to log Done, returning the startup time
+    it reports, or None if it crashed or ran out of time
+    """
+    path = Path(save['path'], 'logs', 'latest.log')
+    start = time.monotonic()
+    offset = 0
+    while time.monotonic() - start < timeout:
+        time.sleep(1)
+        if not systemd_unit(save) and time.monotonic() - start > START_GRACE and \
+                not screen_running(save['name']):
+            return None
+        try:
+            if path.stat().st_ino == old_inode:
+                continue
+            with open(path, 'rb') as log:
+                log.seek(offset)
+                data = log.read()
+        except OSError:
+            continue
+        complete = data[:data.rfind(b'\n') + 1]
+        offset += len(complete)
+        match = DONE_PATTERN.search(complete.decode('utf-8', 'replace'))
+        if match:
+            return float(match.group(1).replace(',', '.'))
+    return None
+
+
+def copy_configs(save, dest):
+    """
+    copy the config files a new version may migrate into dest. rather than
+    trying the migration in a scratch copy, which would mean booting a
+    second server, the new version migrates the live configs and these
+    copies are put back if it fails to start
+    """
+    Path(dest).mkdir(parents=True, exist_ok=True)
+    for name in CONFIGS:
+        src = Path(save['path'], name)
+        if src.is_dir():
+            shutil.copytree(src, Path(dest, name))
+        elif src.exists():
+            shutil.copy2(src, Path(dest, name))
+
+
+def restore_configs(save, src):
+    """
+    put back the config files copied before the update
+    """
+    for name in CONFIGS:
+        if not Path(src, name).exists():
+            continue
+        dest = Path(save['path'], name)
+        if dest.is_dir():
+            shutil.rmtree(dest)
+        os.replace(Path(src, name), dest)
+
+
+def restore_worlds(save, staging):
+    """
+    replace a save's worlds with the copies staged before the update
+    """
+    for world in get_worlds(save['path']):
+        if Path(staging, world).exists():
+            shutil.rmtree(Path(save['path'], world), ignore_errors=True)
+            os.replace(Path(staging, world), Path(save['path'], world))
+
+
+def switch(save, jar, version, jar_field):
+    """
+    point a save's start script and entry at a jar
+    """
+    create_start_script(save['name'], save['path'], str(jar), **start_options(save))
+    update_save(save['name'], version=version, jar=jar_field)
+
+
+def rollback(save, staging, old_jar, args):
+    """
+    put the previous jar, configs and worlds back and start it again
+    """
+    print(f'{save["name"]} did not reach Done, rolling back')
+    stop_server(save)
+    restore_configs(save, Path(staging, CONFIG_NAME))
+    restore_worlds(save, staging)
+    switch(save, old_jar, save['version'], save.get('jar'))
+    inode = log_inode(save)
+    start_server(save)
+    took = wait_for_done(save, inode, args.done_timeout)
+    if took is None:
+        print(f'{save["name"]} did not start after rolling back either, check its logs')
+    else:
+        print(f'rolled {save["name"]} back to {save["version"]}, started in {took:.1f}s')
+
+
+def restart(save, target, jar, args):
+    """
+    restart a running server onto a staged jar, rolling back on failure
+    """
+    old_jar = find_jar(save)
+    staging, pause, _, _ = stage_snapshot(save, args.workers)
+    print(f'copied the worlds for a rollback, saving paused for {pause:.2f}s')
+    try:
+        copy_configs(save, Path(staging, CONFIG_NAME))
+        broadcast(save, 'restarting for an update now')
+        inode = log_inode(save)
+        stop_server(save)
+        downtime = time.monotonic()
+        try:
+            switch(save, jar, target['version'], target['jar'])
+            start_server(save)
+            took = wait_for_done(save, inode, args.done_timeout)
+        except (OSError, subprocess.CalledProcessError) as err:
+            print(f'could not start {target["version"]}: {err}')
+            took = None
+        if took is None:
+            rollback(save, staging, old_jar, args)
+            sys.exit(1)
+        print(f'{save["name"]} updated to {target["version"]}, started in {took:.1f}s, ' + \
+            f'down for {time.monotonic() - downtime:.1f}s')
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def stage_server(args, save):
+    """
+    stage an update for a save, then restart onto it when it suits players
+    """
+    if args.restart_when_empty or args.restart_at:
+        if 'rcon' not in save:
+            print(f'rcon is not set up for {save["name"]}, run "mcm rcon -n {save["name"]}"')
+            sys.exit(1)
+    try:
+        restart_at = next_time(args.restart_at) if args.restart_at else None
+        target = resolve(save['fork'], args.version)
+        print(f'staging {save["fork"]} {target["version"]} for {save["name"]}')
+        jar = stage_jar(save, target)
+    except (OSError, ValueError) as err:
+        print(err)
+        sys.exit(1)
+
+    if not screen_running(save['name']) or not (args.restart_when_empty or restart_at):
+        switch(save, jar, target['version'], target['jar'])
+        print(f'{save["name"]} will run {target["version"]} from its next start')
+        return
+    if restart_at:
+        print(f'restarting {save["name"]} at {restart_at:%H:%M}' + \
+            (' or once it is empty' if args.restart_when_empty else ''))
+    else:
+        print(f'restarting {save["name"]} once it is empty')
+    try:
+        reason = wait_for_restart(save, args.restart_when_empty, restart_at)
+    except KeyboardInterrupt:
+        print(f'\ncancelled, {save["name"]} still runs {save["version"]}')
+        sys.exit(1)
+    print(f'restarting {save["name"]}, ' + \
+        ('nobody is online' if reason == 'empty' else 'as scheduled'))
+    try:
+        restart(get_save_from_name(save['name']), target, jar, args)
+    except (OSError, RconError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+            subprocess.CalledProcessError) as err:
+        print(f'could not restart {save["name"]}: {err}')
+        sys.exit(1)
@@ -1,35 +1,104 @@
 """
-used for uh
-we'll see
-code hard
+the save list of every server mcm manages, kept in ~/.config/mcm/saves.json.
+the file is loaded once per process and indexed by name and path, and every
+write happens under a lock and lands atomically. it holds rcon passwords, so
+only its owner can read it
 """
+import os
 import json
+import fcntl
+import threading
 from pathlib import Path
+from fnmatch import fnmatch
+from contextlib import contextmanager
+
+from .profile import span
+
+
+SAVES_DIR = Path(Path.home(), '.config/mcm/')
+SAVES_FILE = Path(SAVES_DIR, 'saves.json')
+LOCK_FILE = Path(SAVES_DIR, 'saves.json.lock')
+
+# in-process view of saves.json, refreshed whenever the file changes on disk
+STORE = {'stamp': None, 'saves': [], 'by_name': {}, 'by_path': {}}
+THREAD_LOCK = threading.RLock()
+
+
+def file_stamp():
+    """
+    return a cheap fingerprint of saves.json, or None if it doesn't exist
+    """
+    try:
+        stat = SAVES_FILE.stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def index(saves, stamp):
+    """
+    replace the in-process store with saves and rebuild its indexes
+    """
+    STORE['stamp'] = stamp
+    STORE['saves'] = saves
+    STORE['by_name'] = {save['name']: save for save in saves}
+    STORE['by_path'] = {save['path']: save for save in saves}
+
+
+def load():
+    """
+    make sure the in-process store matches saves.json
+    """
+    stamp = file_stamp()
+    if stamp is not None and stamp == STORE['stamp']:
+        return
+    if stamp is None:
+        index([], None)
+        return
+    with span('saves.load'), open(SAVES_FILE, 'r') as file:
+        index(json.loads(file.read()), stamp)
+
 
 def get_saves():
     """
     load saves from config file
     """
-    if not Path(Path.home(), '.config/mcm/').exists() or \
-        not Path(Path.home(), '.config/mcm/saves.json').exists(): # pylint: disable=no-else-return
-        return []
-    else:
-        with open(Path(Path.home(), '.config/mcm/saves.json'), 'r') as file:
-            return json.loads(file.read())
+    with THREAD_LOCK:
+        load()
+        return list(STORE['saves'])
 
 
 def get_save_from_name(name):
     """
     return a save by name
     """
-    return next((item for item in get_saves() if item['name'] == name), None)
+    with THREAD_LOCK:
+        load()
+        return STORE['by_name'].get(name)
 
 
 def get_save_from_path(path):
     """
     return a save by path
     """
-    return next((item for item in get_saves() if item['path'] == path), None)
+    with THREAD_LOCK:
+        load()
+        return STORE['by_path'].get(str(path))
+
+
+def get_targets(name, every=False, pattern=None):
+    """
+    return the named save, or with every, all saves whose name matches the
+    glob pattern. raises ValueError when the name is missing or unknown
+    """
+    if every:
+        return [save for save in get_saves() if pattern is None or fnmatch(save['name'], pattern)]
+    if not name:
+        raise ValueError('give the name of a server, or --all')
+    save = get_save_from_name(name)
+    if save is None:
+        raise ValueError(f'could not find save with name {name}')
+    return [save]
 
 
 def save_exists(name, path):
@@ -39,7 +108,33 @@ def save_exists(name, path):
     return get_save_from_name(name) or get_save_from_path(path)
 
 
-def add_server(name, fork, version, path):
+@contextmanager
+def modify():
+    """
+    lock saves.json against other mcm processes and yield the current save
+    list to be changed in place, then write it back atomically
+    """
+    with THREAD_LOCK:
+        SAVES_DIR.mkdir(parents=True, exist_ok=True)
+        with open(LOCK_FILE, 'a') as lock:
+            with span('saves.lock'):
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # another process may have written since we last looked
+            load()
+            saves = [dict(save) for save in STORE['saves']]
+            yield saves
+            with span('saves.write'):
+                tmp = Path(SAVES_DIR, f'.saves.json.{os.getpid()}')
+                with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                        'wt') as file:
+                    file.write(json.dumps(saves, indent=4))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp, SAVES_FILE)
+                index(saves, file_stamp())
+
+
+def add_server(name, fork, version, path, jar=None): # pylint: disable=too-many-arguments
     """
     add a server to the save list and save the file
     """
@@ -48,31 +143,34 @@ def add_server(name, fork, version, path):
     server['fork'] = fork
     server['version'] = version
     server['path'] = str(path)
-    saves = get_saves()
-    if save_exists(name, path):
-        print('A server with that name or path already exists')
-    saves.append(server)
-    if not Path(Path.home(), '.config/mcm/').exists():
-        Path(Path.home(), '.config/mcm/').mkdir(parents=True)
-    with open(Path(Path.home(), '.config/mcm/saves.json'), 'wt') as file:
-        file.write(json.dumps(saves, indent=4))
+    if jar is not None:
+        server['jar'] = jar
+    with modify() as saves:
+        if any(item['name'] == name or item['path'] == str(path) for item in saves):
+            print('A server with that name or path already exists')
+            return
+        saves.append(server)
 
 
-def update_server_version(name, version):
+def update_save(name, **fields):
     """
-    update a server's version
+    set fields on a save, dropping any given as None
     """
-    saves = get_saves()
+    with modify() as saves:
+        for item in saves:
+            if item['name'] == name:
+                item.update(fields)
+                for key, value in fields.items():
+                    if value is None:
+                        del item[key]
+                break
 
-    server = get_save_from_name(name)
-    server['version'] = version
 
-    for i, item in enumerate(saves):
-        if item['name'] == name:
-            saves[i] = server
-            break
-
-    if not Path(Path.home(), '.config/mcm/').exists():
-        Path(Path.home(), '.config/mcm/').mkdir(parents=True)
-    with open(Path(Path.home(), '.config/mcm/saves.json'), 'wt') as file:
-        file.write(json.dumps(saves, indent=4))
+def update_server_version(name, version, jar=None):
+    """
+    update a server's version and the jar it runs
+    """
+    fields = {'version': version}
+    if jar is not None:
+        fields['jar'] = jar
+    update_save(name, **fields)
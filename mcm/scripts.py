@@ -2,17 +2,150 @@
 module to handle creation of start and systemd scripts
 """
 import os
+import re
 import pwd
+import hashlib
 from pathlib import Path
 
+from .profile import span
+from .utils import get_mem_size
 
-MEM_SIZE = min(((os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))/(1024.**3)), 6)
 
+# aikar's flags, with the separate g1 tuning he recommends for heaps of 12G and up
+G1_FLAGS = '-XX:+UseG1GC -XX:+ParallelRefProcEnabled -XX:MaxGCPauseMillis=200 ' + \
+    '-XX:+UnlockExperimentalVMOptions -XX:+DisableExplicitGC -XX:+AlwaysPreTouch ' + \
+    '-XX:G1HeapWastePercent=5 -XX:G1MixedGCCountTarget=4 ' + \
+    '-XX:G1MixedGCLiveThresholdPercent=90 -XX:G1RSetUpdatingPauseTimePercent=5 ' + \
+    '-XX:SurvivorRatio=32 -XX:+PerfDisableSharedMem -XX:MaxTenuringThreshold=1'
+G1_SMALL_HEAP_FLAGS = '-XX:G1NewSizePercent=30 -XX:G1MaxNewSizePercent=40 ' + \
+    '-XX:G1HeapRegionSize=8M -XX:G1ReservePercent=20 -XX:InitiatingHeapOccupancyPercent=15'
+G1_LARGE_HEAP_FLAGS = '-XX:G1NewSizePercent=40 -XX:G1MaxNewSizePercent=50 ' + \
+    '-XX:G1HeapRegionSize=16M -XX:G1ReservePercent=15 -XX:InitiatingHeapOccupancyPercent=20'
+LARGE_HEAP = 12 * 1024
+# the first jdk able to dump a dynamic class data archive when the jvm exits
+CDS_MIN_JAVA = 13
+SYSTEMD_DIR = Path(os.environ.get('MCM_SYSTEMD_DIR', '/etc/systemd/system'))
 
-def create_start_script(server_name, path, jar_name):
+# alternative collectors, selectable per save and compared by mcm bench
+PROFILES = {
+    'aikar': None,
+    'zgc': '-XX:+UnlockExperimentalVMOptions -XX:+UseZGC -XX:+DisableExplicitGC ' + \
+        '-XX:+AlwaysPreTouch -XX:+PerfDisableSharedMem',
+    'shenandoah': '-XX:+UnlockExperimentalVMOptions -XX:+UseShenandoahGC ' + \
+        '-XX:+DisableExplicitGC -XX:+AlwaysPreTouch -XX:+PerfDisableSharedMem',
+}
+
+
+def gc_flags(heap, profile='aikar'):
+    """
+    return the gc flags of a profile for a heap of the given size in MiB
+    """
+    if PROFILES[profile] is not None:
+        return PROFILES[profile]
+    size_flags = G1_LARGE_HEAP_FLAGS if heap >= LARGE_HEAP else G1_SMALL_HEAP_FLAGS
+    return f'{G1_FLAGS} {size_flags} -Dusing.aikars.flags=https://mcflags.emc.gs ' + \
+        '-Daikars.new.flags=true'
+
+
+def default_heap():
+    """
+    return the heap in MiB servers get unless told otherwise: physical ram
+    capped at 6G
+    """
+    return get_mem_size() * 1024
+
+
+def java_flags(heap=None, cpus=None, profile='aikar'):
+    """
+    return every jvm flag for a server, heap in MiB defaulting to
+    default_heap()
+    """
+    if heap is None:
+        heap = default_heap()
+    return f'-Xms{heap}M -Xmx{heap}M {cpu_flags(cpus)}{gc_flags(heap, profile)}'
+
+
+def cpu_flags(cpus):
+    """
+    size the jvm's gc and jit thread pools to the cpus it is pinned to
+    """
+    if cpus is None:
+        return ''
+    return f'-XX:ActiveProcessorCount={cpus} -XX:ParallelGCThreads={cpus} ' + \
+        f'-XX:ConcGCThreads={max(cpus // 4, 1)} '
+
+
+def find_jar(save):
+    """
+    return the jar a save runs, reading it from start.sh for older saves
+    """
+    if 'jar' in save:
+        return f'{save["path"]}/{save["jar"]}'
+    with open(Path(save['path'], 'start.sh'), 'r') as script_fd:
+        match = re.search(r' -jar (\S+) nogui', script_fd.read())
+    if match is None:
+        raise ValueError(f'could not find the jar {save["name"]} runs')
+    return match.group(1)
+
+
+def start_options(save):
+    """
+    return the create_start_script options stored with a save
+    """
+    return {
+        'heap': save.get('heap'),
+        'cpus': len(save['cpus']) if 'cpus' in save else None,
+        'profile': save.get('profile', 'aikar'),
+        'cds': save.get('cds', False),
+    }
+
+
+def rewrite_start_script(save):
     """
-    create the startup script given a few arguments
+    regenerate a save's start script from the settings stored with it
     """
+    create_start_script(save['name'], save['path'], find_jar(save), **start_options(save))
+
+
+def jar_digest(jar_name):
+    """
+    return a short hash of a jar's contents, keying its class data archive
+    """
+    digest = hashlib.sha1()
+    with span('scripts.jar_digest'), open(jar_name, 'rb') as jar_fd:
+        for block in iter(lambda: jar_fd.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def cds_script(jar_name):
+    """
+    return start script lines choosing the class data archive of a jar for the
+    installed jdk: it is loaded when it exists, otherwise the run records it on
+    exit after deleting the archives of older jars and jdks
+    """
+    archive = f'{jar_name}.{jar_digest(jar_name)}-jdk${{java_version}}.jsa'
+    return f'''
+# share the classes this jar loaded on a previous run of the same jdk
+java_version="$(java -version 2>&1 | sed -n 's/.* version "\\([^"]*\\)".*/\\1/p')"
+cds_flags=""
+if [ "${{java_version%%.*}}" -ge {CDS_MIN_JAVA} ] 2>/dev/null; then
+    if [ -f "{archive}" ]; then
+        cds_flags="-XX:SharedArchiveFile={archive}"
+    else
+        rm -f "{Path(jar_name).parent}"/*.jar.*.jsa
+        cds_flags="-XX:ArchiveClassesAtExit={archive}"
+    fi
+fi
+'''
+
+
+def create_start_script(server_name, path, jar_name, cds=False, **options):
+    """
+    create the startup script given a few arguments. options are passed on
+    to java_flags, and cds adds a class data archive kept next to the jar
+    """
+    cds_lines, cds_flags = (cds_script(jar_name), ' $cds_flags') if cds else ('', '')
     start_script = f'''#!/usr/bin/env bash
 ## {server_name}.sh
 
@@ -24,30 +157,33 @@ set -o nounset
 
 # return the exit status of the final command before a failure
 set -o pipefail
-
+{cds_lines}
 # create a new named screen session for the server, killing any existing ones
 if screen -list | grep -q "^{server_name}-mc$"; then
     screen -S "{server_name}-mc" -X quit 2>&1 >/dev/null
 fi
-screen -dmS "{server_name}-mc" java -Xms{MEM_SIZE}G -Xmx{MEM_SIZE}G -XX:+UseG1GC -XX:+UnlockExperimentalVMOptions -XX:MaxGCPauseMillis=100 -XX:+DisableExplicitGC -XX:TargetSurvivorRatio=90 -XX:G1NewSizePercent=50 -XX:G1MaxNewSizePercent=80 -XX:G1MixedGCLiveThresholdPercent=35 -XX:+AlwaysPreTouch -XX:+ParallelRefProcEnabled -Dusing.aikars.flags=mcflags.emc.gs -jar {jar_name} nogui
+screen -dmS "{server_name}-mc" java {java_flags(**options)}{cds_flags} -jar {jar_name} nogui
 '''
 
-    with open(Path(path, 'start.sh'), 'wt') as script_fd:
+    with span('scripts.start', server=server_name), \
+            open(Path(path, 'start.sh'), 'wt') as script_fd:
         script_fd.write(start_script)
     Path(path, 'start.sh').chmod(0o744)
 
 
-def create_systemd_file(server_name, path):
+def create_systemd_file(server_name, path, resources=None, overwrite=False):
     """
-    create a systemd service file if possible
+    create a systemd service file if possible, with optional resource control
+    directives for the service section. returns whether the file was written
     """
-    unit_file = f'/etc/systemd/system/{server_name}-mc.service'
-    if os.path.exists(unit_file):
+    unit_file = Path(SYSTEMD_DIR, f'{server_name}-mc.service')
+    if os.path.exists(unit_file) and not overwrite:
         print('systemd unit file already exists')
-        return
-    if not os.access('/etc/systemd/system/', os.W_OK):
+        return False
+    if not os.access(SYSTEMD_DIR, os.W_OK):
         print('could not write to systemd unit file')
-        return
+        return False
+    controls = ''.join(f'{key}={value}\n' for key, value in (resources or {}).items())
     file_text = f'''[Unit]
 Description=Minecraft Server
 After=network.target
@@ -58,9 +194,10 @@ User={pwd.getpwuid(os.getuid())[0]}
 WorkingDirectory={path}
 ExecStart={path}/start.sh
 Restart=always
-
+{controls}
 [Install]
 WantedBy=multi-user.target
 '''
-    with open(unit_file, 'wt') as script_fd:
+    with span('scripts.systemd', server=server_name), open(unit_file, 'wt') as script_fd:
         script_fd.write(file_text)
+    return True
@@ -2,52 +2,52 @@
 methods to update a server to a given version
 """
 import sys
-import time
-import json
-from urllib.request import urlopen, urlretrieve
+from fnmatch import fnmatch
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from bs4 import BeautifulSoup
+from .cache import install_target, ensure_cached, link_jar
+from .profile import span
+from .resolve import resolve, resolve_or_exit
+from .rollout import stage_server
+from .scripts import create_start_script, rewrite_start_script, start_options
+from .saves import update_server_version, update_save, get_save_from_name, get_saves
+from .versions import print_table
 
-from .utils import reporthook
-from .scripts import create_start_script
-from .saves import update_server_version, get_save_from_name
+
+UPDATE_HEADER = ('name', 'fork', 'from', 'to', 'status')
+
+
+def apply_update(save, target):
+    """
+    install a resolved jar into a save and point its start script at it
+    """
+    path = save['path']
+    install_target(target, path)
+
+    create_start_script(save['name'], path, f'{path}/{target["jar"]}', **start_options(save))
+    update_server_version(save['name'], target['version'], target['jar'])
+
+
+def apply_cds(args, save):
+    """
+    store a --cds or --no-cds choice with a save, returning the save as stored
+    """
+    if args.cds is None:
+        return save
+    update_save(save['name'], cds=args.cds or None)
+    return get_save_from_name(save['name'])
 
 
 def update_paper(args, save):
     """
     update a given paper server
     """
-    paper_versions = json.loads(
-        urlopen('https://papermc.io/api/v1/paper')\
-            .read().decode('utf-8'))
-    if args.version is None or args.version == 'latest':
-        version = paper_versions['versions'][0]
-    else:
-        version = args.version.partition('-')[0]
-        if version not in paper_versions['versions']:
-            print(f'invalid paper version {args.version}')
-            sys.exit(1)
-    # now that we have a good version, get the build number
-    paper_builds = json.loads(
-        urlopen(f'https://papermc.io/api/v1/paper/{version}')\
-            .read().decode('utf-8'))
-    if args.version is not None and '-' in args.version:
-        build = args.version.partition('-')[2]
-        if build not in paper_builds['builds']['all']:
-            print(f'invalid paper build {build}')
-            sys.exit(1)
-    else:
-        build = paper_builds['builds']['latest']
+    target = resolve_or_exit('paper', args.version)
+    version, _, build = target['version'].partition('-')
     print(f'updating to paper version {version}, build {build}')
 
-    urlretrieve(f'https://papermc.io/api/v1/paper/{version}/{build}/download', \
-        f'{save["path"]}/paper-{version}-{build}.jar', reporthook)
-    time.sleep(0.5)
-    print(f'\nDownloaded paper-{version}-{build}.jar to {save["path"]}')
-
-    create_start_script(save['name'], save['path'], f'{save["path"]}/paper-{version}-{build}.jar')
-    update_server_version(save['name'], f'{version}-{build}')
+    apply_update(save, target)
 
     print(f'{save["name"]} updated to version paper-{version}-{build}. ' + \
         'if you\'re using systemd, be sure to restart the server')
@@ -57,91 +57,131 @@ def update_vanilla(args, save):
     """
     update a given vanilla server
     """
-    # load list of all versions from mojang's metadata
-    versions = json.loads(
-        urlopen('https://launchermeta.mojang.com/mc/game/version_manifest.json')\
-            .read().decode('utf-8'))
+    target = resolve_or_exit('vanilla', args.version)
+    print(f'updating to vanilla server version {target["version"]}')
 
-    # get the latest version of minecraft if none was provide
-    if args.version is None or args.version.lower() == 'latest':
-        selected_version = versions['latest']['release']
-    else:
-        selected_version = args.version.lower()
-
-    # get the download url for the server jar or exit if the version is not found
-    server_url = None
-    for version in versions['versions']:
-        if version['id'] == selected_version:
-            version_json = json.loads(urlopen(version['url']).read().decode('utf-8'))
-            server_url = version_json['downloads']['server']['url']
-            break
-    if server_url is None:
-        print(f'Invalid version {selected_version}. Exiting')
-        sys.exit(1)
-    print(f'updating to vanilla server version {selected_version}')
+    apply_update(save, target)
 
-    urlretrieve(server_url, f'{save["path"]}/minecraft-server-{selected_version}.jar', reporthook)
-    time.sleep(0.5)
-    print(f'\nDownloaded minecraft-server-{selected_version}.jar to {save["path"]}')
+    print(f'{save["name"]} updated to version {target["version"]}. ' + \
+        'if you\'re using systemd, be sure to restart the server')
 
-    create_start_script(save['name'], save['path'], f'minecraft-server-{selected_version}.jar')
-    update_server_version(save['name'], f'{selected_version}')
 
-    print(f'{save["name"]} updated to version {selected_version}. ' + \
+def update_forge(args, save):
+    """
+    update a given forge server
+    """
+    target = resolve_or_exit('forge', args.version)
+    print(f'updating to forge version {target["version"]}')
+
+    apply_update(save, target)
+
+    print(f'{save["name"]} updated to version {target["version"]}. ' + \
         'if you\'re using systemd, be sure to restart the server')
 
 
-def update_forge(args, save): # pylint: disable=too-many-branches
+def select_saves(args):
     """
-    forge download handler
+    return the saves matching the fork, version and name filters
     """
-    if args.version is None or args.version == 'latest':
-        page = requests.get('https://files.minecraftforge.net/')
-    else:
-        version = args.version.partition('-')[0]
-        page = requests.get(f'https://files.minecraftforge.net/maven/net/minecraftforge/forge/index_{version}.html')
-    if page.status_code  != 200:
-        print(f'invalid forge version {version}')
-        sys.exit(1)
+    return [save for save in get_saves() if \
+        (args.fork is None or save['fork'] == args.fork) and \
+        (args.from_version is None or fnmatch(save['version'], args.from_version)) and \
+        (args.match is None or fnmatch(save['name'], args.match))]
 
-    parsed_page = BeautifulSoup(page.text, 'html.parser')
-    if args.version is not None and '-' in args.version:
-        links = [e['href'] for e in parsed_page.find_all('a') if \
-            'Direct Download' in e.text and 'universal' in e['href'] \
-            and f'/{args.version}' in e['href']]
-        if len(links) > 0:
-            link = links[0]
-        else:
-            print(f'invalid build {args.version}')
-            sys.exit(1)
 
-    link = parsed_page.find_all('div', attrs={'class': 'download'})[0 if args.version == 'latest' or len(parsed_page.find_all('div', attrs={'class': 'download'})) == 1 else 1].find_all('div', attrs={'class': 'link'})[-1].find_all('a')[0]['href'].partition('url=')[2]
-
-    version = link.partition('/forge/')[2].partition('/')[0].partition('-')[0] + '-' + link.partition('/forge/')[2].partition('-')[2].partition('-')[0].partition('/')[0]
-    print(f'updating to forge version {version}')
+def run_concurrently(func, items, workers):
+    """
+    call func on every item with bounded parallelism, returning a dict of
+    item to (result, error)
+    """
+    def call(item):
+        try:
+            return func(item), None
+        except (OSError, ValueError) as err:
+            return None, err
 
-    path = save['path']
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(items, executor.map(call, items)))
 
-    urlretrieve(link, f'{path}/forge-{version}.jar', reporthook)
-    time.sleep(0.5)
-    print(f'\nDownloaded forge-{version}.jar to {path}')
 
-    create_start_script(save['name'], path, f'{path}/forge-{version}.jar')
-    update_server_version(save['name'], f'{version}')
+def update_all(args): # pylint: disable=too-many-locals
+    """
+    update every matching save, resolving each fork and fetching each jar once
+    """
+    saves = [apply_cds(args, save) for save in select_saves(args)]
+    if not saves:
+        print('no saves match the given filters')
+        sys.exit(1)
 
-    print(f'{save["name"]} updated to version {version}. ' + \
-    'if you\'re using systemd, be sure to restart the server')
+    # servers on the same fork share one resolution and one download
+    with span('update.resolve'):
+        targets = run_concurrently(lambda fork: resolve(fork, args.version),
+            sorted({save['fork'] for save in saves}), args.workers)
+    urls = {target['url']: target['hash'] for target, _ in targets.values() if target}
+    print(f'updating {len(saves)} servers, fetching {len(urls)} jars')
+
+    def fetch(url):
+        with span('update.fetch', url=url):
+            return ensure_cached(url, urls[url], lambda n: None)[0]
+
+    jars = run_concurrently(fetch, sorted(urls), args.workers)
+
+    def install(save):
+        target, err = targets[save['fork']]
+        if err is not None:
+            raise err
+        if save['version'] == target['version']:
+            if args.cds is not None:
+                rewrite_start_script(save)
+            return 'up to date'
+        src, err = jars[target['url']]
+        if err is not None:
+            raise err
+        link_jar(src, Path(save['path'], target['jar']))
+        create_start_script(save['name'], save['path'], f'{save["path"]}/{target["jar"]}',
+            **start_options(save))
+        return 'updated'
+
+    with span('update.install'):
+        results = run_concurrently(lambda i: install(saves[i]), range(len(saves)), args.workers)
+
+    rows = []
+    for i, save in enumerate(saves):
+        status, err = results[i]
+        target = targets[save['fork']][0]
+        if status == 'updated':
+            update_server_version(save['name'], target['version'], target['jar'])
+        rows.append((save['name'], save['fork'], save['version'],
+            target['version'] if target else '-', status or f'failed: {err}'))
+
+    print_table(UPDATE_HEADER, rows)
+    if any(status is None for status, _ in results.values()):
+        sys.exit(1)
+    print('if you\'re using systemd, be sure to restart the updated servers')
 
 
 def update_server(args):
     """
     receive args and dispatch to fork as needed
     """
+    staged = args.stage or args.restart_when_empty or args.restart_at
+    if args.all and staged:
+        print('staged updates restart one server at a time, give its name instead of --all')
+        sys.exit(1)
+    if args.all:
+        update_all(args)
+        return
+    if args.name is None:
+        print('give the name of a server to update, or --all')
+        sys.exit(1)
     save = get_save_from_name(args.name)
     if save is None:
         print(f'could not find save with name {args.name}')
         sys.exit(1)
-    if save['fork'] == 'paper':
+    save = apply_cds(args, save)
+    if staged:
+        stage_server(args, save)
+    elif save['fork'] == 'paper':
         update_paper(args, save)
     elif save['fork'] == 'vanilla':
         update_vanilla(args, save)
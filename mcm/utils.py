@@ -4,23 +4,153 @@ common utils
 import os
 import sys
 import time
+import subprocess
+import threading
+from pathlib import Path
 
 
-def reporthook(count, block_size, total_size):
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path(Path.home(), '.cache')), 'mcm')
+# base url of a mirror serving every upstream host under /<host>/, such as the
+# stand-in the benchmarks run against
+UPSTREAM = os.environ.get('MCM_UPSTREAM', '').rstrip('/')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+class Progress:
+    """
+    thread-safe download progress printer, called with each chunk's byte count
+    """
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def __call__(self, nbytes):
+        with self.lock:
+            self.done += nbytes
+            duration = max(time.time() - self.start, 0.001)
+            speed = int(self.done / (1024 * duration))
+            percent = min(int(self.done * 100 / self.total), 100) if self.total > 0 else 0
+            sys.stdout.write('\r%d%%, %d MB, %d KB/s, %d seconds passed' %
+                (percent, self.done / (1024 * 1024), speed, duration))
+            sys.stdout.flush()
+
+
+def upstream(url):
+    """
+    return where to fetch an upstream url from, which is the url itself unless
+    MCM_UPSTREAM points at a mirror
+    """
+    if not UPSTREAM or url.startswith(f'{UPSTREAM}/'):
+        return url
+    return f'{UPSTREAM}/{url.partition("://")[2]}'
+
+
+def get_mem_size():
+    """
+    return the heap size in GiB to give a server: physical ram, capped at 6
+    """
+    ram = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024.**3)
+    return max(int(min(ram, 6)), 1)
+
+
+def read_properties(path):
+    """
+    read a server's server.properties into a dict, empty if it never ran
+    """
+    properties_file = Path(path, 'server.properties')
+    if not properties_file.exists():
+        return {}
+    properties = {}
+    for line in properties_file.read_text().splitlines():
+        if line.strip() and not line.lstrip().startswith('#'):
+            key, _, value = line.partition('=')
+            properties[key.strip()] = value.strip()
+    return properties
+
+
+def get_worlds(path):
+    """
+    return the directory names of a server's overworld, nether and end
+    """
+    level = read_properties(path).get('level-name') or 'world'
+    return [level, f'{level}_nether', f'{level}_the_end']
+
+
+def write_properties(path, properties):
+    """
+    set keys in a server.properties, creating it if the server never ran
+    """
+    properties_file = Path(path, 'server.properties')
+    lines = properties_file.read_text().splitlines() if properties_file.exists() else []
+    remaining = dict(properties)
+    for i, line in enumerate(lines):
+        key = line.partition('=')[0].strip()
+        if key in remaining and not line.lstrip().startswith('#'):
+            lines[i] = f'{key}={remaining.pop(key)}'
+    lines.extend(f'{key}={value}' for key, value in remaining.items())
+    properties_file.write_text('\n'.join(lines) + '\n')
+
+
+def run_async(coroutine):
+    """
+    run a coroutine to completion on a fresh event loop
+    """
+    import asyncio # pylint: disable=import-outside-toplevel
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def screen_running(server_name):
+    """
+    return whether the screen session start.sh creates for a server exists
+    """
+    try:
+        sessions = subprocess.run(['screen', '-list'], stdout=subprocess.PIPE,
+            universal_newlines=True, check=False).stdout
+    except OSError:
+        return False
+    return f'.{server_name}-mc\t' in sessions
+
+
+def find_java_processes():
+    """
+    return a dict of working directory to pid for every running java process
+    """
+    processes = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/comm', 'r') as comm:
+                if comm.read().strip() != 'java':
+                    continue
+            processes[os.readlink(f'/proc/{pid}/cwd')] = int(pid)
+        except OSError:
+            continue
+    return processes
+
+
+def read_process(pid):
     """
-    used for printing the status of a download
+    return the resident bytes, cpu seconds and thread count of a process
     """
-    global START_TIME # pylint: disable=global-variable-undefined
-    if count == 0:
-        START_TIME = time.time()
-        return
-    duration = time.time() - START_TIME
-    progress_size = int(count * block_size)
-    speed = int(progress_size / (1024 * duration))
-    percent = min(int(count*block_size*100/total_size),100)
-    sys.stdout.write('\r%d%%, %d MB, %d KB/s, %d seconds passed' %
-                    (percent, progress_size / (1024 * 1024), speed, duration))
-    sys.stdout.flush()
+    with open(f'/proc/{pid}/stat', 'r') as stat:
+        # the command name can contain spaces, fields resume after its ')'
+        fields = stat.read().rpartition(')')[2].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = threads = 0
+    with open(f'/proc/{pid}/status', 'r') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return {'rss': rss, 'cpu': cpu, 'threads': threads}
 
 
 def get_is_root() -> bool:
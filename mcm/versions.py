@@ -0,0 +1,317 @@
+"""
+local index of the vanilla, paper and forge versions upstream publishes,
+kept as one file per fork and refreshed incrementally once stale
+"""
+import os
+import re
+import sys
+import json
+import time
+from pathlib import Path
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+from .metadata import get_json, get_text, get_ttl, is_offline
+from .profile import span
+from .saves import get_saves
+from .utils import CACHE_DIR, upstream
+
+
+INDEX_DIR = Path(CACHE_DIR, 'versions')
+MOJANG_MANIFEST = upstream('https://launchermeta.mojang.com/mc/game/version_manifest.json')
+PAPER_API = upstream('https://papermc.io/api/v2/projects/paper')
+FORGE_FILES = upstream('https://files.minecraftforge.net')
+FORGE_MAVEN = upstream('https://maven.minecraftforge.net/net/minecraftforge/forge')
+PROMOTIONS = f'{FORGE_FILES}/net/minecraftforge/forge/promotions_slim.json'
+MAVEN_METADATA = f'{FORGE_MAVEN}/maven-metadata.xml'
+FORKS = ('vanilla', 'paper', 'forge')
+# paper build lists fetched at once when refreshing
+WORKERS = 8
+VERSIONS_HEADER = ('version', 'latest', 'builds')
+OUTDATED_HEADER = ('name', 'fork', 'installed', 'latest in line', 'newest')
+
+
+def version_key(version):
+    """
+    sort key for dotted minecraft and forge versions
+    """
+    return tuple(int(part) for part in re.findall(r'\d+', version))
+
+
+def forge_version(full_version):
+    """
+    return the mc-build version of a maven forge version, dropping the
+    minecraft version old builds carry again as a suffix
+    """
+    mc_version, _, build = full_version.partition('-')
+    return f'{mc_version}-{build.partition("-")[0]}'
+
+
+def load_index(fork):
+    """
+    load the index of a fork, or None if it was never fetched
+    """
+    try:
+        with open(Path(INDEX_DIR, f'{fork}.json'), 'r') as file:
+            return json.loads(file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def save_index(fork, index):
+    """
+    atomically write the index of a fork
+    """
+    INDEX_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = Path(INDEX_DIR, f'.{fork}.json.{os.getpid()}')
+    with open(tmp, 'wt') as file:
+        file.write(json.dumps(index))
+    os.replace(tmp, Path(INDEX_DIR, f'{fork}.json'))
+
+
+def refresh_vanilla(index):
+    """
+    add the versions mojang published since the last refresh
+    """
+    manifest = get_json(MOJANG_MANIFEST)
+    known = index.setdefault('versions', {})
+    for version in manifest['versions']:
+        if version['id'] not in known:
+            known[version['id']] = {'type': version['type'], 'url': version['url'],
+                'time': version['releaseTime']}
+    index['latest'] = manifest['latest']
+
+
+def fetch_builds(version):
+    """
+    return the build numbers paper published for a minecraft version
+    """
+    return get_json(f'{PAPER_API}/versions/{version}')['builds']
+
+
+def refresh_paper(index):
+    """
+    add new paper versions and fetch build lists again only for new versions
+    and the newest line, as older lines rarely get builds
+    """
+    versions = get_json(PAPER_API)['versions']
+    builds = index.setdefault('builds', {})
+    line = version_line(versions[-1])
+    stale = [version for version in versions
+        if version not in builds or version_line(version) == line]
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        builds.update(zip(stale, executor.map(fetch_builds, stale)))
+    index['versions'] = versions
+    index.setdefault('downloads', {})
+
+
+def refresh_forge(index):
+    """
+    fetch forge's promotions and maven version list again
+    """
+    root = ElementTree.fromstring(get_text(MAVEN_METADATA))
+    index['versions'] = [element.text for element in root.iter('version')]
+    index['promos'] = get_json(PROMOTIONS)['promos']
+
+
+REFRESHERS = {
+    'vanilla': (MOJANG_MANIFEST, refresh_vanilla),
+    'paper': (PAPER_API, refresh_paper),
+    'forge': (MAVEN_METADATA, refresh_forge),
+}
+
+
+def get_index(fork, refresh=False):
+    """
+    return the index of a fork, refreshing it first if it is stale or refresh
+    is set. offline, whatever was indexed last is used
+    """
+    url, refresher = REFRESHERS[fork]
+    index = load_index(fork)
+    if is_offline():
+        if index is None:
+            raise ValueError(f'no {fork} versions are indexed and --offline was given')
+        return index
+    if refresh or index is None or time.time() - index['refreshed'] > get_ttl(url):
+        with span('versions.refresh', fork=fork):
+            index = index or {}
+            refresher(index)
+            index['refreshed'] = time.time()
+            save_index(fork, index)
+    return index
+
+
+def paper_download(index, version, build):
+    """
+    return the name and sha256 of a paper build's jar. builds never change,
+    so each is fetched once and kept in the index
+    """
+    key = f'{version}-{build}'
+    if key not in index['downloads']:
+        index['downloads'][key] = get_json(f'{PAPER_API}/versions/{version}/builds/{build}')\
+            ['downloads']['application']
+        save_index('paper', index)
+    return index['downloads'][key]
+
+
+def minecraft_version(fork, version):
+    """
+    return the minecraft version part of a fork's version
+    """
+    return version if fork == 'vanilla' else version.partition('-')[0]
+
+
+def version_line(version):
+    """
+    return the major line of a minecraft version, 1.16 for 1.16.5
+    """
+    return '.'.join(version.split('.')[:2])
+
+
+def is_pattern(version_arg):
+    """
+    whether a version argument names a whole line, such as 1.16.x
+    """
+    return version_arg is not None and version_arg.endswith('.x')
+
+
+def matches(fork, version, pattern):
+    """
+    whether a version falls under a pattern: a line such as 1.16.x, or a
+    minecraft version and everything below it
+    """
+    base = pattern[:-2] if is_pattern(pattern) else pattern
+    mc_version = minecraft_version(fork, version)
+    return version == pattern or mc_version == base or mc_version.startswith(f'{base}.')
+
+
+def get_versions(fork, index, snapshots=True):
+    """
+    return every indexed version of a fork, oldest first, in the form saves
+    record them
+    """
+    if fork == 'vanilla':
+        versions = sorted(index['versions'], key=lambda version: index['versions'][version]['time'])
+        return [version for version in versions
+            if snapshots or index['versions'][version]['type'] == 'release']
+    if fork == 'paper':
+        return [f'{version}-{build}' for version in index['versions']
+            for build in index['builds'].get(version, [])]
+    return sorted({forge_version(version) for version in index['versions']}, key=version_key)
+
+
+def newer_than(fork, versions, than):
+    """
+    return the versions after than, which may be a full version or a
+    minecraft version to skip every build of
+    """
+    positions = [i for i, version in enumerate(versions)
+        if version == than or minecraft_version(fork, version) == than]
+    if not positions:
+        raise ValueError(f'{than} is not a known {fork} version')
+    return versions[positions[-1] + 1:]
+
+
+def latest_matching(fork, index, pattern):
+    """
+    return the newest release under a pattern such as 1.16.x, or None
+    """
+    return next((version for version in reversed(get_versions(fork, index, snapshots=False))
+        if matches(fork, version, pattern)), None)
+
+
+def print_table(header, rows):
+    """
+    print rows under a header in aligned columns
+    """
+    widths = [max(len(str(row[col])) for row in rows + [header]) for col in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def group_builds(fork, versions):
+    """
+    return a row per minecraft version with its latest build and build count,
+    newest first
+    """
+    groups = {}
+    for version in versions:
+        groups.setdefault(minecraft_version(fork, version), []).append(version)
+    return [(mc_version, builds[-1], len(builds)) for mc_version, builds in reversed(groups.items())]
+
+
+def list_versions(args):
+    """
+    print the versions of a fork, filtered by a pattern and a floor
+    """
+    try:
+        index = get_index(args.fork, args.refresh)
+        versions = get_versions(args.fork, index, args.snapshots or args.fork != 'vanilla')
+        if args.newer_than:
+            versions = newer_than(args.fork, get_versions(args.fork, index), args.newer_than)
+            if not args.snapshots and args.fork == 'vanilla':
+                versions = [version for version in versions
+                    if index['versions'][version]['type'] == 'release']
+    except (OSError, ValueError) as err:
+        print(err)
+        sys.exit(1)
+    if args.version:
+        versions = [version for version in versions if matches(args.fork, version, args.version)]
+    if not versions:
+        print(f'no {args.fork} versions match')
+        return
+    if args.fork == 'vanilla':
+        print_table(('version', 'type', 'released'), [(version, index['versions'][version]['type'],
+            index['versions'][version]['time'][:10]) for version in reversed(versions)])
+    else:
+        print_table(VERSIONS_HEADER, group_builds(args.fork, versions))
+
+
+def list_latest(args):
+    """
+    print the newest version of every fork
+    """
+    for fork in FORKS:
+        try:
+            index = get_index(fork, args.refresh)
+        except (OSError, ValueError) as err:
+            print(f'{fork}: could not load versions: {err}')
+            continue
+        versions = get_versions(fork, index, snapshots=False)
+        print(f'{fork}: {versions[-1] if versions else "none"}, {len(versions)} versions indexed')
+
+
+def list_outdated():
+    """
+    compare every save against the indexed versions without going online
+    """
+    rows = []
+    for save in get_saves():
+        index = load_index(save['fork'])
+        if index is None:
+            rows.append((save['name'], save['fork'], save['version'], '-', 'not indexed'))
+            continue
+        snapshots = save['fork'] == 'vanilla' and \
+            index['versions'].get(save['version'], {}).get('type', 'release') != 'release'
+        versions = get_versions(save['fork'], index, snapshots)
+        line = version_line(minecraft_version(save['fork'], save['version']))
+        in_line = next((version for version in reversed(versions) if
+            version_line(minecraft_version(save['fork'], version)) == line), '-')
+        rows.append((save['name'], save['fork'], save['version'], in_line,
+            versions[-1] if versions else '-'))
+    if not rows:
+        print('no saves found')
+        return
+    print_table(OUTDATED_HEADER, rows)
+
+
+def handle_versions(args):
+    """
+    dispatch version queries
+    """
+    if args.outdated:
+        list_outdated()
+    elif args.fork is None:
+        list_latest(args)
+    else:
+        list_versions(args)
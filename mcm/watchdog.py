@@ -0,0 +1,584 @@
+"""
+supervise every saved server from one asyncio loop. each server's latest.log
+is followed for lag warnings and watchdog dumps, it is pinged over server
+list ping, and its jvm's memory and gc threads are sampled from /proc. what
+happens about each kind of trouble is up to the server's policy, and servers
+that keep crashing are quarantined until released
+"""
+import os
+import sys
+import time
+import signal
+import shutil
+import asyncio
+import subprocess
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+from .bench import DONE_PATTERN, LAG_PATTERN
+from .memory import footprint, get_current_heap
+from .ping import ping_save
+from .saves import get_saves, get_save_from_name, update_save
+from .utils import find_java_processes, read_process, CLOCK_TICKS
+
+
+EVENTS = ('lag', 'stall', 'unresponsive', 'memory', 'gc', 'crash')
+# every action also does what the ones before it do
+ACTIONS = ('ignore', 'alert', 'dump', 'restart')
+DEFAULT_POLICY = {'lag': 'alert', 'stall': 'dump', 'unresponsive': 'restart', 'memory': 'alert',
+    'gc': 'alert', 'crash': 'restart'}
+# paper and spigot's watchdog, and vanilla's when a tick hangs long enough to crash
+STALL_MARKERS = ('The server has stopped responding!', 'A single server tick took')
+STOP_MARKERS = ('Stopping server', 'Stopping the server')
+# jvm threads doing garbage collection, by the start of their names
+GC_THREADS = ('GC Thread', 'G1 ', 'ZWorker', 'ZDriver', 'ZDirector', 'Shenandoah')
+# most bytes of a log read per check, so a flood of output can't balloon memory
+READ_LIMIT = 1024 * 1024
+# seconds between scans of /proc for servers that were started
+RESCAN_INTERVAL = 30
+# checks between looking for new gc threads
+GC_RESCAN = 10
+# checks in a row gc has to dominate cpu time before it counts
+GC_STRIKES = 3
+# cpu seconds per check a jvm has to use for its gc share to mean anything
+GC_MIN_CPU = 0.05
+ALERT_COOLDOWN = 600
+BACKOFF_START = 10
+BACKOFF_MAX = 600
+DUMP_TIMEOUT = 30
+# seconds a stopped server has to exit before it is killed
+KILL_GRACE = 10
+
+
+def get_policy(save):
+    """
+    return what the watchdog does about each event on a save
+    """
+    return dict(DEFAULT_POLICY, **save.get('watchdog', {}))
+
+
+def read_gc_threads(pid, threads):
+    """
+    update threads, a dict of gc thread id to cpu seconds, and return the
+    cpu seconds its threads used since last time. threads seen for the
+    first time count from now
+    """
+    used = 0
+    for tid, last in list(threads.items()):
+        try:
+            with open(f'/proc/{pid}/task/{tid}/stat', 'r') as stat:
+                fields = stat.read().rpartition(')')[2].split()
+        except OSError:
+            del threads[tid]
+            continue
+        cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        if last is not None:
+            used += cpu - last
+        threads[tid] = cpu
+    return used
+
+
+def find_gc_threads(pid, threads):
+    """
+    add gc threads a jvm started since the last look to threads
+    """
+    try:
+        tids = os.listdir(f'/proc/{pid}/task')
+    except OSError:
+        return
+    for tid in tids:
+        if tid in threads:
+            continue
+        try:
+            with open(f'/proc/{pid}/task/{tid}/comm', 'r') as comm:
+                if comm.read().startswith(GC_THREADS):
+                    threads[tid] = None
+        except OSError:
+            continue
+
+
+def process_gone(pid, grace):
+    """
+    wait up to grace seconds for a process to exit, returning whether it did
+    """
+    deadline = time.monotonic() + grace
+    while os.path.exists(f'/proc/{pid}'):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.5)
+    return True
+
+
+class Watch: # pylint: disable=too-many-instance-attributes
+    """
+    what the watchdog knows about one server between checks
+    """
+    def __init__(self, save):
+        self.save = save
+        self.path = os.path.realpath(save['path'])
+        self.heap = get_current_heap(save)
+        self.pid = None
+        self.log = None
+        self.inode = None
+        self.partial = b''
+        self.follow_log(True)
+        self.healthy_since = time.monotonic() if self.started() else None
+        self.lag = deque()
+        self.failures = deque()
+        self.alerted = {}
+        self.gc_threads = {}
+        self.cpu = None
+        self.checks = 0
+        self.gc_strikes = 0
+        self.ping_failures = 0
+        self.pinged = 0
+        self.stopped = False
+        self.busy = False
+        self.backoff = BACKOFF_START
+
+    def started(self):
+        """
+        return whether the current log shows the server finished starting,
+        for servers already running when the watchdog starts
+        """
+        try:
+            with open(Path(self.save['path'], 'logs', 'latest.log'), 'rb') as log:
+                # Done comes early in a log, well within the first read
+                return DONE_PATTERN.search(log.read(READ_LIMIT).decode('utf-8', 'replace')) \
+                    is not None
+        except OSError:
+            return False
+
+    def reset(self, pid):
+        """
+        start over for a new jvm
+        """
+        self.pid = pid
+        self.gc_threads = {}
+        self.cpu = None
+        self.checks = 0
+        self.gc_strikes = 0
+        self.ping_failures = 0
+        self.stopped = False
+
+    def follow_log(self, at_end):
+        """
+        start following the current latest.log from its end or its start,
+        keeping it open so the rest of it can be read after it is rotated
+        """
+        self.close()
+        self.inode, self.partial = None, b''
+        try:
+            self.log = open(Path(self.save['path'], 'logs', 'latest.log'), 'rb')
+        except OSError:
+            return
+        self.inode = os.fstat(self.log.fileno()).st_ino
+        if at_end:
+            self.log.seek(0, os.SEEK_END)
+
+    def close(self):
+        """
+        stop following the log
+        """
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def read_lines(self):
+        """
+        return the complete lines written to the followed log since the last read
+        """
+        if self.log is None:
+            return ''
+        data = self.partial + self.log.read(READ_LIMIT)
+        complete = data.rfind(b'\n') + 1
+        # a line too long to finish within the limit is dropped
+        self.partial = data[complete:] if len(data) - complete < READ_LIMIT else b''
+        return data[:complete].decode('utf-8', 'replace')
+
+    def read_log(self):
+        """
+        return the complete lines appended to latest.log since the last read,
+        and whether the server started a new log
+        """
+        text = self.read_lines()
+        try:
+            stat = Path(self.save['path'], 'logs', 'latest.log').stat()
+        except OSError:
+            return text, False
+        if self.log is not None and stat.st_ino == self.inode and \
+                stat.st_size >= self.log.tell():
+            return text, False
+        # the old log was read to its end above, the new one is read from its start
+        self.follow_log(False)
+        return text + self.read_lines(), True
+
+
+class Supervisor:
+    """
+    checks every saved server on an interval and acts on its policy
+    """
+    def __init__(self, args):
+        self.args = args
+        self.watches = {}
+        self.processes = {}
+        self.scanned = 0
+        self.tasks = set()
+        self.stopping = None
+
+    def log(self, save, message):
+        """
+        print a timestamped line about a server
+        """
+        print(f'{datetime.now():%Y-%m-%d %H:%M:%S} {save["name"]}: {message}', flush=True)
+
+    async def alert(self, watch, event, message):
+        """
+        report an event, at most once per cooldown for each kind, running the
+        alert command with the details in its environment
+        """
+        now = time.monotonic()
+        if now - watch.alerted.get(event, -ALERT_COOLDOWN) < ALERT_COOLDOWN:
+            return
+        watch.alerted[event] = now
+        self.log(watch.save, f'{event}: {message}')
+        if self.args.alert_command:
+            process = await asyncio.create_subprocess_shell(self.args.alert_command,
+                env=dict(os.environ, MCM_SERVER=watch.save['name'], MCM_EVENT=event,
+                    MCM_MESSAGE=message))
+            await process.wait()
+
+    async def dump(self, watch):
+        """
+        capture a thread dump of a server's jvm into its logs directory
+        """
+        if watch.pid is None:
+            return
+        jcmd = shutil.which('jcmd')
+        if jcmd is None:
+            # without jcmd the jvm prints the dump to its console instead
+            os.kill(watch.pid, signal.SIGQUIT)
+            self.log(watch.save, 'jcmd not found, sent SIGQUIT for a thread dump on the console')
+            return
+        path = Path(watch.save['path'], 'logs',
+            f'mcm-threads-{datetime.now():%Y-%m-%d-%H%M%S}.txt')
+        with open(path, 'wb') as dump_fd:
+            process = await asyncio.create_subprocess_exec(jcmd, str(watch.pid), 'Thread.print',
+                stdout=dump_fd, stderr=subprocess.STDOUT)
+            try:
+                await asyncio.wait_for(process.wait(), DUMP_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        self.log(watch.save, f'wrote a thread dump to {path}')
+
+    async def handle(self, watch, event, message):
+        """
+        act on an event according to the server's policy
+        """
+        action = ACTIONS.index(get_policy(watch.save)[event])
+        if action >= ACTIONS.index('alert'):
+            await self.alert(watch, event, message)
+        if action >= ACTIONS.index('dump') and event != 'crash':
+            await self.dump(watch)
+        if action >= ACTIONS.index('restart'):
+            task = asyncio.ensure_future(self.restart(watch, event))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def cycle(self, save, pid):
+        """
+        stop a server, killing its jvm if it won't exit, then start it and
+        wait for it to log Done. returns its startup time, or None
+        """
+        # the restart path pulls in the download stack, which is only paid for once needed
+        from .rollout import stop_server, start_server, log_inode, wait_for_done # pylint: disable=import-outside-toplevel
+        if pid is not None:
+            stop_server(save)
+            if not process_gone(pid, KILL_GRACE):
+                os.kill(pid, signal.SIGKILL)
+        inode = log_inode(save)
+        start_server(save)
+        return wait_for_done(save, inode, self.args.done_timeout)
+
+    async def restart(self, watch, event):
+        """
+        restart a server after a backoff that grows with each restart,
+        quarantining it instead once it fails too often
+        """
+        if watch.busy:
+            return
+        watch.busy = True
+        try:
+            now = time.monotonic()
+            watch.failures.append(now)
+            while watch.failures[0] < now - self.args.crash_window:
+                watch.failures.popleft()
+            if len(watch.failures) >= self.args.crash_limit:
+                await self.quarantine(watch)
+                return
+            from .rollout import systemd_unit # pylint: disable=import-outside-toplevel
+            if event == 'crash' and systemd_unit(watch.save):
+                # Restart=always already brings it back, only the crash loop is ours to catch
+                return
+            self.log(watch.save, f'restarting in {watch.backoff}s after {event}')
+            await asyncio.sleep(watch.backoff)
+            watch.backoff = min(watch.backoff * 2, BACKOFF_MAX)
+            pid = watch.pid if event != 'crash' else None
+            loop = asyncio.get_event_loop()
+            done = await loop.run_in_executor(None, self.cycle, watch.save, pid)
+            watch.reset(None)
+            watch.follow_log(True)
+            # look for the new jvm right away
+            self.scanned = 0
+            if done is None:
+                await self.alert(watch, 'restart', 'did not reach Done after restarting')
+            else:
+                watch.healthy_since = time.monotonic()
+                self.log(watch.save, f'back up, started in {done:.1f}s')
+        except (OSError, subprocess.CalledProcessError) as err:
+            await self.alert(watch, 'restart', f'restart failed: {err}')
+        finally:
+            watch.busy = False
+
+    async def quarantine(self, watch):
+        """
+        stop a crash looping server and leave it alone until released
+        """
+        from .rollout import stop_server # pylint: disable=import-outside-toplevel
+        await self.alert(watch, 'quarantine', f'{len(watch.failures)} failures within ' + \
+            f'{self.args.crash_window:.0f}s, stopping it until "mcm watchdog release ' + \
+            f'{watch.save["name"]}"')
+        update_save(watch.save['name'], quarantined=int(time.time()))
+        watch.save = get_save_from_name(watch.save['name'])
+        if watch.pid is not None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, stop_server, watch.save)
+        watch.reset(None)
+
+    def find_pid(self, watch):
+        """
+        return the pid of a server's jvm, scanning /proc for new ones only
+        every so often or when its log shows it started
+        """
+        if watch.pid is not None and os.path.exists(f'/proc/{watch.pid}'):
+            return watch.pid
+        if time.monotonic() - self.scanned >= RESCAN_INTERVAL:
+            self.processes = find_java_processes()
+            self.scanned = time.monotonic()
+        pid = self.processes.get(watch.path)
+        # the last scan may be older than the jvm it found
+        return pid if pid is not None and os.path.exists(f'/proc/{pid}') else None
+
+    def read_log(self, watch):
+        """
+        follow a server's log, returning the events it shows
+        """
+        text, restarted = watch.read_log()
+        if restarted:
+            # a new log means a new jvm, look for it right away
+            watch.healthy_since = None
+            self.scanned = 0
+        events = []
+        now = time.monotonic()
+        for line in text.splitlines():
+            if LAG_PATTERN.search(line):
+                watch.lag.append(now)
+            elif any(marker in line for marker in STALL_MARKERS):
+                events.append(('stall', line.strip()))
+            elif DONE_PATTERN.search(line):
+                watch.healthy_since = now
+            elif any(marker in line for marker in STOP_MARKERS):
+                watch.stopped = True
+        while watch.lag and watch.lag[0] < now - self.args.lag_window:
+            watch.lag.popleft()
+        if len(watch.lag) >= self.args.lag_warnings:
+            events.append(('lag', f'{len(watch.lag)} "Can\'t keep up!" warnings in the last ' + \
+                f'{self.args.lag_window:.0f}s'))
+            watch.lag.clear()
+        return events
+
+    def sample(self, watch):
+        """
+        sample a jvm's memory and the share of its cpu time spent on gc,
+        returning the events they show
+        """
+        events = []
+        try:
+            process = read_process(watch.pid)
+        except OSError:
+            return events
+        if watch.heap is not None and \
+                process['rss'] > footprint(watch.heap) * 1024 * 1024 * self.args.rss_margin:
+            events.append(('memory', f'resident {process["rss"] / (1024 * 1024):.1f} MB ' + \
+                f'with a {watch.heap} MiB heap'))
+        if watch.checks % GC_RESCAN == 0:
+            find_gc_threads(watch.pid, watch.gc_threads)
+        watch.checks += 1
+        gc_used = read_gc_threads(watch.pid, watch.gc_threads)
+        if watch.cpu is not None and process['cpu'] - watch.cpu >= GC_MIN_CPU and \
+                gc_used / (process['cpu'] - watch.cpu) > self.args.gc_share:
+            watch.gc_strikes += 1
+            if watch.gc_strikes == GC_STRIKES:
+                events.append(('gc', f'gc threads used {gc_used / (process["cpu"] - watch.cpu):.0%} ' + \
+                    f'of cpu time for {GC_STRIKES} checks in a row'))
+        else:
+            watch.gc_strikes = 0
+        watch.cpu = process['cpu']
+        return events
+
+    async def ping(self, watch):
+        """
+        ping a server that finished starting, returning the events it shows
+        """
+        if watch.healthy_since is None or \
+                time.monotonic() - watch.pinged < self.args.ping_interval:
+            return []
+        watch.pinged = time.monotonic()
+        status = await ping_save(watch.save, self.args.ping_timeout)
+        if status['online']:
+            watch.ping_failures = 0
+            return []
+        watch.ping_failures += 1
+        if watch.ping_failures < self.args.ping_failures:
+            return []
+        watch.ping_failures = 0
+        return [('unresponsive', f'no answer to {self.args.ping_failures} pings in a row: ' + \
+            status['error'])]
+
+    async def check(self, watch):
+        """
+        check a server once
+        """
+        if watch.busy or 'quarantined' in watch.save:
+            return
+        events = self.read_log(watch)
+        pid = self.find_pid(watch)
+        if pid != watch.pid:
+            if watch.pid is not None and watch.stopped:
+                self.log(watch.save, 'stopped')
+            elif watch.pid is not None:
+                events.append(('crash', f'the jvm (pid {watch.pid}) exited without stopping'))
+            if pid is None:
+                watch.healthy_since = None
+            else:
+                self.log(watch.save, f'running as pid {pid}')
+            watch.reset(pid)
+        if pid is not None:
+            events += self.sample(watch)
+            events += await self.ping(watch)
+            if watch.healthy_since is not None and \
+                    time.monotonic() - watch.healthy_since > self.args.crash_window:
+                watch.backoff = BACKOFF_START
+        for event, message in events:
+            await self.handle(watch, event, message)
+
+    def sync(self):
+        """
+        follow servers being added to and removed from saves.json
+        """
+        saves = {save['name']: save for save in get_saves()}
+        for name in list(self.watches):
+            if name not in saves:
+                self.watches.pop(name).close()
+        for name, save in saves.items():
+            if name not in self.watches:
+                self.watches[name] = Watch(save)
+                if 'quarantined' in save:
+                    self.log(save, 'quarantined, release it with ' + \
+                        f'"mcm watchdog release {name}"')
+            elif self.watches[name].save is not save:
+                self.watches[name].save = save
+                self.watches[name].heap = get_current_heap(save)
+
+    async def run(self):
+        """
+        check every server on the interval until stopped by a signal
+        """
+        loop = asyncio.get_event_loop()
+        self.stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stopping.set)
+        print(f'watching {len(get_saves())} servers every {self.args.interval:g}s', flush=True)
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            self.sync()
+            await asyncio.gather(*[self.check(watch) for watch in self.watches.values()])
+            try:
+                await asyncio.wait_for(self.stopping.wait(),
+                    max(self.args.interval - (time.monotonic() - started), 0))
+            except asyncio.TimeoutError:
+                pass
+        for task in self.tasks:
+            task.cancel()
+
+
+def run_watchdog(args):
+    """
+    supervise every saved server until interrupted
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(Supervisor(args).run())
+    finally:
+        loop.close()
+
+
+def set_policy(args):
+    """
+    change what the watchdog does about events on a server, then print its
+    policy
+    """
+    from .versions import print_table # pylint: disable=import-outside-toplevel
+    save = get_save_from_name(args.name)
+    if save is None:
+        print(f'could not find save with name {args.name}')
+        sys.exit(1)
+    policy = dict(save.get('watchdog', {}))
+    for assignment in args.on or []:
+        event, _, action = assignment.partition('=')
+        if event not in EVENTS or action not in ACTIONS:
+            print(f'invalid --on "{assignment}", expected EVENT=ACTION with an event of ' + \
+                f'{", ".join(EVENTS)} and an action of {", ".join(ACTIONS)}')
+            sys.exit(1)
+        policy[event] = action
+    if args.on:
+        # only what differs from the defaults is stored
+        update_save(save['name'], watchdog={event: action for event, action in policy.items()
+            if DEFAULT_POLICY[event] != action} or None)
+        save = get_save_from_name(args.name)
+    print_table(('event', 'action'), [(event, get_policy(save)[event]) for event in EVENTS])
+    if 'quarantined' in save:
+        print(f'quarantined since {datetime.fromtimestamp(save["quarantined"]):%Y-%m-%d %H:%M}')
+
+
+def release(args):
+    """
+    let the watchdog look after a quarantined server again
+    """
+    save = get_save_from_name(args.name)
+    if save is None:
+        print(f'could not find save with name {args.name}')
+        sys.exit(1)
+    if 'quarantined' not in save:
+        print(f'{save["name"]} is not quarantined')
+        return
+    update_save(save['name'], quarantined=None)
+    print(f'released {save["name"]}, start it again and the watchdog will pick it up')
+
+
+def handle_watchdog(args):
+    """
+    dispatch watchdog actions
+    """
+    if args.watchdog_action == 'run':
+        run_watchdog(args)
+    elif args.watchdog_action == 'policy':
+        set_policy(args)
+    elif args.watchdog_action == 'release':
+        release(args)
+    else:
+        print('no action given, use "mcm watchdog run", "mcm watchdog policy" or ' + \
+            '"mcm watchdog release"')
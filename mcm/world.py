@@ -0,0 +1,260 @@
+"""
+report where a world's disk space goes and prune chunks nobody spends time
+in. region headers are read through mmap and InhabitedTime by inflating
+each chunk only as far as the tag
+"""
+import os
+import re
+import sys
+import mmap
+import math
+import zlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from .anvil import HEADER, SECTOR, GZIP, EXTERNAL, TAG_INT, TAG_LONG, read_header, read_chunk, \
+    find_tag, chunk_position, write_region
+from .saves import get_save_from_name
+from .utils import get_worlds, screen_running
+
+
+TICKS_PER_SECOND = 20
+DURATION = re.compile(r'(\d+)([tsmhd]?)')
+UNIT_TICKS = {'t': 1, '': TICKS_PER_SECOND, 's': TICKS_PER_SECOND, 'm': 60 * TICKS_PER_SECOND,
+    'h': 3600 * TICKS_PER_SECOND, 'd': 86400 * TICKS_PER_SECOND}
+# InhabitedTime buckets for the analysis, in ticks
+BUCKETS = (('under 1m', 60 * TICKS_PER_SECOND), ('under 5m', 300 * TICKS_PER_SECOND),
+    ('under 1h', 3600 * TICKS_PER_SECOND), ('1h or more', math.inf))
+# directories holding region files indexed the same way as a dimension's chunks
+COMPANIONS = ('entities', 'poi')
+
+
+def parse_duration(text):
+    """
+    parse a duration such as 5m, 2h or 6000t into ticks
+    """
+    match = DURATION.fullmatch(text)
+    if match is None:
+        raise ValueError(f'invalid duration {text}, use a number with t, s, m, h or d')
+    return int(match.group(1)) * UNIT_TICKS[match.group(2)]
+
+
+def get_region_dirs(save):
+    """
+    return the region directory of every dimension of a save
+    """
+    return sorted(path for world in get_worlds(save['path'])
+        for path in Path(save['path'], world).glob('**/region') if path.is_dir())
+
+
+def get_spawn(save):
+    """
+    return the x and z of the overworld spawn, or 0, 0 if it can't be read
+    """
+    try:
+        with open(Path(save['path'], get_worlds(save['path'])[0], 'level.dat'), 'rb') as file:
+            data = file.read()
+        return find_tag(GZIP, data, TAG_INT, 'SpawnX') or 0, \
+            find_tag(GZIP, data, TAG_INT, 'SpawnZ') or 0
+    except (OSError, ValueError, zlib.error):
+        return 0, 0
+
+
+def read_inhabited(path):
+    """
+    return (index, InhabitedTime or None) for every chunk of a region file
+    """
+    chunks = []
+    with open(path, 'rb') as region:
+        if os.fstat(region.fileno()).st_size < HEADER:
+            return chunks
+        with mmap.mmap(region.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for index, offset, _, _ in read_header(buffer):
+                try:
+                    compression, data = read_chunk(buffer, offset)
+                    inhabited = None if compression & EXTERNAL else \
+                        find_tag(compression, data, TAG_LONG, 'InhabitedTime')
+                except (ValueError, zlib.error):
+                    inhabited = None
+                chunks.append((index, inhabited))
+    return chunks
+
+
+def analyze_region(path):
+    """
+    return the size of a region file and the InhabitedTime of its chunks
+    """
+    return os.path.getsize(path), read_inhabited(path)
+
+
+def get_doomed(path, threshold, center, radius):
+    """
+    return the indexes of the chunks of a region to prune: those inhabited
+    for less than threshold ticks and further than radius blocks from center.
+    chunks whose InhabitedTime can't be read are kept
+    """
+    doomed = []
+    for index, inhabited in read_inhabited(path):
+        if threshold is not None and (inhabited is None or inhabited >= threshold):
+            continue
+        if radius is not None:
+            chunk_x, chunk_z = chunk_position(path, index)
+            distance = math.hypot(chunk_x * 16 + 8 - center[0], chunk_z * 16 + 8 - center[1])
+            if distance <= radius:
+                continue
+        doomed.append(index)
+    return doomed
+
+
+def read_kept(path, doomed):
+    """
+    return the size of a region file, the (index, timestamp, compression,
+    data) of the chunks it keeps and the sector counts of its doomed chunks.
+    raises ValueError when a kept chunk can't be read
+    """
+    with open(path, 'rb') as region:
+        buffer = region.read()
+    kept, removed = [], []
+    for index, offset, sectors, timestamp in read_header(buffer):
+        if index in doomed:
+            removed.append(sectors)
+        else:
+            kept.append((index, timestamp, *read_chunk(buffer, offset)))
+    return len(buffer), kept, removed
+
+
+def compact_region(path, size, kept):
+    """
+    rewrite a region file with only the kept chunks, deleting it once it has
+    none left. returns the bytes freed
+    """
+    if kept:
+        write_region(path, kept)
+        return size - os.path.getsize(path)
+    os.unlink(path)
+    return size
+
+
+def prune_region(path, threshold, center, radius, dry_run): # pylint: disable=too-many-arguments
+    """
+    prune the doomed chunks of a region file and of its entities and poi
+    companions. returns the number of chunks pruned, the bytes freed and why
+    the region was left alone, if it was. every file is read before any is
+    rewritten, so a region with an unreadable chunk is skipped whole
+    """
+    doomed = set(get_doomed(path, threshold, center, radius))
+    if not doomed:
+        return 0, 0, None
+    dimension = Path(path).parent.parent
+    regions = [Path(dimension, directory, Path(path).name) for directory in COMPANIONS] + \
+        [Path(path)]
+    try:
+        plans = [(region, *read_kept(region, doomed)) for region in regions if region.exists()]
+    except ValueError as err:
+        return 0, 0, f'{path}: {err}'
+    if dry_run:
+        return len(doomed), sum(sectors * SECTOR for *_, removed in plans
+            for sectors in removed), None
+    freed = sum(compact_region(region, size, kept)
+        for region, size, kept, removed in plans if removed)
+    return len(doomed), freed, None
+
+
+def get_save(name):
+    """
+    return a save by name or exit
+    """
+    save = get_save_from_name(name)
+    if save is None:
+        print(f'could not find save with name {name}')
+        sys.exit(1)
+    return save
+
+
+def analyze_world(args): # pylint: disable=too-many-locals
+    """
+    print the size of every dimension, the largest regions and how long
+    players have spent in the chunks
+    """
+    save = get_save(args.name)
+    regions = [path for directory in get_region_dirs(save) for path in directory.glob('r.*.mca')]
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = dict(zip(regions, executor.map(analyze_region, regions, chunksize=16)))
+
+    buckets = {label: 0 for label, _ in BUCKETS}
+    unknown = 0
+    for directory in get_region_dirs(save):
+        dimension = [result for path, result in results.items() if path.parent == directory]
+        size = sum(size for size, _ in dimension)
+        companions = sum(path.stat().st_size for name in COMPANIONS
+            for path in Path(directory.parent, name).glob('r.*.mca'))
+        print(f'{directory.parent.relative_to(save["path"])}: {len(dimension)} regions, ' + \
+            f'{sum(len(chunks) for _, chunks in dimension)} chunks, ' + \
+            f'{size / (1024 * 1024):.1f} MB of chunks, ' + \
+            f'{companions / (1024 * 1024):.1f} MB of entities and poi')
+        for _, chunks in dimension:
+            for _, inhabited in chunks:
+                if inhabited is None:
+                    unknown += 1
+                    continue
+                label = next(label for label, limit in BUCKETS if inhabited < limit)
+                buckets[label] += 1
+
+    print('time players spent in chunks:')
+    for label, count in buckets.items():
+        print(f'  {label}: {count} chunks')
+    if unknown:
+        print(f'  unreadable: {unknown} chunks')
+    print('largest regions:')
+    for path, (size, chunks) in sorted(results.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f'  {path.relative_to(save["path"])}: {size / (1024 * 1024):.1f} MB, ' + \
+            f'{len(chunks)} chunks')
+
+
+def prune_world(args):
+    """
+    drop chunks players barely visited outside a radius and compact the regions
+    """
+    save = get_save(args.name)
+    if args.inhabited_below is None and args.outside_radius is None:
+        print('give --inhabited-below, --outside-radius or both')
+        sys.exit(1)
+    if not args.dry_run and screen_running(save['name']):
+        print(f'{save["name"]} is running, stop it before pruning its world')
+        sys.exit(1)
+    try:
+        threshold = parse_duration(args.inhabited_below) if args.inhabited_below else None
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    # the radius is around spawn in the overworld and around 0, 0 elsewhere, as in pregen
+    spawn = get_spawn(save)
+    overworld = Path(save['path'], get_worlds(save['path'])[0], 'region')
+    regions = [path for directory in get_region_dirs(save) for path in directory.glob('r.*.mca')]
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        jobs = [executor.submit(prune_region, str(path), threshold,
+            spawn if path.parent == overworld else (0, 0), args.outside_radius, args.dry_run)
+            for path in regions]
+        results = [job.result() for job in jobs]
+    pruned = sum(count for count, _, _ in results)
+    freed = sum(size for _, size, _ in results)
+    print(f'{"would prune" if args.dry_run else "pruned"} {pruned} chunks from ' + \
+        f'{sum(1 for count, _, _ in results if count)} regions and ' + \
+        f'{"would free" if args.dry_run else "freed"} {freed / (1024 * 1024):.1f} MB')
+    skipped = [reason for _, _, reason in results if reason]
+    if skipped:
+        print(f'left {len(skipped)} regions with unreadable chunks untouched:')
+        for reason in skipped:
+            print(f'  {reason}')
+
+
+def handle_world(args):
+    """
+    dispatch world actions
+    """
+    if args.world_action == 'analyze':
+        analyze_world(args)
+    elif args.world_action == 'prune':
+        prune_world(args)
+    else:
+        print('no action given, use "mcm world analyze" or "mcm world prune"')